@@ -0,0 +1,90 @@
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.filebased import FileBasedCache
+from api.metrics import registry
+from api.replicas import allow_replica_reads, reset_replica_reads
+
+
+class CatalogCache:
+    """
+    Cache of serialized product payloads. Every key embeds the catalog
+    generation, which is bumped on any product change, so stale entries are
+    never served. Concurrent misses on the same key are collapsed into a single
+    fill per process
+    """
+    generation_key = "catalog:generation"
+    lock_stripes = 64
+
+    def __init__(self):
+        self._locks = [threading.Lock() for _ in range(self.lock_stripes)]
+
+    @property
+    def cache(self):
+        return caches[settings.CATALOG_CACHE_ALIAS]
+
+    def generation(self):
+        generation = self.cache.get(self.generation_key)
+        if generation is None:
+            # start from the clock, so a lost counter never goes back to an old generation
+            self.cache.add(self.generation_key, int(time.time() * 1000), None)
+            generation = self.cache.get(self.generation_key)
+        return generation
+
+    def bump(self):
+        """
+        Invalidates every cached payload
+        """
+        try:
+            self.cache.incr(self.generation_key)
+        except ValueError:
+            self.generation()
+
+    def get_or_fill(self, key, fill):
+        """
+        Returns the payload cached under key, calling fill() to compute and
+        store it on a miss. The fill reads from the primary: a lagging replica's
+        rows would be cached under the current generation
+        """
+        key = "catalog:{}:{}".format(self.generation(), key)
+        value = self.cache.get(key)
+        if value is not None:
+            registry.inc("cache_requests_total", (("cache", "catalog"), ("result", "hit")))
+            return value
+        registry.inc("cache_requests_total", (("cache", "catalog"), ("result", "miss")))
+        with self._locks[hash(key) % self.lock_stripes]:
+            # another thread may have filled it while we waited
+            value = self.cache.get(key)
+            if value is None:
+                token = allow_replica_reads(False)
+                try:
+                    value = fill()
+                finally:
+                    reset_replica_reads(token)
+                self.cache.set(key, value, settings.CATALOG_CACHE_TIMEOUT)
+        return value
+
+
+catalog_cache = CatalogCache()
+
+
+class ExpiringFileBasedCache(FileBasedCache):
+    """
+    File based cache whose entries are only removed once expired: past
+    MAX_ENTRIES, the expired ones are deleted instead of random ones, so
+    revoked tokens and replica pins outlive any burst of entries
+    """
+
+    def _cull(self):
+        filelist = self._list_cache_files()
+        if len(filelist) < self._max_entries:
+            return
+        for fname in filelist:
+            try:
+                with open(fname, "rb") as f:
+                    # deletes the file when expired
+                    self._is_expired(f)
+            except FileNotFoundError:
+                # removed by another worker
+                pass
@@ -0,0 +1,147 @@
+import atexit
+import json
+import os
+import queue
+import random
+import threading
+import time
+from django.conf import settings
+from django.utils import timezone
+
+
+class CaptureWriter:
+    """
+    Appends lines to a file from a background thread, in batches: write()
+    only queues the line, and drops it when the queue is full, so requests
+    never wait on the disk
+    """
+    max_queue = 10000
+    batch_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.queue = queue.Queue(self.max_queue)
+        self.dropped = 0
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        # once per process: a thread doesn't survive the fork of a worker
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self.run, name="capture-writer", daemon=True).start()
+                atexit.register(self.flush)
+
+    def write(self, line):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            lines = [self.queue.get()]
+            while len(lines) < self.batch_size:
+                try:
+                    lines.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.path, "a", encoding="utf-8") as file:
+                    file.write("".join(lines))
+            except OSError:
+                self.dropped += len(lines)
+            for _ in lines:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        Waits until the queued lines are written
+        """
+        if self.pid == os.getpid():
+            self.queue.join()
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path):
+    writer = _writers.get(path)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.setdefault(path, CaptureWriter(path))
+    return writer
+
+
+def redact(data):
+    """
+    Replaces the values of the TRAFFIC_CAPTURE_REDACT keys, at any depth
+    """
+    if isinstance(data, dict):
+        return {
+            key: "***" if key in settings.TRAFFIC_CAPTURE_REDACT else redact(value) for key, value in data.items()
+        }
+    if isinstance(data, list):
+        return [redact(value) for value in data]
+    return data
+
+
+class TrafficCaptureMiddleware:
+    """
+    Writes a TRAFFIC_CAPTURE_RATE sample of the requests to the
+    TRAFFIC_CAPTURE_PREFIXES paths to TRAFFIC_CAPTURE_PATH, one JSON line
+    each: method, path, query, body (redacted, up to
+    TRAFFIC_CAPTURE_MAX_BODY bytes), user, route name, status and duration.
+    Replay them with the replay_traffic command. Off with a rate of 0
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rate = settings.TRAFFIC_CAPTURE_RATE
+        if not rate or random.random() >= rate or not request.path.startswith(settings.TRAFFIC_CAPTURE_PREFIXES):
+            return self.get_response(request)
+        body = self.read_body(request)
+        started = time.perf_counter()
+        response = self.get_response(request)
+        duration = (time.perf_counter() - started) * 1000
+        user = getattr(request, "user", None)
+        match = request.resolver_match
+        record = {
+            "time": timezone.now().isoformat(),
+            "method": request.method,
+            "path": request.path,
+            "query": request.META.get("QUERY_STRING", ""),
+            "content_type": request.content_type,
+            "body": body,
+            "user": user.pk if user is not None and user.is_authenticated else None,
+            "route": match.url_name if match else None,
+            "status": response.status_code,
+            "duration_ms": round(duration, 3),
+        }
+        get_writer(settings.TRAFFIC_CAPTURE_PATH).write(json.dumps(record) + "\n")
+        return response
+
+    def read_body(self, request):
+        """
+        Returns the body as text, None when empty or too large to keep
+        """
+        try:
+            length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            return None
+        if not length or length > settings.TRAFFIC_CAPTURE_MAX_BODY:
+            return None
+        # read before the view, which may consume the stream; it is kept for the view
+        body = request.body.decode("utf-8", "replace")
+        if request.content_type == "application/json":
+            try:
+                return json.dumps(redact(json.loads(body)))
+            except ValueError:
+                pass
+        return body
@@ -0,0 +1,127 @@
+import gzip
+import re
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ACCEPT_ENCODING = re.compile(r"\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([\d.]+))?\s*")
+# the suffix of the ETags of compressed representations: "<etag>-gzip"
+ENCODED_ETAG = re.compile(r'-(?:br|gzip)"')
+
+
+def available_encodings():
+    """
+    Content encodings we can produce, preferred first
+    """
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def choose_encoding(request, encodings):
+    """
+    Returns the encoding of encodings the client accepts with the highest
+    weight (ties going to the first one), or None for the identity
+    """
+    weights = {}
+    for part in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        match = ACCEPT_ENCODING.fullmatch(part)
+        if match:
+            try:
+                weights[match.group(1).lower()] = float(match.group(2) or 1)
+            except ValueError:
+                continue
+    best, best_weight = None, 0
+    for encoding in encodings:
+        weight = weights.get(encoding, weights.get("*", 0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def encoded_etag(etag, encoding):
+    """
+    Strong (or weak) ETag of the representation compressed with encoding
+    """
+    return '{}-{}"'.format(etag[:-1], encoding) if etag.endswith('"') else etag
+
+
+def compress(content, encoding, smallest=False):
+    """
+    Compresses bytes, with smallest as small as possible: slow, for content
+    compressed once
+    """
+    if encoding == "br":
+        return brotli.compress(content, quality=11 if smallest else 5)
+    return gzip.compress(content, compresslevel=9 if smallest else 6, mtime=0)
+
+
+def compress_stream(chunks, encoding):
+    if encoding == "gzip":
+        yield from compress_sequence(chunks)
+        return
+    compressor = brotli.Compressor(quality=5)
+    for chunk in chunks:
+        # flushed, so every chunk reaches the client as it is produced
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+class CompressionMiddleware:
+    """
+    Compresses the responses of the COMPRESSION_CONTENT_TYPES with brotli
+    (when installed) or gzip, as the client accepts: those of
+    COMPRESSION_MIN_BYTES or more, and every streaming one, chunk by chunk.
+    Responses that already have a Content-Encoding are left alone.
+    Compressed responses get their own ETag (see encoded_etag()), whose
+    encoding suffix is removed from the If-Match and If-None-Match headers
+    before the view compares them, and put back on a 304
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if_none_match = request.META.get("HTTP_IF_NONE_MATCH", "")
+        for header in ("HTTP_IF_MATCH", "HTTP_IF_NONE_MATCH"):
+            if header in request.META:
+                request.META[header] = ENCODED_ETAG.sub('"', request.META[header])
+        response = self.get_response(request)
+        if response.status_code == 304 and response.has_header("ETag"):
+            # the client's copy is the encoded one
+            for encoding in ("br", "gzip"):
+                if encoded_etag(response["ETag"], encoding) in if_none_match:
+                    response["ETag"] = encoded_etag(response["ETag"], encoding)
+                    break
+            return response
+        if response.has_header("Content-Encoding") or not self.compressible(response):
+            return response
+        if not response.streaming and len(response.content) < settings.COMPRESSION_MIN_BYTES:
+            return response
+        patch_vary_headers(response, ("Accept-Encoding",))
+        encoding = choose_encoding(request, available_encodings())
+        if encoding is None:
+            return response
+        if response.streaming:
+            response.streaming_content = compress_stream(response.streaming_content, encoding)
+            del response["Content-Length"]
+        else:
+            content = compress(response.content, encoding)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response["Content-Length"] = str(len(content))
+        # the compressed bytes differ: a strong validator names the encoding
+        if response.has_header("ETag"):
+            response["ETag"] = encoded_etag(response["ETag"], encoding)
+        response["Content-Encoding"] = encoding
+        return response
+
+    def compressible(self, response):
+        content_type = response.get("Content-Type", "").split(";")[0].strip().lower()
+        return content_type in settings.COMPRESSION_CONTENT_TYPES
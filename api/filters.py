@@ -0,0 +1,133 @@
+import datetime
+from django.core import checks
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import models
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import BaseFilterBackend
+
+BOOLEANS = {"true": True, "1": True, "false": False, "0": False}
+
+
+def indexed_fields(model):
+    """
+    Names of the fields leading an index of the model (partial indexes
+    excluded): filtering or ordering on them never scans the table
+    """
+    fields = {model._meta.pk.name}
+    for field in model._meta.concrete_fields:
+        if field.db_index or field.unique:
+            fields.add(field.name)
+    for index in model._meta.indexes:
+        if index.condition is None:
+            fields.add(index.fields[0].lstrip("-"))
+    for constraint in model._meta.constraints:
+        if isinstance(constraint, models.UniqueConstraint) and constraint.condition is None:
+            fields.add(constraint.fields[0])
+    for fields_together in model._meta.unique_together:
+        fields.add(fields_together[0])
+    return fields
+
+
+class IndexedFilterBackend(BaseFilterBackend):
+    """
+    Filters and orders lists with the query parameters a viewset whitelists:
+        indexed_filters: {parameter: "field" or "field__lookup"}, lookups
+            being exact (default), gt, gte, lt and lte. Date time fields take
+            a YYYY-MM-DD day (gte/lte include the whole day) or a date time
+        ordering_fields: fields accepted by ?ordering=field or -field
+    Every field must lead an index of the model (see the api.E001 check), so
+    no query parameter can trigger a full scan. Other parameters are ignored
+    """
+    ordering_param = "ordering"
+    lookups = ("exact", "gt", "gte", "lt", "lte")
+
+    def filter_queryset(self, request, queryset, view):
+        model = queryset.model
+        for param, lookup in getattr(view, "indexed_filters", {}).items():
+            if param not in request.query_params:
+                continue
+            name, _, lookup = lookup.partition("__")
+            field = model._meta.get_field(name)
+            queryset = queryset.filter(**self.get_lookup(param, field, lookup or "exact", request.query_params[param]))
+        ordering = self.get_requested_ordering(request, view)
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset
+
+    def get_lookup(self, param, field, lookup, value):
+        if isinstance(field, models.BooleanField):
+            if value.lower() not in BOOLEANS:
+                raise ValidationError({"message": "Error! {} must be true or false!".format(param)})
+            return {field.name: BOOLEANS[value.lower()]}
+        if isinstance(field, models.DateTimeField):
+            try:
+                day, moment = parse_date(value), parse_datetime(value)
+            except ValueError:
+                day = moment = None
+            if day is not None:
+                # a whole day: gte/lt start at its midnight, gt/lte at the next one
+                start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+                if lookup == "exact":
+                    return {field.name + "__gte": start, field.name + "__lt": start + datetime.timedelta(days=1)}
+                if lookup in ("gt", "lte"):
+                    start += datetime.timedelta(days=1)
+                return {"{}__{}".format(field.name, {"gt": "gte", "lte": "lt"}.get(lookup, lookup)): start}
+            if moment is None:
+                raise ValidationError({"message": "Error! {} must be a YYYY-MM-DD date or a date time!".format(param)})
+            if timezone.is_naive(moment):
+                moment = timezone.make_aware(moment)
+            return {"{}__{}".format(field.name, lookup): moment}
+        try:
+            value = field.to_python(value)
+        except DjangoValidationError:
+            raise ValidationError({"message": "Error! {} is not a valid {}!".format(param, field.name)})
+        return {"{}__{}".format(field.attname if field.is_relation else field.name, lookup): value}
+
+    def get_requested_ordering(self, request, view):
+        value = request.query_params.get(self.ordering_param)
+        if not value:
+            return None
+        name = value.lstrip("-")
+        if name not in getattr(view, "ordering_fields", ()):
+            raise ValidationError({"message": "Error! {} can't be ordered by {}!".format(view.basename, name)})
+        if name in ("id", "pk"):
+            return (value,)
+        # id breaks the ties, in the same direction
+        return (value, "-id" if value.startswith("-") else "id")
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Ordering of the cursor pagination: the requested one, or the paginator's
+        """
+        return self.get_requested_ordering(request, view) or view.paginator.ordering
+
+
+@checks.register()
+def check_indexed_filters(app_configs, **kwargs):
+    """
+    Every declared filter and ordering field must lead an index
+    """
+    from api.urls import router
+    errors = []
+    for _, viewset, _ in router.registry:
+        queryset = getattr(viewset, "queryset", None)
+        if queryset is None:
+            continue
+        filters = getattr(viewset, "indexed_filters", {})
+        for param, lookup in filters.items():
+            if lookup.partition("__")[2] not in ("",) + IndexedFilterBackend.lookups:
+                errors.append(checks.Error(
+                    "{} filter {} uses an unsupported lookup: {}".format(viewset.__name__, param, lookup),
+                    obj=viewset, id="api.E002",
+                ))
+        indexed = indexed_fields(queryset.model)
+        names = [lookup.partition("__")[0] for lookup in filters.values()] + list(getattr(viewset, "ordering_fields", ()))
+        for name in sorted(set(names) - indexed - {"pk"}):
+            errors.append(checks.Error(
+                "{} filters or orders on {}.{}, which starts no index".format(viewset.__name__, queryset.model.__name__, name),
+                hint="Add db_index=True or a Meta.indexes entry starting with {}".format(name),
+                obj=viewset, id="api.E001",
+            ))
+    return errors
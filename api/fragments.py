@@ -0,0 +1,142 @@
+import json
+import re
+import secrets
+import threading
+from collections import OrderedDict, defaultdict
+from collections.abc import Mapping
+from django.conf import settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from api.metrics import registry
+
+# a fragment is encoded as this string followed by its index, then replaced
+# by its bytes: the random part keeps stored strings from passing for one
+MARKER = "fragment:{}:".format(secrets.token_hex(16))
+PLACEHOLDER = re.compile('"{}(\\d+)"'.format(MARKER).encode())
+
+
+class Fragment(Mapping):
+    """
+    Representation of an object held as encoded JSON bytes, spliced as they
+    are into the response by api.renderers.FragmentJSONRenderer. Read as a
+    mapping (by other renderers, or tests) it decodes them
+    """
+    __slots__ = ("key", "content", "_data")
+
+    def __init__(self, key, content=None):
+        self.key = key
+        self.content = content
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json.loads(self.content)
+        return self._data
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "Fragment({!r})".format(self.content)
+
+
+class FragmentCache:
+    """
+    In-process LRU cache of encoded fragments, keyed by (variant, time zone,
+    pk, stamps): a changed object gets a new stamp, so it is never served
+    stale, and its old entries age out. The total size of the fragments is
+    kept under FRAGMENT_CACHE_MAX_BYTES
+    """
+    # bytes of a key and its entry, roughly
+    entry_overhead = 200
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    @property
+    def max_bytes(self):
+        return settings.FRAGMENT_CACHE_MAX_BYTES
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.size = 0
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                content = self.entries.get(key)
+                if content is not None:
+                    self.entries.move_to_end(key)
+                    found[key] = content
+        return found
+
+    def set_many(self, items):
+        max_bytes = self.max_bytes
+        with self.lock:
+            for key, content in items.items():
+                previous = self.entries.pop(key, None)
+                if previous is not None:
+                    self.size -= len(previous) + self.entry_overhead
+                self.entries[key] = content
+                self.size += len(content) + self.entry_overhead
+            while self.entries and self.size > max_bytes:
+                _, content = self.entries.popitem(last=False)
+                self.size -= len(content) + self.entry_overhead
+
+
+fragment_cache = FragmentCache()
+
+
+class PageFragments:
+    """
+    Fragments of a page rendered by a compiled read plan (see
+    api.serializers.compile_read_plan): get() hands out placeholders, fill()
+    sets their bytes, from the cache or with one query per nested serializer
+    """
+
+    def __init__(self, cache=fragment_cache):
+        self.cache = cache
+        self.time_zone = timezone.get_current_timezone_name()
+        # (plan, pk) -> Fragment: an object embedded by several rows is read once
+        self.fragments = {}
+
+    def get(self, plan, pk, stamps):
+        if pk is None:
+            return None
+        fragment = self.fragments.get((plan, pk))
+        if fragment is None:
+            fragment = self.fragments[plan, pk] = Fragment((plan.variant, self.time_zone, pk, stamps))
+        return fragment
+
+    def fill(self):
+        cached = self.cache.get_many([fragment.key for fragment in self.fragments.values()])
+        registry.inc("cache_requests_total", (("cache", "fragment"), ("result", "hit")), len(cached))
+        registry.inc("cache_requests_total", (("cache", "fragment"), ("result", "miss")), len(self.fragments) - len(cached))
+        missing = defaultdict(list)
+        for (plan, pk), fragment in self.fragments.items():
+            fragment.content = cached.get(fragment.key)
+            if fragment.content is None:
+                missing[plan].append(pk)
+        renderer, fresh = JSONRenderer(), {}
+        for plan, pks in missing.items():
+            rows = plan.model._default_manager.filter(pk__in=pks).values_list(*plan.lookups)
+            # stored under the stamps read with the fields, which may be newer than the page's
+            for pk, stamps, data in plan.render(rows):
+                content = renderer.render(data)
+                fresh[plan.variant, self.time_zone, pk, stamps] = content
+                self.fragments[plan, pk].content = content
+            for pk in pks:
+                # deleted since the page was read
+                if self.fragments[plan, pk].content is None:
+                    self.fragments[plan, pk].content = b"null"
+        self.cache.set_many(fresh)
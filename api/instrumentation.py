@@ -0,0 +1,117 @@
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger("api.queries")
+
+# "IN (%s, %s, %s)" lists of any length have the same shape
+PLACEHOLDER_LIST = re.compile(r"\(\s*%s(?:\s*,\s*%s)*\s*\)")
+
+
+def query_shape(sql):
+    return PLACEHOLDER_LIST.sub("(%s...)", sql)
+
+
+@contextmanager
+def wrap_queries(wrapper):
+    """
+    Installs an execute wrapper on the connections to every database
+    """
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(wrapper))
+        yield wrapper
+
+
+class QueryCounter:
+    """
+    Execute wrapper counting the queries and their time
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.record(sql)
+
+    def record(self, sql):
+        pass
+
+
+class QueryStats(QueryCounter):
+    """
+    QueryCounter also counting how many times each query shape ran
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.shapes = Counter()
+
+    def record(self, sql):
+        self.shapes[query_shape(sql)] += 1
+
+    def repeated(self):
+        """
+        Returns the (shape, count) of the queries run QUERY_TIMING_REPEATS
+        times or more, an N+1 pattern, most run first
+        """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= settings.QUERY_TIMING_REPEATS]
+
+
+class QueryTimingMiddleware:
+    """
+    Counts and times the SQL queries of a QUERY_TIMING_RATE sample of the
+    requests, on every database, flags the shapes repeated QUERY_TIMING_REPEATS
+    times or more (N+1) and reports them in a Server-Timing header and in the
+    fields of an "api.queries" log record, a warning when queries repeat.
+    Queries run while a streaming response is sent are not counted
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rate = settings.QUERY_TIMING_RATE
+        if not rate or random.random() >= rate:
+            return self.get_response(request)
+        started = time.perf_counter()
+        with wrap_queries(QueryStats()) as stats:
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+        repeated = stats.repeated()
+        metrics = [
+            'db;dur={:.2f};desc="{} queries"'.format(stats.duration * 1000, stats.count),
+            "app;dur={:.2f}".format(duration * 1000),
+        ]
+        if repeated:
+            metrics.append('n-plus-1;desc="{} shapes, up to {}x"'.format(len(repeated), repeated[0][1]))
+        response["Server-Timing"] = ", ".join(filter(None, [response.get("Server-Timing")] + metrics))
+        match = request.resolver_match
+        fields = {
+            "route": match.view_name if match else None,
+            "method": request.method,
+            "status": response.status_code,
+            "queries": stats.count,
+            "db_ms": round(stats.duration * 1000, 2),
+            "duration_ms": round(duration * 1000, 2),
+            "repeated_queries": [{"sql": shape, "count": count} for shape, count in repeated],
+        }
+        logger.log(
+            logging.WARNING if repeated else logging.DEBUG,
+            "%s %s: %d queries in %.2f ms%s", request.method, request.path, stats.count, stats.duration * 1000,
+            ", repeated: {}".format(", ".join("{}x".format(count) for _, count in repeated)) if repeated else "",
+            extra=fields,
+        )
+        return response
@@ -0,0 +1,162 @@
+import csv
+import json
+import os
+import sys
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+
+class ImportCommand(BaseCommand):
+    """
+    Base of the bulk import commands: streams CSV or JSONL rows, validates them
+    with the model's serializer and writes them with bulk_create/bulk_update,
+    one transaction per batch. Rows can be upserted by "external_id", and the
+    rejected ones are written to a side file, with the ones superseded by a
+    later row of the same batch with the same key (counted as duplicate)
+    """
+    serializer_class = None
+    key = "external_id"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or JSONL file, - for stdin")
+        parser.add_argument("--format", choices=["csv", "jsonl"], help="Input format (default: from the file extension)")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--upsert", action="store_true", help="Update the rows whose external_id already exists")
+        parser.add_argument("--rejects", help="File receiving the rejected rows (default: <path>.rejects.jsonl)")
+
+    def handle(self, *args, **options):
+        path, batch_size = options["path"], options["batch_size"]
+        input_format = options["format"] or ("csv" if path.endswith(".csv") else "jsonl" if path != "-" else None)
+        if input_format is None:
+            raise CommandError("Use --format to read from stdin")
+        rejects_path = options["rejects"] or ("rejects.jsonl" if path == "-" else path + ".rejects.jsonl")
+        self.upsert = options["upsert"]
+        self.serializer = self.get_serializer()
+        self.counts = {"created": 0, "updated": 0, "rejected": 0, "duplicate": 0}
+        started = time.monotonic()
+        source = sys.stdin if path == "-" else open(path, newline="", encoding="utf-8")
+        with source, open(rejects_path, "w", encoding="utf-8") as self.rejects:
+            batch = []
+            for line, row in self.read_rows(source, input_format):
+                batch.append((line, row))
+                if len(batch) == batch_size:
+                    self.import_batch(batch)
+                    batch = []
+                    if options["verbosity"] > 1:
+                        self.report(started)
+            if batch:
+                self.import_batch(batch)
+        self.after_import()
+        self.report(started)
+        if not self.counts["rejected"] and not self.counts["duplicate"]:
+            os.remove(rejects_path)
+
+    def get_serializer(self):
+        """
+        The serializer validating each row. Its unique check on the key is
+        dropped, that one is done per batch
+        """
+        class ImportSerializer(self.serializer_class):
+            class Meta(self.serializer_class.Meta):
+                extra_kwargs = {self.key: {"validators": []}}
+        return ImportSerializer()
+
+    def read_rows(self, source, input_format):
+        """
+        Yields (line number, row) pairs, invalid JSON lines are rejected
+        """
+        if input_format == "csv":
+            reader = csv.DictReader(source)
+            for row in reader:
+                yield reader.line_num, row
+            return
+        for line, text in enumerate(source, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                self.reject(line, text.rstrip("\n"), {"non_field_errors": [str(e)]})
+                continue
+            yield line, row
+
+    def import_batch(self, batch):
+        model = self.serializer_class.Meta.model
+        rows = {}
+        for line, row in batch:
+            try:
+                data = self.serializer.run_validation(row)
+            except ValidationError as e:
+                self.reject(line, row, e.detail)
+                continue
+            data[self.key] = data.get(self.key) or None
+            # rows without key are always created, the last row wins for a key
+            key = data[self.key] or ("line", line)
+            if key in rows:
+                self.skip_duplicate(*rows[key][:2], line)
+            rows[key] = (line, row, data)
+        keys = [data[self.key] for _, _, data in rows.values() if data[self.key]]
+        existing = model.objects.in_bulk(keys, field_name=self.key) if keys else {}
+        created, updated, fields = [], [], set()
+        now = timezone.now()
+        for line, row, data in rows.values():
+            instance = existing.get(data[self.key])
+            if instance is None:
+                created.append(model(**data))
+            elif self.upsert:
+                for attr, value in data.items():
+                    setattr(instance, attr, value)
+                instance.updated_at = now
+                fields.update(data)
+                updated.append(instance)
+            else:
+                self.reject(line, row, {self.key: ["Already exists, use --upsert to update it."]})
+        with transaction.atomic():
+            model.objects.bulk_create(created)
+            if updated:
+                self.bulk_update(model, updated, sorted(fields | {"updated_at"}))
+        self.counts["created"] += len(created)
+        self.counts["updated"] += len(updated)
+
+    def bulk_update(self, model, objs, fields):
+        """
+        Updates objs with one parameterized UPDATE run through executemany.
+        QuerySet.bulk_update builds a CASE per field and row, which gets very
+        slow on big batches
+        """
+        fields = [model._meta.get_field(name) for name in fields]
+        quote = connection.ops.quote_name
+        sql = "UPDATE {} SET {} WHERE {} = %s".format(
+            quote(model._meta.db_table),
+            ", ".join("{} = %s".format(quote(field.column)) for field in fields),
+            quote(model._meta.pk.column),
+        )
+        params = [
+            [field.get_db_prep_save(getattr(obj, field.attname), connection) for field in fields] + [obj.pk]
+            for obj in objs
+        ]
+        with connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+
+    def reject(self, line, row, errors):
+        self.counts["rejected"] += 1
+        self.rejects.write(json.dumps({"line": line, "row": row, "errors": errors}) + "\n")
+
+    def skip_duplicate(self, line, row, winner):
+        self.counts["duplicate"] += 1
+        self.rejects.write(json.dumps({
+            "line": line, "row": row, "errors": {self.key: ["Repeated in the batch, line {} was imported.".format(winner)]}
+        }) + "\n")
+
+    def after_import(self):
+        pass
+
+    def report(self, started):
+        elapsed = time.monotonic() - started
+        total = sum(self.counts.values())
+        self.stdout.write("{} rows: {created} created, {updated} updated, {rejected} rejected, {duplicate} duplicate in {:.1f}s ({:.0f} rows/s)".format(
+            total, elapsed, total / elapsed if elapsed else 0, **self.counts
+        ))
@@ -0,0 +1,7 @@
+from api.serializers import CustomerSerializer
+from ._importer import ImportCommand
+
+
+class Command(ImportCommand):
+    help = "Imports customers from a CSV or JSONL file in batches, optionally upserting by external_id"
+    serializer_class = CustomerSerializer
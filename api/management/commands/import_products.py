@@ -0,0 +1,12 @@
+from api.cache import catalog_cache
+from api.serializers import ProductSerializer
+from ._importer import ImportCommand
+
+
+class Command(ImportCommand):
+    help = "Imports products from a CSV or JSONL file in batches, optionally upserting by external_id"
+    serializer_class = ProductSerializer
+
+    def after_import(self):
+        # bulk writes don't send the signals invalidating the catalog
+        catalog_cache.bump()
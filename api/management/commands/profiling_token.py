@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api.profiling import issue_profiling_token
+
+
+class Command(BaseCommand):
+    help = (
+        "Prints a signed value for the X-Profile header, which has api.profiling.ProfilingMiddleware "
+        "profile the request, valid for PROFILING_TOKEN_MAX_AGE seconds"
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(issue_profiling_token())
+        self.stderr.write("Valid for {} seconds".format(settings.PROFILING_TOKEN_MAX_AGE))
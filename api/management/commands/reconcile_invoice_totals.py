@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from api.models import Invoice, InvoiceItem
+
+TOTALS = ("total_value", "total_quantity", "total_discount")
+
+
+class Command(BaseCommand):
+    help = "Recomputes invoice totals from their items, in id ordered chunks, and fixes any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="Invoices checked per chunk")
+        parser.add_argument("--dry-run", action="store_true", help="Only report the invoices that drifted")
+
+    def handle(self, *args, **options):
+        chunk_size, dry_run = options["chunk_size"], options["dry_run"]
+        last_id, checked, fixed = 0, 0, 0
+        while True:
+            with transaction.atomic():
+                invoices = list(
+                    Invoice.objects.select_for_update().filter(id__gt=last_id).order_by("id")
+                    .only("id", "updated_at", *TOTALS)[:chunk_size]
+                )
+                if not invoices:
+                    break
+                first_id, last_id = invoices[0].id, invoices[-1].id
+                totals = {
+                    row["invoice_id"]: row
+                    for row in InvoiceItem.objects.filter(invoice_id__gte=first_id, invoice_id__lte=last_id).totals_by_invoice()
+                }
+                drifted, now = [], timezone.now()
+                for invoice in invoices:
+                    expected = totals.get(invoice.id, {"total_value": 0.0, "total_quantity": 0, "total_discount": 0.0})
+                    if any(abs(getattr(invoice, name) - expected[name]) > 1e-6 for name in TOTALS):
+                        for name in TOTALS:
+                            setattr(invoice, name, expected[name])
+                        invoice.updated_at = now
+                        drifted.append(invoice)
+                if drifted and not dry_run:
+                    Invoice.objects.bulk_update(drifted, TOTALS + ("updated_at",))
+            checked += len(invoices)
+            fixed += len(drifted)
+            if options["verbosity"] > 1:
+                self.stdout.write("Checked invoices up to id {}".format(last_id))
+        self.stdout.write("Checked {} invoices, {} {}".format(checked, "found" if dry_run else "fixed", fixed))
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+from django.db.models import F
+from django.db.models.functions import TruncDate, TruncMonth
+from api.models import CustomerMonthlySales, InvoiceItem, ProductDailySales, RollupState
+
+STATE = "sales"
+
+
+class Command(BaseCommand):
+    help = "Adds the invoice's items created since the last run to the sales rollups, in id ordered chunks"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Invoice's items added per chunk")
+        parser.add_argument("--rebuild", action="store_true", help="Empty the rollups and add all the items again")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        if options["rebuild"]:
+            # a single transaction: readers see the previous rollups until the rebuild is done
+            with transaction.atomic():
+                ProductDailySales.objects.all().delete()
+                CustomerMonthlySales.objects.all().delete()
+                RollupState.objects.update_or_create(name=STATE, defaults={"high_water_mark": 0})
+                added = self.refresh(chunk_size, options["verbosity"])
+        else:
+            added = self.refresh(chunk_size, options["verbosity"])
+        self.stdout.write("Added {} invoice's items to the sales rollups".format(added))
+
+    def refresh(self, chunk_size, verbosity):
+        added = 0
+        while True:
+            with transaction.atomic():
+                state, _ = RollupState.objects.select_for_update().get_or_create(name=STATE)
+                ids = list(
+                    InvoiceItem.objects.filter(id__gt=state.high_water_mark).order_by("id")
+                    .values_list("id", flat=True)[:chunk_size]
+                )
+                if not ids:
+                    break
+                items = InvoiceItem.objects.filter(id__gt=state.high_water_mark, id__lte=ids[-1])
+                ProductDailySales.objects.add_sales(items.sales("product_id", day=TruncDate("invoice__purchase_date")))
+                CustomerMonthlySales.objects.add_sales(items.sales(
+                    customer_id=F("invoice__customer_id"),
+                    month=TruncMonth("invoice__purchase_date", output_field=models.DateField()),
+                ))
+                state.high_water_mark = ids[-1]
+                state.save(update_fields=["high_water_mark"])
+            added += len(ids)
+            if verbosity > 1:
+                self.stdout.write("Added invoice's items up to id {}".format(ids[-1]))
+        return added
@@ -0,0 +1,147 @@
+import http.client
+import json
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import Resolver404, resolve
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays the requests captured by api.capture.TrafficCaptureMiddleware against a live server, or "
+        "in process with the test client, and reports latency percentiles, throughput and errors per route"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="JSON lines file written by the capture middleware")
+        parser.add_argument("--url", help="Base url of a live server, e.g. http://127.0.0.1:8000 (default: in process)")
+        parser.add_argument("--token", help='Authorization header of the requests, e.g. "Token 1b7c..."')
+        parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight")
+        parser.add_argument("--limit", type=int, help="Replay only the first LIMIT requests")
+        parser.add_argument("--writes", action="store_true", help="Also replay POST, PUT, PATCH and DELETE requests")
+
+    def handle(self, *args, **options):
+        records = self.load(options["file"], options["writes"], options["limit"])
+        if not records:
+            raise CommandError("No request to replay in {}".format(options["file"]))
+        send = self.live_sender(options["url"], options["token"]) if options["url"] else self.client_sender(options["token"])
+        results, started = [], time.perf_counter()
+        pending = iter(records)
+        lock = threading.Lock()
+
+        def worker():
+            request = send()
+            while True:
+                with lock:
+                    record = next(pending, None)
+                if record is None:
+                    return
+                began = time.perf_counter()
+                try:
+                    status = request(record)
+                except (OSError, http.client.HTTPException):
+                    status = None
+                results.append((self.route(record), status, (time.perf_counter() - began) * 1000))
+
+        if options["concurrency"] == 1:
+            # in this thread, on its database connection
+            worker()
+        else:
+            threads = [threading.Thread(target=worker) for _ in range(options["concurrency"])]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.report(results, time.perf_counter() - started)
+
+    def load(self, path, writes, limit):
+        records = []
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                if limit is not None and len(records) >= limit:
+                    break
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if writes or record["method"] in SAFE_METHODS:
+                    records.append(record)
+        return records
+
+    def route(self, record):
+        try:
+            return resolve(record["path"]).url_name or record["path"]
+        except Resolver404:
+            return "unresolved"
+
+    def client_sender(self, token):
+        headers = {"HTTP_AUTHORIZATION": token} if token else {}
+
+        def sender():
+            # server errors come back as 500 responses, as from a live server
+            client = Client(raise_request_exception=False)
+
+            def request(record):
+                path = record["path"] + ("?" + record["query"] if record["query"] else "")
+                response = client.generic(
+                    record["method"], path, (record["body"] or "").encode(),
+                    record["content_type"] or "application/octet-stream", **headers
+                )
+                # streaming exports run their query while being read
+                if response.streaming:
+                    for _ in response.streaming_content:
+                        pass
+                return response.status_code
+            return request
+        return sender
+
+    def live_sender(self, url, token):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise CommandError("--url must be an http or https url")
+        connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+
+        def sender():
+            # one keep-alive connection per worker
+            state = {"connection": connection_class(parts.netloc, timeout=30)}
+
+            def request(record):
+                path = parts.path.rstrip("/") + record["path"] + ("?" + record["query"] if record["query"] else "")
+                headers = {"Authorization": token} if token else {}
+                if record["body"] is not None:
+                    headers["Content-Type"] = record["content_type"]
+                try:
+                    state["connection"].request(record["method"], path, (record["body"] or "").encode() or None, headers)
+                    response = state["connection"].getresponse()
+                    response.read()
+                except (OSError, http.client.HTTPException):
+                    state["connection"].close()
+                    state["connection"] = connection_class(parts.netloc, timeout=30)
+                    raise
+                return response.status
+            return request
+        return sender
+
+    def report(self, results, elapsed):
+        routes = {}
+        for route, status, latency in results:
+            routes.setdefault(route, []).append((status, latency))
+        self.stdout.write("{:<28} {:>8} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+            "route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"
+        ))
+        for route, rows in sorted(routes.items()) + [("all", [(s, l) for _, s, l in results])]:
+            latencies = sorted(latency for _, latency in rows)
+            errors = sum(1 for status, _ in rows if status is None or status >= 400)
+            self.stdout.write("{:<28} {:>8} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7.1f}%".format(
+                route, len(rows), len(rows) / elapsed, *self.percentiles(latencies), errors * 100 / len(rows)
+            ))
+
+    def percentiles(self, latencies):
+        if len(latencies) < 2:
+            return latencies * 3
+        quantiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        return quantiles[49], quantiles[94], quantiles[98]
@@ -0,0 +1,39 @@
+import sqlite3
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+
+class Command(BaseCommand):
+    help = "Copies the SQLite primary database onto the SQLite replicas (local stand-in for replication)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--interval", type=float, default=0, help="Keep copying every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        primary = settings.DATABASES[DEFAULT_DB_ALIAS]
+        replicas = [settings.DATABASES[alias] for alias in settings.DATABASE_REPLICAS]
+        if not replicas:
+            raise CommandError("No replica configured, set SQLITE_REPLICA=1")
+        for database in [primary] + replicas:
+            if database["ENGINE"] not in ("django.db.backends.sqlite3", "ecommerce.sqlite3"):
+                raise CommandError("Only SQLite databases can be copied")
+        while True:
+            started = time.monotonic()
+            source = sqlite3.connect(primary["NAME"])
+            try:
+                for replica in replicas:
+                    target = sqlite3.connect(replica["NAME"])
+                    try:
+                        # online backup: consistent snapshot, readers of the replica are never
+                        # shown a half written copy
+                        source.backup(target)
+                    finally:
+                        target.close()
+            finally:
+                source.close()
+            self.stdout.write("Copied to {} replica(s) in {:.3f}s".format(len(replicas), time.monotonic() - started))
+            if not options["interval"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,260 @@
+import bisect
+import fcntl
+import glob
+import hmac
+import ipaddress
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from django.conf import settings
+from api.instrumentation import QueryCounter, wrap_queries
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LE = tuple(str(bound) for bound in BUCKETS) + ("+Inf",)
+
+# name: (type, help); histograms are stored as <name>_bucket (not cumulative), _sum and _count
+METRICS = {
+    "http_requests_total": ("counter", "Requests by route name, method and status"),
+    "http_request_duration_seconds": ("histogram", "Request latency by route name and status"),
+    "http_requests_in_flight": ("gauge", "Requests being served"),
+    "db_queries_total": ("counter", "SQL queries by route name"),
+    "db_query_duration_seconds_total": ("counter", "Time spent in SQL queries by route name"),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result (hit or miss)"),
+}
+GAUGES = {name for name, (kind, _) in METRICS.items() if kind == "gauge"}
+# any other method is counted as "other", so clients can't add series
+METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "TRACE", "CONNECT"}
+ARCHIVE = "archive.json"
+
+
+class Registry:
+    """
+    Metrics of this process. Every thread counts in its own shard, a dict no
+    other thread writes, so counting takes no lock; a snapshot sums the
+    shards. Series are keyed by (name, ((label, value), ...)).
+    A background thread writes the snapshot to METRICS_DIR/<pid>.json every
+    METRICS_FLUSH_SECONDS, for the worker answering /metrics to merge them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.shards = []
+        self.local = threading.local()
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None or self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # a new worker: forget the parent's counts, start our writer
+                    self.pid = os.getpid()
+                    self.shards = []
+                    threading.Thread(target=self.run, name="metrics-writer", daemon=True).start()
+                shard = self.local.shard = {}
+                self.shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self.shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self.shard()
+        bucket = (name + "_bucket", labels + (("le", LE[bisect.bisect_left(BUCKETS, value)]),))
+        shard[bucket] = shard.get(bucket, 0) + 1
+        for key, amount in (((name + "_sum", labels), value), ((name + "_count", labels), 1)):
+            shard[key] = shard.get(key, 0) + amount
+
+    def snapshot(self):
+        totals = Counter()
+        if self.pid == os.getpid():
+            for shard in list(self.shards):
+                # copying a dict holds the GIL: the owner thread can't change it meanwhile
+                totals.update(shard.copy())
+        return totals
+
+    def run(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_SECONDS)
+            self.flush()
+
+    def flush(self):
+        if self.pid == os.getpid() and settings.METRICS_DIR:
+            write_series(os.path.join(settings.METRICS_DIR, "{}.json".format(self.pid)), self.snapshot())
+
+
+registry = Registry()
+
+
+def write_series(path, series):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = "{}.{}.tmp".format(path, threading.get_ident())
+    with open(temporary, "w") as file:
+        json.dump([[name, labels, value] for (name, labels), value in series.items()], file)
+    # readers see the previous file or this one, never a partial write
+    os.replace(temporary, path)
+
+
+def read_series(path):
+    try:
+        with open(path) as file:
+            rows = json.load(file)
+    except (OSError, ValueError):
+        return Counter()
+    return Counter({(name, tuple(tuple(label) for label in labels)): value for name, labels, value in rows})
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def retire(pid):
+    """
+    Folds the counters of a worker that exited into the archive, dropping its
+    gauges
+    """
+    path = os.path.join(settings.METRICS_DIR, "{}.json".format(pid))
+    if not settings.METRICS_DIR or not os.path.exists(path):
+        return
+    with open(os.path.join(settings.METRICS_DIR, "archive.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # another process may have folded it while we waited
+        if not os.path.exists(path):
+            return
+        archive = read_series(os.path.join(settings.METRICS_DIR, ARCHIVE))
+        archive.update({key: value for key, value in read_series(path).items() if key[0] not in GAUGES})
+        write_series(os.path.join(settings.METRICS_DIR, ARCHIVE), archive)
+        os.remove(path)
+
+
+def reset():
+    """
+    Removes the stored metrics, so the counters start from zero (called when
+    gunicorn starts)
+    """
+    if not settings.METRICS_DIR:
+        return
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, "*.json")):
+        os.remove(path)
+
+
+def collect():
+    """
+    Sums the live snapshot of this process, the last snapshots of the other
+    live workers and the archive, into which the exited ones are folded
+    """
+    totals = registry.snapshot()
+    if not settings.METRICS_DIR:
+        return totals
+    workers = glob.glob(os.path.join(settings.METRICS_DIR, "[0-9]*.json"))
+    for pid in [int(os.path.basename(path)[:-len(".json")]) for path in workers]:
+        if pid != os.getpid():
+            if is_alive(pid):
+                totals.update(read_series(os.path.join(settings.METRICS_DIR, "{}.json".format(pid))))
+            else:
+                retire(pid)
+    totals.update(read_series(os.path.join(settings.METRICS_DIR, ARCHIVE)))
+    return totals
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels) + "}"
+
+
+def render(series):
+    """
+    Prometheus text exposition (version 0.0.4) of the series, with the
+    cumulative histogram buckets and the cache hit ratios
+    """
+    by_name = defaultdict(dict)
+    for (name, labels), value in series.items():
+        by_name[name][labels] = value
+    lines = []
+    for name, (kind, help) in METRICS.items():
+        lines += ["# HELP {} {}".format(name, help), "# TYPE {} {}".format(name, kind)]
+        if kind != "histogram":
+            for labels, value in sorted(by_name[name].items()):
+                lines.append("{}{} {}".format(name, format_labels(labels), value))
+            continue
+        for labels, count in sorted(by_name[name + "_count"].items()):
+            buckets = by_name[name + "_bucket"]
+            cumulative = 0
+            for le in LE:
+                cumulative += buckets.get(labels + (("le", le),), 0)
+                lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", le),)), cumulative))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels), by_name[name + "_sum"][labels]))
+            lines.append("{}_count{} {}".format(name, format_labels(labels), count))
+    lookups = defaultdict(dict)
+    for labels, value in by_name["cache_requests_total"].items():
+        labels = dict(labels)
+        lookups[labels["cache"]][labels["result"]] = value
+    lines += ["# HELP cache_hit_ratio Hits over lookups by cache", "# TYPE cache_hit_ratio gauge"]
+    for cache, results in sorted(lookups.items()):
+        total = results.get("hit", 0) + results.get("miss", 0)
+        lines.append('cache_hit_ratio{{cache="{}"}} {}'.format(cache, results.get("hit", 0) / total if total else 0))
+    return "\n".join(lines) + "\n"
+
+
+def is_scraper(request):
+    """
+    Whether request comes from an internal caller allowed to read the
+    metrics: from METRICS_ALLOWED_NETWORKS, not forwarded by a proxy, with
+    the METRICS_TOKEN bearer token when one is set
+    """
+    if "HTTP_X_FORWARDED_FOR" in request.META:
+        return False
+    try:
+        address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+    except ValueError:
+        return False
+    if not any(address in ipaddress.ip_network(network) for network in settings.METRICS_ALLOWED_NETWORKS):
+        return False
+    if settings.METRICS_TOKEN:
+        expected = "Bearer {}".format(settings.METRICS_TOKEN)
+        return hmac.compare_digest(request.META.get("HTTP_AUTHORIZATION", "").encode(), expected.encode())
+    return True
+
+
+class MetricsMiddleware:
+    """
+    Counts the requests, their latency, their SQL queries and the requests in
+    flight, by route name (the url name: customer-list, invoiceitem-detail,
+    ...). Off when METRICS_DIR is empty
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.METRICS_DIR:
+            return self.get_response(request)
+        registry.inc("http_requests_in_flight")
+        started = time.perf_counter()
+        try:
+            with wrap_queries(QueryCounter()) as queries:
+                response = self.get_response(request)
+        finally:
+            registry.inc("http_requests_in_flight", value=-1)
+        duration = time.perf_counter() - started
+        match = request.resolver_match
+        route = (("route", match.url_name if match and match.url_name else "unmatched"),)
+        status = (("status", str(response.status_code)),)
+        method = (("method", request.method if request.method in METHODS else "other"),)
+        registry.inc("http_requests_total", route + method + status)
+        registry.observe("http_request_duration_seconds", route + status, duration)
+        registry.inc("db_queries_total", route, queries.count)
+        registry.inc("db_query_duration_seconds_total", route, queries.duration)
+        return response
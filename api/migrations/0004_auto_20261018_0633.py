@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 06:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_auto_20261018_0630'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invoice',
+            name='total_quantity',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.0.8 on 2026-10-18 06:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_auto_20261018_0633'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['customer', 'purchase_date'], name='invoice_customer_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='shoppingcart',
+            index=models.Index(condition=models.Q(is_closed=False), fields=['customer'], name='cart_open_customer_idx'),
+        ),
+    ]
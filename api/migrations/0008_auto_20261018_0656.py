@@ -0,0 +1,59 @@
+# Generated by Django 3.0.8 on 2026-10-18 06:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_auto_20261018_0645'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupState',
+            fields=[
+                ('name', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('high_water_mark', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProductDailySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=0)),
+                ('gross_value', models.FloatField(default=0.0)),
+                ('discount', models.FloatField(default=0.0)),
+                ('day', models.DateField()),
+                ('product', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='daily_sales', to='api.Product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CustomerMonthlySales',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=0)),
+                ('gross_value', models.FloatField(default=0.0)),
+                ('discount', models.FloatField(default=0.0)),
+                ('month', models.DateField()),
+                ('customer', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='monthly_sales', to='api.Customer')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='productdailysales',
+            index=models.Index(fields=['day', 'id'], name='product_sales_day_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='productdailysales',
+            constraint=models.UniqueConstraint(fields=('product', 'day'), name='product_day_sales_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='customermonthlysales',
+            index=models.Index(fields=['month', 'id'], name='customer_sales_month_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='customermonthlysales',
+            constraint=models.UniqueConstraint(fields=('customer', 'month'), name='customer_month_sales_uniq'),
+        ),
+    ]
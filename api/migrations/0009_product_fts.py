@@ -0,0 +1,24 @@
+# Generated by Django 3.0.8 on 2026-10-18 07:05
+
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from api.search import install_product_fts
+    install_product_fts(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    from api.search import uninstall_product_fts
+    uninstall_product_fts(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_auto_20261018_0656'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -1,11 +1,22 @@
 from django.db import models
+from django.db.models import F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
 
 
 class Customer(models.Model):
     name = models.CharField(max_length=255)
-    email = models.CharField(max_length=255)
+    email = models.CharField(max_length=255, db_index=True)
     phone = models.CharField(max_length=255)
+    # key of the customer in the source system, used to upsert imports
+    external_id = models.CharField(max_length=255, null=True, blank=True, unique=True)
     creation_date = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["creation_date", "id"], name="customer_created_idx"),
+        ]
 
 
 class Product(models.Model):
@@ -13,15 +24,102 @@ class Product(models.Model):
     description = models.TextField()
     image_link = models.TextField()
     price = models.FloatField()
+    # key of the product in the supplier catalog (SKU), used to upsert imports
+    external_id = models.CharField(max_length=255, null=True, blank=True, unique=True)
     creation_date = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["creation_date", "id"], name="product_created_idx"),
+        ]
+
+
+class InvoiceQuerySet(models.QuerySet):
+    def add_totals(self, deltas):
+        """
+        Adds {invoice_id: (value, quantity, discount)} deltas to the invoice
+        totals with F() expressions, one UPDATE per invoice
+        """
+        now = timezone.now()
+        for invoice_id, (value, quantity, discount) in deltas.items():
+            if value or quantity or discount:
+                self.filter(id=invoice_id).update(
+                    total_value=F("total_value") + value,
+                    total_quantity=F("total_quantity") + quantity,
+                    total_discount=F("total_discount") + discount,
+                    updated_at=now,
+                )
+
+    def add_item_totals(self, added=(), removed=()):
+        """
+        Updates the totals of the invoices of the added and removed items
+        """
+        deltas = {}
+        for items, sign in ((added, 1), (removed, -1)):
+            for item in items:
+                value, quantity, discount = deltas.get(item.invoice_id, (0.0, 0, 0.0))
+                item_value, item_quantity, item_discount = item.totals()
+                deltas[item.invoice_id] = (
+                    value + sign * item_value, quantity + sign * item_quantity, discount + sign * item_discount
+                )
+        self.add_totals(deltas)
 
 
 class Invoice(models.Model):
     customer = models.ForeignKey("Customer", related_name="customers", on_delete=models.DO_NOTHING)
     total_value = models.FloatField(default=0.0)
-    total_quantity = models.IntegerField(default=1)
+    total_quantity = models.IntegerField(default=0)
     total_discount = models.FloatField(default=0.0)
     purchase_date = models.DateTimeField(auto_now_add=True)
+    # also set by the updates of the totals
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = InvoiceQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["purchase_date", "id"], name="invoice_purchased_idx"),
+            models.Index(fields=["customer", "purchase_date"], name="invoice_customer_date_idx"),
+        ]
+
+
+class InvoiceItemQuerySet(models.QuerySet):
+    @staticmethod
+    def _totals():
+        line_value = F("quantity") * Coalesce("quote_price", Value(0.0)) - F("discount_value")
+        return {
+            "total_value": Coalesce(Sum(line_value, output_field=models.FloatField()), Value(0.0)),
+            "total_quantity": Coalesce(Sum("quantity"), Value(0)),
+            "total_discount": Coalesce(Sum("discount_value"), Value(0.0)),
+        }
+
+    def totals(self):
+        """
+        Aggregates the items into the invoice totals: net value (quantity times
+        quote price, less discount), quantity and discount
+        """
+        return self.aggregate(**self._totals())
+
+    def totals_by_invoice(self):
+        """
+        Same as totals(), grouped by invoice_id
+        """
+        return self.order_by().values("invoice_id").annotate(**self._totals())
+
+    def sales(self, *fields, **expressions):
+        """
+        Aggregates the items' quantity, gross value (quantity times quote price)
+        and discount, grouped by the given fields and expressions
+        """
+        return self.order_by().values(*fields, **expressions).annotate(
+            gross_value=Coalesce(
+                Sum(F("quantity") * Coalesce("quote_price", Value(0.0)), output_field=models.FloatField()), Value(0.0)
+            ),
+            discount=Coalesce(Sum("discount_value"), Value(0.0)),
+            # last: once annotated, "quantity" shadows the field
+            quantity=Coalesce(Sum("quantity"), Value(0)),
+        )
 
 
 class InvoiceItem(models.Model):
@@ -32,6 +130,19 @@ class InvoiceItem(models.Model):
     discount_value = models.FloatField()
     creation_date = models.DateTimeField(auto_now_add=True)
 
+    objects = InvoiceItemQuerySet.as_manager()
+
+    def totals(self):
+        """
+        Returns this item's share of its invoice totals: (value, quantity, discount)
+        """
+        return (self.quantity * (self.quote_price or 0.0) - self.discount_value, self.quantity, self.discount_value)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["creation_date", "id"], name="invoiceitem_created_idx"),
+        ]
+
 
 class ShoppingCart(models.Model):
     customer = models.ForeignKey("Customer", related_name="cart_customers", on_delete=models.DO_NOTHING)
@@ -41,3 +152,107 @@ class ShoppingCart(models.Model):
     creation_date = models.DateTimeField(auto_now_add=True)
     closed_date = models.DateTimeField(auto_now=True)
     is_closed = models.BooleanField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["creation_date", "id"], name="cart_created_idx"),
+            models.Index(fields=["is_closed", "creation_date", "id"], name="cart_closed_created_idx"),
+            # open carts of a customer (partial on backends supporting it)
+            models.Index(fields=["customer"], condition=Q(is_closed=False), name="cart_open_customer_idx"),
+        ]
+
+
+SALES = ("quantity", "gross_value", "discount")
+
+
+class SalesRollupQuerySet(models.QuerySet):
+    def add_sales(self, rows):
+        """
+        Adds InvoiceItem.objects.sales() rows to the rollup: existing
+        (key, period) rows are incremented, missing ones are created
+        """
+        key, period = self.model.key, self.model.period
+        sales = {(row[key], row[period]): row for row in rows}
+        if not sales:
+            return
+        existing = self.filter(**{
+            key + "__in": {row_key for row_key, _ in sales},
+            period + "__in": {row_period for _, row_period in sales},
+        })
+        updated = []
+        for rollup in existing:
+            row = sales.pop((getattr(rollup, key), getattr(rollup, period)), None)
+            if row is not None:
+                for name in SALES:
+                    setattr(rollup, name, getattr(rollup, name) + row[name])
+                updated.append(rollup)
+        self.bulk_update(updated, SALES, batch_size=500)
+        self.bulk_create([self.model(**row) for row in sales.values()], batch_size=500)
+
+    def totals(self):
+        """
+        Sums the rollup rows: quantity, gross value, discount and net value
+        """
+        totals = self.aggregate(
+            gross_value=Coalesce(Sum("gross_value"), Value(0.0)),
+            discount=Coalesce(Sum("discount"), Value(0.0)),
+            quantity=Coalesce(Sum("quantity"), Value(0)),
+        )
+        totals["net_value"] = totals["gross_value"] - totals["discount"]
+        return totals
+
+
+class SalesRollup(models.Model):
+    """
+    Invoice items pre-aggregated by a key (product or customer) and a period
+    """
+    quantity = models.IntegerField(default=0)
+    gross_value = models.FloatField(default=0.0)
+    discount = models.FloatField(default=0.0)
+
+    objects = SalesRollupQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+
+class ProductDailySales(SalesRollup):
+    # the unique (product, day) constraint covers the lookups by product
+    product = models.ForeignKey("Product", related_name="daily_sales", on_delete=models.DO_NOTHING, db_index=False)
+    day = models.DateField()
+
+    key, period = "product_id", "day"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["product", "day"], name="product_day_sales_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["day", "id"], name="product_sales_day_idx"),
+        ]
+
+
+class CustomerMonthlySales(SalesRollup):
+    customer = models.ForeignKey("Customer", related_name="monthly_sales", on_delete=models.DO_NOTHING, db_index=False)
+    # first day of the month
+    month = models.DateField()
+
+    key, period = "customer_id", "month"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["customer", "month"], name="customer_month_sales_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["month", "id"], name="customer_sales_month_idx"),
+        ]
+
+
+class RollupState(models.Model):
+    """
+    High-water mark of a rollup: the last InvoiceItem.id already added to it.
+    Items are expected to be committed in id order (SQLite serializes writes),
+    and items changed or deleted after being added need a rebuild
+    """
+    name = models.CharField(max_length=64, primary_key=True)
+    high_water_mark = models.BigIntegerField(default=0)
@@ -0,0 +1,37 @@
+from rest_framework.pagination import CursorPagination
+
+
+class CreationDateCursorPagination(CursorPagination):
+    """
+    Keyset pagination over (creation_date, id), newest first.
+    Never runs a COUNT(*) and caps the page size per endpoint: a viewset may
+    set "max_page_size" to override the default cap
+    """
+    ordering = ("-creation_date", "-id")
+    page_size_query_param = "page_size"
+    max_page_size = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.max_page_size = getattr(view, "max_page_size", self.max_page_size)
+        return super().paginate_queryset(queryset, request, view)
+
+
+class PurchaseDateCursorPagination(CreationDateCursorPagination):
+    """
+    Keyset pagination over (purchase_date, id), newest first
+    """
+    ordering = ("-purchase_date", "-id")
+
+
+class DayCursorPagination(CreationDateCursorPagination):
+    """
+    Keyset pagination over (day, id), latest first
+    """
+    ordering = ("-day", "-id")
+
+
+class MonthCursorPagination(CreationDateCursorPagination):
+    """
+    Keyset pagination over (month, id), latest first
+    """
+    ordering = ("-month", "-id")
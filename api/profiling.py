@@ -0,0 +1,192 @@
+import functools
+import glob
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+SALT = "api.profiling"
+
+
+def issue_profiling_token():
+    """
+    Returns a signed value for the X-Profile header, valid for
+    PROFILING_TOKEN_MAX_AGE seconds
+    """
+    return signing.TimestampSigner(salt=SALT).sign("profile")
+
+
+def verify_profiling_token(token):
+    try:
+        signing.TimestampSigner(salt=SALT).unsign(token, max_age=settings.PROFILING_TOKEN_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def frame_label(code):
+    """
+    "function (path:line)" of a code object, the path relative to sys.path
+    """
+    path = code.co_filename
+    roots = [root for root in sys.path if root and path.startswith(os.path.join(root, ""))]
+    if roots:
+        path = os.path.relpath(path, max(roots, key=len))
+    return "{} ({}:{})".format(code.co_name, path, code.co_firstlineno).replace(";", ":")
+
+
+class Sampler:
+    """
+    Samples the stack of the thread creating it every interval seconds, from
+    a background thread, below the creator's frame, and counts the stacks,
+    root first, in the collapsed format of flamegraph.pl and speedscope
+    """
+    max_samples = 20000
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.thread_id = threading.get_ident()
+        # the caller's frame: the server's frames above it are left out
+        self.root = sys._getframe(1)
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        # waiting first: the creator has left __enter__
+        while not self.stopped.wait(self.interval) and self.samples < self.max_samples:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame is not self.root:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+
+def summarize(stacks, top):
+    """
+    Returns the top functions by samples in the function itself (own), with
+    the samples in them or their callees (total)
+    """
+    own, total = Counter(), Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    return [(frame, count, total[frame]) for frame, count in own.most_common(top)]
+
+
+def write_file(path, content):
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        file.write(content)
+    os.replace(temporary, path)
+
+
+def prune():
+    """
+    Removes the oldest profiles beyond PROFILING_MAX_PROFILES, or
+    PROFILING_MAX_BYTES in all, always keeping the newest one
+    """
+    profiles = sorted(glob.glob(os.path.join(settings.PROFILING_DIR, "*.folded")), reverse=True)
+    size = 0
+    for kept, path in enumerate(profiles, 1):
+        paths = (path, path[:-len(".folded")] + ".txt")
+        for name in paths:
+            try:
+                size += os.path.getsize(name)
+            except OSError:
+                pass
+        if kept > 1 and (kept > settings.PROFILING_MAX_PROFILES or size > settings.PROFILING_MAX_BYTES):
+            for name in paths:
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    # removed by another worker
+                    pass
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the requests with a signed X-Profile header (see the
+    profiling_token command) or, from staff users, a profile=1 query
+    parameter, with a Sampler. Writes PROFILING_DIR/<id>.folded, the
+    collapsed stacks, and <id>.txt, the top PROFILING_TOP functions, and
+    returns the id in an X-Profile-Id header. Only the last profiles are
+    kept (see prune()). Off when PROFILING_DIR is empty. The content of a
+    streaming response is sent, and its queries run, after the profile
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.PROFILING_DIR or not self.requested(request):
+            return self.get_response(request)
+        started = time.perf_counter()
+        with Sampler(settings.PROFILING_INTERVAL) as sampler:
+            response = self.get_response(request)
+        duration = time.perf_counter() - started
+        match = request.resolver_match
+        route = match.url_name if match and match.url_name else "unmatched"
+        name = "{}-{}-{}".format(timezone.now().strftime("%Y%m%dT%H%M%S%f"), route, secrets.token_hex(3))
+        os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+        path = os.path.join(settings.PROFILING_DIR, name)
+        # the summary first: a listed .folded always has its .txt
+        write_file(path + ".txt", self.summary(request, response, route, duration, sampler))
+        write_file(path + ".folded", "".join("{} {}\n".format(stack, count) for stack, count in sampler.stacks.items()))
+        prune()
+        response["X-Profile-Id"] = name
+        return response
+
+    def requested(self, request):
+        token = request.META.get("HTTP_X_PROFILE")
+        if token:
+            return verify_profiling_token(token)
+        return request.GET.get("profile") == "1" and self.is_staff(request)
+
+    def is_staff(self, request):
+        user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            return user.is_staff
+        # API users are authenticated by the view: only when asked for a profile
+        try:
+            for authentication in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+                result = authentication().authenticate(Request(request))
+                if result is not None:
+                    return result[0].is_staff
+        except exceptions.AuthenticationFailed:
+            pass
+        return False
+
+    def summary(self, request, response, route, duration, sampler):
+        lines = [
+            "{} {} -> {} ({})".format(request.method, request.get_full_path(), response.status_code, route),
+            "{:.2f} ms, {} samples every {:g} ms".format(duration * 1000, sampler.samples, settings.PROFILING_INTERVAL * 1000),
+            "",
+            "{:>7} {:>7}  function".format("own %", "total %"),
+        ]
+        for frame, own, total in summarize(sampler.stacks, settings.PROFILING_TOP):
+            lines.append("{:>7.1f} {:>7.1f}  {}".format(own * 100 / sampler.samples, total * 100 / sampler.samples, frame))
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,35 @@
+import functools
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from api.fragments import MARKER, PLACEHOLDER, Fragment
+
+
+class FragmentEncoder(JSONEncoder):
+    """
+    Encodes the fragments as placeholders, collecting their bytes in fragments
+    """
+
+    def __init__(self, *args, fragments, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fragments = fragments
+
+    def default(self, obj):
+        if isinstance(obj, Fragment):
+            self.fragments.append(obj.content)
+            return "{}{}".format(MARKER, len(self.fragments) - 1)
+        return super().default(obj)
+
+
+class FragmentJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer splicing the cached bytes of the api.fragments.Fragment
+    objects of the data in place, instead of encoding them again
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        fragments = []
+        self.encoder_class = functools.partial(FragmentEncoder, fragments=fragments)
+        content = super().render(data, accepted_media_type, renderer_context)
+        if not fragments:
+            return content
+        return PLACEHOLDER.sub(lambda match: fragments[int(match.group(1))], content)
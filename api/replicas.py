@@ -0,0 +1,92 @@
+import contextvars
+import hashlib
+import itertools
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_replica_reads = contextvars.ContextVar("replica_reads", default=False)
+
+
+def allow_replica_reads(allowed):
+    """
+    Allows (or not) the current request's reads to go to a replica. Returns a
+    token for reset_replica_reads()
+    """
+    return _replica_reads.set(allowed)
+
+
+def reset_replica_reads(token):
+    _replica_reads.reset(token)
+
+
+def replica_reads_allowed():
+    return _replica_reads.get()
+
+
+def _pin_key(request):
+    client = request.META.get("HTTP_AUTHORIZATION") or request.META.get("REMOTE_ADDR", "")
+    return "replica:pin:{}".format(hashlib.sha1(client.encode()).hexdigest())
+
+
+def pin_to_primary(request):
+    """
+    Sends the client's reads to the primary for REPLICA_PIN_SECONDS, so it
+    reads its own writes
+    """
+    caches[settings.REPLICA_PIN_CACHE_ALIAS].set(_pin_key(request), True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned_to_primary(request):
+    return bool(caches[settings.REPLICA_PIN_CACHE_ALIAS].get(_pin_key(request)))
+
+
+class ReplicaRouter:
+    """
+    Database router sending the reads allowed by allow_replica_reads() to the
+    DATABASE_REPLICAS aliases, round robin. Writes and every other read go to
+    the primary. A replica failing its health check is ejected for
+    REPLICA_EJECT_SECONDS
+    """
+
+    def __init__(self):
+        self._counter = itertools.count()
+        self._checked = {}
+        self._ejected = {}
+
+    def db_for_read(self, model, **hints):
+        if not replica_reads_allowed():
+            return None
+        replicas = [alias for alias in settings.DATABASE_REPLICAS if self.is_healthy(alias)]
+        if not replicas:
+            return None
+        return replicas[next(self._counter) % len(replicas)]
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas are copies of the primary
+        return db not in settings.DATABASE_REPLICAS
+
+    def is_healthy(self, alias):
+        """
+        Checks a replica at most every REPLICA_CHECK_SECONDS
+        """
+        now = time.monotonic()
+        if self._ejected.get(alias, 0) > now:
+            return False
+        if now - self._checked.get(alias, -settings.REPLICA_CHECK_SECONDS) < settings.REPLICA_CHECK_SECONDS:
+            return True
+        self._checked[alias] = now
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except Exception:
+            self._ejected[alias] = now + settings.REPLICA_EJECT_SECONDS
+            return False
+        return True
@@ -0,0 +1,10 @@
+from rest_framework.routers import DefaultRouter
+
+
+class BulkRouter(DefaultRouter):
+    """
+    DefaultRouter that also routes PATCH on the list url to the viewset's
+    "bulk_partial_update" method, when the viewset has one
+    """
+    routes = list(DefaultRouter.routes)
+    routes[0] = routes[0]._replace(mapping={**routes[0].mapping, 'patch': 'bulk_partial_update'})
@@ -0,0 +1,267 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from django.conf import settings
+from django.db import connections, router
+from django.db.utils import OperationalError
+from api.cache import catalog_cache
+from api.models import Product
+
+FTS_TABLE = "api_product_fts"
+# ranking weights of the (name, description) columns: a hit in the name counts more
+WEIGHTS = (10.0, 1.0)
+# shorter prefixes would expand to too many terms
+MIN_PREFIX = 2
+TOKEN = re.compile(r"[^\W_]+")
+
+CREATE_FTS = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5("
+    "name, description, content='api_product', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3 4 5 6')"
+).format(FTS_TABLE)
+TRIGGERS = {
+    "api_product_fts_insert": (
+        "CREATE TRIGGER api_product_fts_insert AFTER INSERT ON api_product BEGIN "
+        "INSERT INTO {0}(rowid, name, description) VALUES (new.id, new.name, new.description); END"
+    ),
+    "api_product_fts_delete": (
+        "CREATE TRIGGER api_product_fts_delete AFTER DELETE ON api_product BEGIN "
+        "INSERT INTO {0}({0}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); END"
+    ),
+    "api_product_fts_update": (
+        "CREATE TRIGGER api_product_fts_update AFTER UPDATE OF name, description ON api_product BEGIN "
+        "INSERT INTO {0}({0}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+        "INSERT INTO {0}(rowid, name, description) VALUES (new.id, new.name, new.description); END"
+    ),
+}
+
+
+def install_product_fts(connection):
+    """
+    Creates the FTS5 index of the products and the triggers keeping it in
+    sync, and rebuilds it when a trigger was missing: SQLite drops them when a
+    migration remakes the product table. Returns False on backends without FTS5
+    """
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute(CREATE_FTS)
+        except OperationalError:
+            # SQLite built without FTS5
+            return False
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'api_product'")
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [sql for name, sql in TRIGGERS.items() if name not in existing]
+        for sql in missing:
+            cursor.execute(sql.format(FTS_TABLE))
+        if missing:
+            cursor.execute("INSERT INTO {0}({0}) VALUES ('rebuild')".format(FTS_TABLE))
+    return True
+
+
+def uninstall_product_fts(connection):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name in TRIGGERS:
+            cursor.execute("DROP TRIGGER IF EXISTS {}".format(name))
+        cursor.execute("DROP TABLE IF EXISTS {}".format(FTS_TABLE))
+
+
+def tokenize(text):
+    """
+    Lower cased words without diacritics, as the unicode61 tokenizer splits them
+    """
+    text = unicodedata.normalize("NFKD", text.lower())
+    return TOKEN.findall("".join(char for char in text if not unicodedata.combining(char)))
+
+
+class SearchResults(list):
+    """
+    Ids of a page of search results. truncated is set when the query matched
+    more than SEARCH_MAX_RANKED products, of which only the newest were ranked
+    """
+
+    def __init__(self, ids=(), truncated=False):
+        super().__init__(ids)
+        self.truncated = truncated
+
+
+_fts_tables = {}
+
+
+def has_fts(connection):
+    if connection.alias not in _fts_tables:
+        _fts_tables[connection.alias] = (
+            connection.vendor == "sqlite" and FTS_TABLE in connection.introspection.table_names()
+        )
+    return _fts_tables[connection.alias]
+
+
+def fts_query(terms):
+    """
+    The MATCH expression of terms: every word, the last one also as a prefix
+    """
+    words = ['"{}"'.format(term) for term in terms]
+    if len(terms[-1]) >= MIN_PREFIX:
+        words[-1] += "*"
+    return " ".join(words)
+
+
+def fts_search(connection, terms, limit, offset):
+    """
+    Ranks the newest SEARCH_MAX_RANKED matches with bm25(). Besides the capped
+    matches, bm25() reads every match of each word once for its IDF: that
+    scan, not the ranking, bounds the latency of common words
+    """
+    sql = "SELECT rowid, bm25({0}, {1}, {2}) FROM {0} WHERE {0} MATCH %s ORDER BY rowid DESC LIMIT %s".format(
+        FTS_TABLE, *WEIGHTS
+    )
+    max_ranked = settings.SEARCH_MAX_RANKED
+    with connection.cursor() as cursor:
+        # one more than ranked tells whether more products match
+        cursor.execute(sql, [fts_query(terms), max_ranked + 1])
+        rows = cursor.fetchall()
+    # bm25() is negative, best first
+    ranked = heapq.nsmallest(offset + limit, rows[:max_ranked], key=lambda row: (row[1], -row[0]))
+    return SearchResults([row[0] for row in ranked[offset:]], len(rows) > max_ranked)
+
+
+class ProductSearchIndex:
+    """
+    In-memory inverted index of the products' name and description with BM25
+    ranking, used on backends without FTS5. It is built on first use; before
+    each search the products updated since (seen through the catalog
+    generation) are reindexed, and deleted ones are dropped once a search
+    returns them
+    """
+    k1, b = 1.2, 0.75
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # term -> {product id: (name tf, description tf)}
+        self.postings = defaultdict(dict)
+        # sorted terms, for the prefix lookups
+        self.terms = []
+        # product id -> (terms, (name length, description length))
+        self.docs = {}
+        self.lengths = [0, 0]
+        self.generation = None
+        self.updated_at = None
+
+    def add(self, id, name, description):
+        self.remove(id)
+        columns = [Counter(tokenize(name)), Counter(tokenize(description))]
+        terms = set(columns[0]) | set(columns[1])
+        for term in terms:
+            if term not in self.postings:
+                bisect.insort(self.terms, term)
+            self.postings[term][id] = (columns[0][term], columns[1][term])
+        lengths = tuple(sum(column.values()) for column in columns)
+        self.docs[id] = (terms, lengths)
+        self.lengths = [total + length for total, length in zip(self.lengths, lengths)]
+
+    def remove(self, id):
+        doc = self.docs.pop(id, None)
+        if doc is None:
+            return
+        terms, lengths = doc
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(id, None)
+            if not postings:
+                del self.postings[term]
+                del self.terms[bisect.bisect_left(self.terms, term)]
+        self.lengths = [total - length for total, length in zip(self.lengths, lengths)]
+
+    def refresh(self, using):
+        """
+        Indexes the products updated since the last refresh
+        """
+        generation = catalog_cache.generation()
+        if generation == self.generation:
+            return
+        rows = Product.objects.using(using).order_by()
+        if self.updated_at is not None:
+            # rows saved in the same instant may have been missed
+            rows = rows.filter(updated_at__gte=self.updated_at)
+        for id, name, description, updated_at in rows.values_list(
+            "id", "name", "description", "updated_at"
+        ).iterator(chunk_size=2000):
+            self.add(id, name, description)
+            self.updated_at = max(self.updated_at or updated_at, updated_at)
+        self.generation = generation
+
+    def expand(self, prefix):
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + "\uffff", start)
+        return self.terms[start:end]
+
+    def search(self, terms, limit, offset):
+        count = len(self.docs)
+        if not count:
+            return SearchResults()
+        averages = [total / count or 1 for total in self.lengths]
+        matches = []
+        for position, term in enumerate(terms):
+            last = position == len(terms) - 1
+            expanded = self.expand(term) if last and len(term) >= MIN_PREFIX else [term] if term in self.postings else []
+            matches.append([self.postings[match] for match in expanded])
+        # every word must match: intersect, smallest posting lists first
+        candidates = None
+        for postings in sorted(matches, key=lambda postings: sum(map(len, postings))):
+            ids = set().union(*postings)
+            candidates = ids if candidates is None else candidates & ids
+            if not candidates:
+                return SearchResults()
+        truncated = len(candidates) > settings.SEARCH_MAX_RANKED
+        if truncated:
+            candidates = heapq.nlargest(settings.SEARCH_MAX_RANKED, candidates)
+        scores = dict.fromkeys(candidates, 0.0)
+        for postings in matches:
+            best = dict.fromkeys(candidates, 0.0)
+            for term_postings in postings:
+                idf = math.log(1 + (count - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+                for id in candidates:
+                    frequencies = term_postings.get(id)
+                    if frequencies is None:
+                        continue
+                    score = idf * sum(
+                        weight * frequency * (self.k1 + 1)
+                        / (frequency + self.k1 * (1 - self.b + self.b * length / average))
+                        for weight, frequency, length, average
+                        in zip(WEIGHTS, frequencies, self.docs[id][1], averages) if frequency
+                    )
+                    # a prefix matching several terms of a product counts its best one
+                    best[id] = max(best[id], score)
+            for id, score in best.items():
+                scores[id] += score
+        ranked = heapq.nlargest(offset + limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return SearchResults([id for id, _ in ranked[offset:]], truncated)
+
+
+product_index = ProductSearchIndex()
+
+
+def search_products(query, limit, offset=0):
+    """
+    Returns the SearchResults of the products matching every word of query,
+    the last one as a prefix, best BM25 rank first
+    """
+    terms = tokenize(query)
+    if not terms:
+        return SearchResults()
+    connection = connections[router.db_for_read(Product)]
+    if has_fts(connection):
+        return fts_search(connection, terms, limit, offset)
+    with product_index.lock:
+        product_index.refresh(connection.alias)
+        return product_index.search(terms, limit, offset)
@@ -1,29 +1,257 @@
-from rest_framework import serializers
-from .models import Customer, Invoice, InvoiceItem, Product, ShoppingCart
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from .models import Customer, CustomerMonthlySales, Invoice, InvoiceItem, Product, ProductDailySales, ShoppingCart
 
 
-class CustomerSerializer(serializers.ModelSerializer):
+def parse_paths(value):
+    """
+    Turns "a,b.c,b.d" into the tree {"a": {}, "b": {"c": {}, "d": {}}}
+    """
+    tree = {}
+    for path in value.split(","):
+        node = tree
+        for name in filter(None, (name.strip() for name in path.split("."))):
+            node = node.setdefault(name, {})
+    return tree
+
+
+class SparseFieldsMixin:
+    """
+    Serializer mixin rendering only the fields listed by ?fields= (dotted
+    paths reach into the nested serializers) and embedding only the relations
+    listed by ?expand=, the others rendering as ids. Without ?expand= every
+    relation is embedded. Only reads are trimmed. Nested serializers get their
+    part of the trees from their parent
+    """
+
+    def get_sparse_trees(self):
+        """
+        Returns the (fields, expand) trees, None meaning all
+        """
+        if hasattr(self, "_sparse_trees"):
+            return self._sparse_trees
+        request = self.context.get("request")
+        if request is None or request.method not in ("GET", "HEAD"):
+            return None, None
+        params = request.query_params
+        fields = parse_paths(params["fields"]) if "fields" in params else None
+        expand = parse_paths(params["expand"]) if "expand" in params else None
+        if fields is not None and expand is not None:
+            # a dotted field path needs its relation embedded
+            expand = self.merge_paths(expand, {name: sub for name, sub in fields.items() if sub})
+        return fields, expand
+
+    @classmethod
+    def merge_paths(cls, tree, other):
+        merged = dict(tree)
+        for name, sub in other.items():
+            merged[name] = cls.merge_paths(merged.get(name, {}), sub)
+        return merged
+
+    def get_fields(self):
+        fields = super().get_fields()
+        only, expand = self.get_sparse_trees()
+        for name in list(fields):
+            field = fields[name]
+            if only is not None and name not in only and not field.write_only:
+                del fields[name]
+                continue
+            nested = field.child if isinstance(field, serializers.ListSerializer) else field
+            if not isinstance(nested, SparseFieldsMixin):
+                continue
+            if expand is not None and name not in expand:
+                fields[name] = serializers.PrimaryKeyRelatedField(
+                    source=field.source, read_only=True, many=isinstance(field, serializers.ListSerializer)
+                )
+            else:
+                nested._sparse_trees = (
+                    (only.get(name) or None) if only is not None else None,
+                    expand.get(name) if expand is not None else None,
+                )
+        return fields
+
+
+# fields whose to_representation returns a database value of the column's type unchanged
+IDENTITY_FIELDS = {
+    serializers.IntegerField.to_representation, serializers.CharField.to_representation,
+    serializers.BooleanField.to_representation, serializers.PrimaryKeyRelatedField.to_representation,
+}
+
+
+def iso_datetime(value, tz):
+    """
+    DateTimeField.to_representation in ISO 8601, with the time zone resolved
+    once per page instead of once per value
+    """
+    value = value.astimezone(tz) if value.utcoffset() is not None else timezone.make_aware(value, tz)
+    value = value.isoformat()
+    return value[:-6] + "Z" if value.endswith("+00:00") else value
+
+
+# column of the stamp bumped on every change of a row, see compile_fragment_plan
+STAMP_FIELD = "updated_at"
+
+
+def stamp_lookups(serializer, model, prefix=""):
+    """
+    Returns the lookups of the stamps of model and of the models embedded by
+    serializer, or None when one of them has no stamp
+    """
+    try:
+        model._meta.get_field(STAMP_FIELD)
+    except FieldDoesNotExist:
+        return None
+    stamps = [prefix + STAMP_FIELD]
+    for field in serializer.fields.values():
+        if field.write_only or not isinstance(field, serializers.BaseSerializer):
+            continue
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            return None
+        nested = stamp_lookups(field, model_field.related_model, prefix + model_field.name + "__")
+        if nested is None:
+            return None
+        stamps += nested
+    return stamps
+
+
+class FragmentPlan:
+    """
+    Reads and renders the objects of a nested serializer on their own:
+    render(values_list(*lookups) rows) returns (pk, stamps, representation)
+    tuples. variant tells apart the representations of the same object
+    """
+
+    def __init__(self, model, stamps, lookups, render, variant):
+        self.model = model
+        self.stamps = stamps
+        self.lookups = lookups
+        self.render = render
+        self.variant = variant
+
+
+def compile_fragment_plan(serializer, model):
+    """
+    Returns the FragmentPlan of a nested serializer, or None when it can't be
+    compiled or an embedded model has no stamp
+    """
+    stamps = stamp_lookups(serializer, model)
+    if stamps is None:
+        return None
+    plan = compile_read_plan(serializer, model, stamps=stamps)
+    if plan is None:
+        return None
+    lookups, render = plan
+    return FragmentPlan(model, stamps, lookups, render, (type(serializer), render.body))
+
+
+def compile_read_plan(serializer, model, fragments=False, stamps=None):
+    """
+    Compiles a serializer into (lookups, render): render(rows) builds from
+    values_list(*lookups) rows the same representations as the serializer
+    does from instances, without per field dispatch. Returns None when a
+    rendered field doesn't map to a column.
+    With fragments, the nested serializers whose objects have stamps render
+    as api.fragments.Fragment objects got from render(rows, fragments), an
+    api.fragments.PageFragments, and only their pk and stamps are read.
+    With stamps (lookups), render returns (pk, stamps, representation) tuples
+    """
+    lookups, namespace = [], {"iso_datetime": iso_datetime, "get_current_timezone": timezone.get_current_timezone}
+
+    def column(lookup):
+        lookups.append(lookup)
+        return "row[{}]".format(len(lookups) - 1)
+
+    def converter(field):
+        name = "convert{}".format(len(namespace))
+        namespace[name] = field.to_representation
+        return name
+
+    def build(serializer, model, prefix):
+        items = []
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+            if field.source == "*" or "." in field.source:
+                return None
+            try:
+                model_field = model._meta.get_field(field.source)
+            except FieldDoesNotExist:
+                return None
+            if model_field.many_to_many or model_field.one_to_many:
+                return None
+            value = column(prefix + model_field.name)
+            to_representation = type(field).to_representation
+            if isinstance(field, serializers.BaseSerializer):
+                plan = compile_fragment_plan(field, model_field.related_model) if fragments and not prefix else None
+                if plan is not None:
+                    name = "plan{}".format(len(namespace))
+                    namespace[name] = plan
+                    stamp_columns = ", ".join(column(model_field.name + "__" + lookup) for lookup in plan.stamps)
+                    expression = "fragments.get({}, {}, ({},))".format(name, value, stamp_columns)
+                else:
+                    expression = build(field, model_field.related_model, prefix + model_field.name + "__")
+                    if expression is None:
+                        return None
+            elif isinstance(field, serializers.RelatedField) and not isinstance(field, serializers.PrimaryKeyRelatedField):
+                return None
+            elif to_representation in IDENTITY_FIELDS:
+                expression = value
+            elif to_representation is serializers.FloatField.to_representation:
+                expression = "float({})".format(value)
+            elif (
+                to_representation is serializers.DateTimeField.to_representation and settings.USE_TZ
+                and not hasattr(field, "timezone")
+                and str(getattr(field, "format", api_settings.DATETIME_FORMAT)).lower() == ISO_8601
+            ):
+                expression = "iso_datetime({}, tz)".format(value)
+            else:
+                expression = "{}({})".format(converter(field), value)
+            if expression != value:
+                expression = "None if {0} is None else {1}".format(value, expression)
+            items.append("{!r}: ({})".format(field.field_name, expression))
+        return "{" + ", ".join(items) + "}"
+
+    body = build(serializer, model, "")
+    if body is None:
+        return None
+    if stamps is not None:
+        pk = column(model._meta.pk.name)
+        body = "({}, ({},), {})".format(pk, ", ".join(column(lookup) for lookup in stamps), body)
+    exec("def render(rows, fragments=None):\n    tz = get_current_timezone()\n    return [" + body + " for row in rows]", namespace)
+    render = namespace["render"]
+    render.body = body
+    return lookups, render
+
+
+class CustomerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Customer
         fields = '__all__'
 
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = '__all__'
 
 
-class InvoiceSerializer(serializers.ModelSerializer):
+class InvoiceSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     customer = CustomerSerializer(read_only=True)
     customer_id = serializers.IntegerField(write_only=True)
 
     class Meta:
         model = Invoice
         fields = '__all__'
+        # kept in sync with the invoice's items
+        read_only_fields = ('total_value', 'total_quantity', 'total_discount')
 
 
-class InvoiceItemSerializer(serializers.ModelSerializer):
+class InvoiceItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     invoice = InvoiceSerializer(read_only=True)
     invoice_id = serializers.IntegerField(write_only=True)
     product = ProductSerializer(read_only=True)
@@ -34,7 +262,7 @@ class InvoiceItemSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class ShoppingCartSerializer(serializers.ModelSerializer):
+class ShoppingCartSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     customer = CustomerSerializer(read_only=True)
     customer_id = serializers.IntegerField(write_only=True)
     product = ProductSerializer(read_only=True)
@@ -43,3 +271,15 @@ class ShoppingCartSerializer(serializers.ModelSerializer):
     class Meta:
         model = ShoppingCart
         fields = '__all__'
+
+
+class ProductDailySalesSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = ProductDailySales
+        fields = '__all__'
+
+
+class CustomerMonthlySalesSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = CustomerMonthlySales
+        fields = '__all__'
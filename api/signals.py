@@ -0,0 +1,35 @@
+from django.db import connections, router, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+from api.cache import catalog_cache
+from api.models import Product
+from api.search import FTS_TABLE, install_product_fts, product_index
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_catalog(sender, **kwargs):
+    """
+    Bumps the catalog generation right away and again once the change is
+    committed, so no reader can refill the cache with uncommitted data
+    """
+    catalog_cache.bump()
+    transaction.on_commit(catalog_cache.bump)
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    with product_index.lock:
+        product_index.remove(instance.id)
+
+
+@receiver(post_migrate)
+def repair_product_fts(sender, using, **kwargs):
+    """
+    Puts back the search triggers dropped when a migration remade the product table
+    """
+    connection = connections[using]
+    if sender.label != "api" or not router.allow_migrate_model(using, Product):
+        return
+    if FTS_TABLE in connection.introspection.table_names():
+        install_product_fts(connection)
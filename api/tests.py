@@ -1,9 +1,35 @@
+import csv
 import datetime
-from django.test import TestCase, Client
+import gzip
+import re
+import subprocess
+import threading
+import time
+import unittest
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.utils import OperationalError
+from django.test import Client, SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
+import io
 import json
+import os
+import tempfile
+from unittest import mock
 from django.contrib.auth.models import User
+from api.cache import CatalogCache, ExpiringFileBasedCache, catalog_cache
+from api import metrics
+from api.capture import get_writer
+from api.fragments import FragmentCache, PageFragments, fragment_cache
+from api.models import Customer, CustomerMonthlySales, Invoice, InvoiceItem, Product, ProductDailySales, RollupState, SALES, ShoppingCart
+from api.replicas import ReplicaRouter, allow_replica_reads, replica_reads_allowed, reset_replica_reads
+from api.search import ProductSearchIndex, install_product_fts, product_index, search_products
+from api.filters import check_indexed_filters
+from api.views import CustomerViewSet, FastReadMixin, PrecompiledTemplateView, ShoppingCartViewSet, warm_precompiled_templates
 
 class TestEcommerceApi(TestCase):
     """
@@ -80,6 +106,7 @@ class TestEcommerceApi(TestCase):
         This method runs before execution of each test case
         """
         self.client = Client()
+        fragment_cache.clear()
         self.token = ""
         self.auth_headers = ""
         # mockup's
@@ -666,4 +693,1386 @@ class TestEcommerceApi(TestCase):
         response = self.client.post(self.url, wrong_pass_user)
         # for wrong password must not be status code 200!
         self.assertNotEqual(200, response.status_code)
-    # END Testing Auth Token
\ No newline at end of file
+    # END Testing Auth Token
+
+
+    # Testing query planning
+    def _seed_rows(self, count):
+        """
+        Creates count invoice's items and shoppingcarts, each with its own
+        invoice, customer and product
+        """
+        for i in range(count):
+            customer = Customer.objects.create(**self.customer_data)
+            product = Product.objects.create(**self.product_data)
+            invoice = Invoice.objects.create(customer=customer)
+            InvoiceItem.objects.create(invoice=invoice, product=product, quantity=1, discount_value=0.0)
+            ShoppingCart.objects.create(customer=customer, product=product, quantity=1, discount_value=0.0, is_closed=False)
+
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, **self.auth_headers)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        return len(queries)
+
+
+    def test_list_queries_do_not_grow_with_rows(self):
+        """
+        This test case checks if list endpoints run the same number of queries
+        no matter how many rows come back
+        """
+        self._seed_rows(2)
+        few = {m: self._count_queries(reverse("{}-list".format(m))) for m in ["invoice", "invoiceitem", "shoppingcart"]}
+        self._seed_rows(5)
+        many = {m: self._count_queries(reverse("{}-list".format(m))) for m in ["invoice", "invoiceitem", "shoppingcart"]}
+        self.assertEqual(few, many)
+
+
+    def test_invoice_item_detail_joins_relations(self):
+        """
+        This test case checks if invoice's item detail endpoint loads the nested
+        invoice, customer and product in a single query
+        """
+        self._seed_rows(1)
+        item = InvoiceItem.objects.first()
+        url = reverse("invoiceitem-detail", kwargs={'pk': item.id})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, **self.auth_headers)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(item.invoice.customer.id, response.json()["invoice"]["customer"]["id"])
+        item_queries = [q for q in queries if "api_" in q["sql"]]
+        self.assertEqual(1, len(item_queries))
+    # END Testing query planning
+
+
+    # Testing pagination
+    def test_list_pagination_walks_all_rows(self):
+        """
+        This test case checks if list endpoints are paginated by cursor, follow
+        the next links through every row and never count the table
+        """
+        self._seed_rows(5)
+        seen = []
+        url = reverse("invoiceitem-list") + "?page_size=2"
+        with CaptureQueriesContext(connection) as queries:
+            while url:
+                response = self.client.get(url, **self.auth_headers)
+                self.assertEqual(status.HTTP_200_OK, response.status_code)
+                r_json = response.json()
+                self.assertLessEqual(len(r_json["results"]), 2)
+                seen += [r["id"] for r in r_json["results"]]
+                url = r_json["next"]
+        self.assertEqual(sorted(InvoiceItem.objects.values_list("id", flat=True)), sorted(seen))
+        self.assertFalse([q for q in queries if "COUNT(" in q["sql"].upper()])
+
+
+    def test_list_page_size_is_bounded(self):
+        """
+        This test case checks if a client can't ask for more rows than the
+        endpoint's max page size
+        """
+        self._seed_rows(3)
+        with mock.patch.object(ShoppingCartViewSet, "max_page_size", 2):
+            response = self.client.get(reverse("shoppingcart-list") + "?page_size=1000", **self.auth_headers)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertEqual(2, len(response.json()["results"]))
+    # END Testing pagination
+
+
+    # Testing bulk writes
+    def test_invoice_item_bulk_create(self):
+        """
+        This test case checks if invoice's item create endpoint accepts a list,
+        creating the valid rows and reporting the invalid ones by index
+        """
+        customer = Customer.objects.create(**self.customer_data)
+        product = Product.objects.create(**self.product_data)
+        invoice = Invoice.objects.create(customer=customer)
+        row = {**self.invoice_item_data, "invoice_id": invoice.id, "product_id": product.id}
+        data = [row, {**row, "quantity": "many"}, {**row, "product_id": 9999}, {**row, "quantity": 3}]
+        self.url = reverse("invoiceitem-list")
+        response = self.client.post(self.url, data, content_type="application/json", **self.auth_headers)
+        self.assertEqual(status.HTTP_207_MULTI_STATUS, response.status_code)
+        r_json = response.json()
+        self.assertEqual([10, 3], [r["quantity"] for r in r_json["results"]])
+        self.assertEqual(product.id, r_json["results"][0]["product"]["id"])
+        self.assertEqual([1, 2], [e["index"] for e in r_json["errors"]])
+        self.assertIn("product_id", r_json["errors"][1]["errors"])
+        self.assertEqual(2, InvoiceItem.objects.count())
+
+
+    def test_shoppingcart_bulk_partial_update(self):
+        """
+        This test case checks if shoppingcart list endpoint accepts a PATCH with
+        a list of carts, skipping closed and unknown carts
+        """
+        self._seed_rows(2)
+        open_cart, closed_cart = ShoppingCart.objects.order_by("id")
+        closed_cart.is_closed = True
+        closed_cart.save()
+        data = [{"id": open_cart.id, "quantity": 7}, {"id": closed_cart.id, "quantity": 7}, {"id": 9999, "quantity": 7}]
+        self.url = reverse("shoppingcart-list")
+        response = self.client.patch(self.url, data, content_type="application/json", **self.auth_headers)
+        self.assertEqual(status.HTTP_207_MULTI_STATUS, response.status_code)
+        r_json = response.json()
+        self.assertEqual([open_cart.id], [r["id"] for r in r_json["results"]])
+        self.assertEqual([1, 2], [e["index"] for e in r_json["errors"]])
+        self.assertEqual(7, ShoppingCart.objects.get(id=open_cart.id).quantity)
+        self.assertEqual(1, ShoppingCart.objects.get(id=closed_cart.id).quantity)
+
+
+    def test_bulk_partial_update_duplicate_ids(self):
+        """
+        This test case checks if a PATCH list repeating an id updates the row
+        once, reporting the repeats as errors
+        """
+        self._seed_rows(1)
+        item = InvoiceItem.objects.get()
+        data = [{"id": item.id, "quantity": 4}, {"id": item.id, "quantity": 5}, {"id": item.id, "quantity": 6}]
+        self.url = reverse("invoiceitem-list")
+        response = self.client.patch(self.url, data, content_type="application/json", **self.auth_headers)
+        self.assertEqual(status.HTTP_207_MULTI_STATUS, response.status_code)
+        r_json = response.json()
+        self.assertEqual([4], [r["quantity"] for r in r_json["results"]])
+        self.assertEqual([{"index": 1, "errors": {"id": ["duplicate"]}}, {"index": 2, "errors": {"id": ["duplicate"]}}], r_json["errors"])
+        item.refresh_from_db()
+        self.assertEqual(4, item.quantity)
+        # the seeded invoice has no totals: they only hold the delta, applied once
+        self.assertEqual(3, Invoice.objects.get(id=item.invoice_id).total_quantity)
+    # END Testing bulk writes
+
+
+    # Testing checkout
+    def _checkout_queries(self, lines):
+        customer = Customer.objects.create(**self.customer_data)
+        for i in range(lines):
+            product = Product.objects.create(**{**self.product_data, "price": 2.0})
+            ShoppingCart.objects.create(customer=customer, product=product, quantity=3, discount_value=0.5, is_closed=False)
+        self.url = reverse("checkout")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, {"customer_id": customer.id}, **self.auth_headers)
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        invoice = response.json()["invoice"]
+        self.assertEqual(customer.id, invoice["customer"]["id"])
+        self.assertAlmostEqual(lines * (3 * 2.0 - 0.5), invoice["total_value"])
+        self.assertEqual(lines * 3, invoice["total_quantity"])
+        self.assertAlmostEqual(lines * 0.5, invoice["total_discount"])
+        self.assertEqual(lines, InvoiceItem.objects.filter(invoice_id=invoice["id"], quote_price=2.0).count())
+        self.assertFalse(ShoppingCart.objects.filter(customer=customer, is_closed=False).exists())
+        return len(queries)
+
+
+    def test_checkout_view(self):
+        """
+        This test case checks if checkout turns the open carts into an invoice
+        with a fixed number of queries
+        """
+        self.assertEqual(self._checkout_queries(2), self._checkout_queries(6))
+
+
+    def test_checkout_without_open_carts(self):
+        """
+        This test case checks if checkout fails when the customer has no open carts
+        """
+        customer = Customer.objects.create(**self.customer_data)
+        self.url = reverse("checkout")
+        response = self.client.post(self.url, {"customer_id": customer.id}, **self.auth_headers)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+
+
+    def test_checkout_validates_customer(self):
+        """
+        This test case checks if checkout rejects a missing or malformed
+        customer_id and answers 404 for an unknown customer
+        """
+        self.url = reverse("checkout")
+        for data in ({}, {"customer_id": "abc"}, {"customer_id": 0}, {"customer_id": -3}):
+            response = self.client.post(self.url, data, content_type="application/json", **self.auth_headers)
+            self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code, data)
+        response = self.client.post(self.url, [1], content_type="application/json", **self.auth_headers)
+        self.assertEqual(status.HTTP_400_BAD_REQUEST, response.status_code)
+        response = self.client.post(self.url, {"customer_id": 9999}, **self.auth_headers)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+        self.assertFalse(Invoice.objects.exists())
+    # END Testing checkout
+
+
+    # Testing invoice totals
+    def _assert_totals(self, invoice_id, value, quantity, discount):
+        invoice = Invoice.objects.get(id=invoice_id)
+        self.assertAlmostEqual(value, invoice.total_value)
+        self.assertEqual(quantity, invoice.total_quantity)
+        self.assertAlmostEqual(discount, invoice.total_discount)
+
+
+    def test_invoice_totals_follow_items(self):
+        """
+        This test case checks if invoice totals are kept in sync when its items
+        are created, updated and deleted
+        """
+        customer = Customer.objects.create(**self.customer_data)
+        product = Product.objects.create(**self.product_data)
+        invoice = Invoice.objects.create(customer=customer)
+        other = Invoice.objects.create(customer=customer)
+        data = {**self.invoice_item_data, "invoice_id": invoice.id, "product_id": product.id, "quote_price": 2.0, "discount_value": 1.0}
+        id_itm = self._create_model("invoiceitem", data, ["quantity"])
+        response = self.client.post(reverse("invoiceitem-list"), [data, data], content_type="application/json", **self.auth_headers)
+        self.assertEqual(status.HTTP_201_CREATED, response.status_code)
+        self._assert_totals(invoice.id, 3 * 19.0, 30, 3.0)
+        # moving an item to another invoice
+        self._update_model("invoiceitem", id_itm, {**data, "invoice_id": other.id, "quantity": 5}, ["quantity"])
+        self._assert_totals(invoice.id, 2 * 19.0, 20, 2.0)
+        self._assert_totals(other.id, 9.0, 5, 1.0)
+        self._delete_model("invoiceitem", id_itm)
+        self._assert_totals(other.id, 0.0, 0, 0.0)
+
+
+    def test_reconcile_invoice_totals(self):
+        """
+        This test case checks if the reconciliation command fixes the invoices
+        whose totals drifted from their items
+        """
+        self._seed_rows(3)
+        Invoice.objects.filter(id=Invoice.objects.first().id).update(total_value=99.0)
+        out = io.StringIO()
+        call_command("reconcile_invoice_totals", chunk_size=2, stdout=out)
+        self.assertIn("Checked 3 invoices, fixed 3", out.getvalue())
+        for invoice in Invoice.objects.all():
+            self._assert_totals(invoice.id, *InvoiceItem.objects.get(invoice=invoice).totals())
+    # END Testing invoice totals
+
+
+    # Testing catalog cache
+    def test_product_detail_is_cached(self):
+        """
+        This test case checks if product detail is served from the catalog cache
+        and refreshed after the product changes
+        """
+        id = self._create_model("product", self.product_data, ["name"])
+        self._detail_model("product", self.product_data, id, ["name"])
+        with CaptureQueriesContext(connection) as queries:
+            self._detail_model("product", self.product_data, id, ["name"])
+        # only the cheap validator query may touch the table
+        self.assertFalse([q for q in queries if '"api_product"."name"' in q["sql"]])
+        data = {**self.product_data, "name": "Changed the name"}
+        self._update_model("product", id, data, ["name"])
+        self._detail_model("product", data, id, ["name"])
+
+
+    def test_product_detail_cache_keeps_sparse_variants(self):
+        """
+        This test case checks if a cached product detail isn't served to a
+        request asking for other fields
+        """
+        id = self._create_model("product", self.product_data, ["name"])
+        self.url = reverse("product-detail", kwargs={"pk": id})
+        self.assertIn("description", self.client.get(self.url, **self.auth_headers).json())
+        response = self.client.get(self.url + "?fields=id", **self.auth_headers)
+        self.assertEqual({"id": id}, response.json())
+        self.assertIn("description", self.client.get(self.url, **self.auth_headers).json())
+
+
+    def test_catalog_cache_single_flight(self):
+        """
+        This test case checks if concurrent misses on the same key run a single fill
+        """
+        fills = []
+        def fill():
+            fills.append(1)
+            time.sleep(0.05)
+            return {"filled": True}
+        key = "test:single-flight:{}".format(time.time())
+        threads = [threading.Thread(target=catalog_cache.get_or_fill, args=(key, fill)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(fills))
+        self.assertEqual({"filled": True}, catalog_cache.get_or_fill(key, fill))
+    # END Testing catalog cache
+
+
+    # Testing conditional requests
+    def test_product_detail_not_modified(self):
+        """
+        This test case checks if product detail answers 304 to a matching
+        If-None-Match and 412 to a stale If-Match on update
+        """
+        id = self._create_model("product", self.product_data, ["name"])
+        self.url = reverse("product-detail", kwargs={'pk': id})
+        response = self.client.get(self.url, **self.auth_headers)
+        etag = response["ETag"]
+        self.assertTrue(response.has_header("Last-Modified"))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(b"", response.content)
+        self.assertEqual(etag, response["ETag"])
+        data = {**self.product_data, "name": "Changed the name"}
+        response = self.client.put(self.url, data, content_type="application/json", HTTP_IF_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+        response = self.client.put(self.url, data, content_type="application/json", HTTP_IF_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_412_PRECONDITION_FAILED, response.status_code)
+
+
+    def test_conditional_requests_with_malformed_pk(self):
+        """
+        This test case checks if a non-numeric pk answers 404 on the
+        endpoints with conditional requests
+        """
+        for model in ("customer", "product"):
+            self.url = reverse("{}-detail".format(model), kwargs={"pk": "abc"})
+            self.assertEqual(status.HTTP_404_NOT_FOUND, self.client.get(self.url, **self.auth_headers).status_code)
+        self.url = reverse("customer-detail", kwargs={"pk": "abc"})
+        response = self.client.put(self.url, self.customer_data, content_type="application/json", **self.auth_headers)
+        self.assertEqual(status.HTTP_404_NOT_FOUND, response.status_code)
+
+
+    def test_customer_list_not_modified(self):
+        """
+        This test case checks if customer list answers 304 until a customer is
+        created
+        """
+        self._create_model("customer", self.customer_data, ["name"])
+        self.url = reverse("customer-list")
+        with CaptureQueriesContext(connection) as queries:
+            etag = self.client.get(self.url, **self.auth_headers)["ETag"]
+        # the ETag comes from the page: no count or aggregate over the table
+        self.assertFalse([q for q in queries if "COUNT(" in q["sql"] or "MAX(" in q["sql"]])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(etag, response["ETag"])
+        self._create_model("customer", self.customer_data, ["name"])
+        self.url = reverse("customer-list")
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+
+
+    def test_list_not_modified_before_rendering(self):
+        """
+        This test case checks if list pages answer 304 to a matching
+        If-None-Match or If-Modified-Since without rendering the page, cached
+        or not, until a row of the page changes
+        """
+        id = self._create_model("product", self.product_data, ["name"])
+        self._create_model("customer", self.customer_data, ["name"])
+        for model in ("customer", "product"):
+            self.url = reverse("{}-list".format(model))
+            response = self.client.get(self.url, **self.auth_headers)
+            etag, last_modified = response["ETag"], response["Last-Modified"]
+            for headers in ({"HTTP_IF_NONE_MATCH": etag}, {"HTTP_IF_MODIFIED_SINCE": last_modified}):
+                catalog_cache.bump()
+                with mock.patch.object(PageFragments, "fill") as fill:
+                    response = self.client.get(self.url, **headers, **self.auth_headers)
+                self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+                self.assertEqual(etag, response["ETag"])
+                self.assertFalse(fill.called)
+        # served from the catalog cache
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self._update_model("product", id, dict(self.product_data, name="Dental floss"), ["name"])
+        response = self.client.get(reverse("product-list"), HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response["ETag"])
+    # END Testing conditional requests
+
+
+    # Testing signed tokens
+    def _signed_token(self):
+        response = self.client.post("/auth", {**self.auth_user, "token_type": "signed"})
+        self.assertEqual(200, response.status_code)
+        return response.json()["token"]
+
+
+    def test_signed_token_skips_db(self):
+        """
+        This test case checks if a signed token authenticates without any
+        token or user query
+        """
+        headers = {"HTTP_AUTHORIZATION": "Bearer {}".format(self._signed_token())}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("customer-list"), **headers)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse([q for q in queries if "authtoken" in q["sql"] or "auth_user" in q["sql"]])
+
+
+    def test_signed_token_invalid(self):
+        """
+        This test case checks if tampered, expired and revoked signed tokens
+        are refused
+        """
+        token = self._signed_token()
+        self.url = reverse("customer-list")
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer {}x".format(token))
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, response.status_code)
+        with override_settings(SIGNED_TOKEN_TTL=-1):
+            expired = self._signed_token()
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer {}".format(expired))
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, response.status_code)
+        response = self.client.delete("/auth", HTTP_AUTHORIZATION="Bearer {}".format(token))
+        self.assertEqual(200, response.status_code)
+        response = self.client.get(self.url, HTTP_AUTHORIZATION="Bearer {}".format(token))
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, response.status_code)
+
+
+    def test_signed_token_revocation_kept(self):
+        """
+        This test case checks if revoked tokens are kept apart from the catalog
+        cache, and only removed from the state cache files once expired
+        """
+        token = self._signed_token()
+        response = self.client.delete("/auth", HTTP_AUTHORIZATION="Bearer {}".format(token))
+        self.assertEqual(200, response.status_code)
+        caches["default"].clear()
+        response = self.client.get(reverse("customer-list"), HTTP_AUTHORIZATION="Bearer {}".format(token))
+        self.assertEqual(status.HTTP_401_UNAUTHORIZED, response.status_code)
+        with tempfile.TemporaryDirectory() as directory:
+            cache = ExpiringFileBasedCache(directory, {"OPTIONS": {"MAX_ENTRIES": 2}})
+            cache.set("signed-token:revoked:1", True, 3600)
+            cache.set("replica:pin:1", True, 0)
+            for i in range(10):
+                cache.set("catalog:{}".format(i), i, 3600)
+            self.assertTrue(cache.get("signed-token:revoked:1"))
+            self.assertEqual(11, len(cache._list_cache_files()))
+    # END Testing signed tokens
+
+
+    # Testing read replicas
+    def test_replica_reads_after_write(self):
+        """
+        This test case checks if safe requests may read from a replica, except
+        right after the same client wrote
+        """
+        allowed = []
+        def db_for_read(self, model, **hints):
+            if model is Customer:
+                allowed.append(replica_reads_allowed())
+        with mock.patch.object(ReplicaRouter, "db_for_read", db_for_read):
+            self.client.get(reverse("customer-list"), **self.auth_headers)
+            self.assertTrue(allowed and all(allowed))
+            self._create_model("customer", self.customer_data, ["name"])
+            allowed.clear()
+            self.client.get(reverse("customer-list"), **self.auth_headers)
+            self.assertTrue(allowed and not any(allowed))
+
+
+    def test_replica_catalog_cache_fill(self):
+        """
+        This test case checks if catalog cache fills read from the primary, so a
+        replica lagging behind a bumped generation is never cached
+        """
+        id = self._create_model("product", self.product_data, ["name"])
+        self._update_model("product", id, dict(self.product_data, name="Dental floss"), ["name"])
+        allowed, filling = [], []
+        def db_for_read(self, model, **hints):
+            if model is Product and filling:
+                allowed.append(replica_reads_allowed())
+        get_or_fill = CatalogCache.get_or_fill
+        def recorded_get_or_fill(self, key, fill):
+            def recorded_fill():
+                filling.append(key)
+                try:
+                    return fill()
+                finally:
+                    filling.pop()
+            return get_or_fill(self, key, recorded_fill)
+        # a client that did not write: its reads may go to a replica
+        with mock.patch.object(ReplicaRouter, "db_for_read", db_for_read), mock.patch.object(CatalogCache, "get_or_fill", recorded_get_or_fill), \
+                mock.patch("api.views.is_pinned_to_primary", return_value=False):
+            detail = self.client.get(reverse("product-detail", kwargs={"pk": id}), **self.auth_headers)
+            listed = self.client.get(reverse("product-list"), **self.auth_headers)
+            searched = self.client.get(reverse("product-search") + "?q=floss", **self.auth_headers)
+        self.assertEqual("Dental floss", detail.json()["name"])
+        self.assertEqual(200, listed.status_code)
+        self.assertEqual(200, searched.status_code)
+        self.assertTrue(allowed and not any(allowed))
+    # END Testing read replicas
+
+
+    # Testing exports
+    def test_invoice_item_export_csv(self):
+        """
+        This test case checks if invoice's items are streamed as CSV with their
+        customer and product columns
+        """
+        self._seed_rows(3)
+        response = self.client.get(reverse("export-invoiceitems"), **self.auth_headers)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.streaming)
+        rows = list(csv.DictReader(io.StringIO(b"".join(response.streaming_content).decode())))
+        self.assertEqual(3, len(rows))
+        self.assertEqual(self.product_data["name"], rows[0]["product_name"])
+        self.assertEqual(self.customer_data["name"], rows[0]["customer_name"])
+
+
+    def test_invoice_export_ndjson_date_range(self):
+        """
+        This test case checks if invoices are streamed as NDJSON, filtered by
+        purchase date
+        """
+        self._seed_rows(2)
+        old = Invoice.objects.first()
+        Invoice.objects.filter(id=old.id).update(purchase_date=old.purchase_date - datetime.timedelta(days=10))
+        today = timezone.now().date().isoformat()
+        self.url = reverse("export-invoices") + "?output=ndjson&start={}&end={}".format(today, today)
+        response = self.client.get(self.url, **self.auth_headers)
+        self.assertEqual(200, response.status_code)
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(1, len(rows))
+        self.assertNotEqual(old.id, rows[0]["id"])
+        self.assertEqual(self.customer_data["email"], rows[0]["customer_email"])
+        response = self.client.get(reverse("export-invoices") + "?start=yesterday", **self.auth_headers)
+        self.assertEqual(400, response.status_code)
+    # END Testing exports
+
+
+    # Testing bulk imports
+    def test_import_products(self):
+        """
+        This test case checks if products are imported in batches, rejected rows
+        are written aside and existing ones are upserted by external_id
+        """
+        folder = tempfile.mkdtemp()
+        path = os.path.join(folder, "products.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["external_id", "name", "description", "image_link", "price"])
+            writer.writerow(["SKU-1", "Tooth paste", "Protects the enamel", "https://img/1.jpg", "0.99"])
+            writer.writerow(["SKU-2", "Tooth brush", "Soft", "https://img/2.jpg", "not a price"])
+            writer.writerow(["SKU-3", "Dental floss", "Mint", "https://img/3.jpg", "2.5"])
+        out = io.StringIO()
+        call_command("import_products", path, batch_size=2, stdout=out)
+        self.assertIn("2 created, 0 updated, 1 rejected", out.getvalue())
+        with open(path + ".rejects.jsonl") as f:
+            rejects = [json.loads(line) for line in f]
+        self.assertEqual(3, rejects[0]["line"])
+        self.assertIn("price", rejects[0]["errors"])
+        path = os.path.join(folder, "products.jsonl")
+        with open(path, "w") as f:
+            f.write(json.dumps({"external_id": "SKU-3", "name": "Dental floss", "description": "Mint", "image_link": "https://img/3.jpg", "price": 3.0}) + "\n")
+            f.write(json.dumps({"external_id": "SKU-4", "name": "Mouthwash", "description": "Fresh", "image_link": "https://img/4.jpg", "price": 4.0}) + "\n")
+        out = io.StringIO()
+        call_command("import_products", path, upsert=True, stdout=out)
+        self.assertIn("1 created, 1 updated, 0 rejected", out.getvalue())
+        self.assertFalse(os.path.exists(path + ".rejects.jsonl"))
+        self.assertEqual(3.0, Product.objects.get(external_id="SKU-3").price)
+        self.assertEqual(3, Product.objects.count())
+
+
+    def test_import_customers_rejects_existing_without_upsert(self):
+        """
+        This test case checks if importing an existing customer is rejected
+        unless upserting
+        """
+        Customer.objects.create(external_id="C-1", **self.customer_data)
+        path = os.path.join(tempfile.mkdtemp(), "customers.jsonl")
+        with open(path, "w") as f:
+            f.write(json.dumps({"external_id": "C-1", **self.customer_data}) + "\n")
+            f.write("{not json\n")
+        out = io.StringIO()
+        call_command("import_customers", path, stdout=out)
+        self.assertIn("0 created, 0 updated, 2 rejected", out.getvalue())
+
+
+    def test_import_counts_duplicate_keys(self):
+        """
+        This test case checks if rows repeating a key within a batch are
+        counted as duplicates and written aside, the last one being imported
+        """
+        path = os.path.join(tempfile.mkdtemp(), "customers.jsonl")
+        with open(path, "w") as f:
+            for name in ("First", "Second", "Third"):
+                f.write(json.dumps({**self.customer_data, "external_id": "C-1", "name": name}) + "\n")
+            f.write(json.dumps({**self.customer_data, "external_id": "C-2"}) + "\n")
+        out = io.StringIO()
+        call_command("import_customers", path, stdout=out)
+        self.assertIn("4 rows: 2 created, 0 updated, 0 rejected, 2 duplicate", out.getvalue())
+        self.assertEqual("Third", Customer.objects.get(external_id="C-1").name)
+        with open(path + ".rejects.jsonl") as f:
+            self.assertEqual([1, 2], [json.loads(line)["line"] for line in f])
+    # END Testing bulk imports
+
+
+    # Testing sales rollups
+    def _sell(self, product, days_ago=0, quantity=1, quote_price=10.0, discount_value=1.0):
+        customer = Customer.objects.create(**self.customer_data)
+        invoice = Invoice.objects.create(customer=customer)
+        Invoice.objects.filter(id=invoice.id).update(purchase_date=timezone.now() - datetime.timedelta(days=days_ago))
+        return InvoiceItem.objects.create(
+            invoice=invoice, product=product, quantity=quantity, quote_price=quote_price, discount_value=discount_value
+        )
+
+
+    def test_refresh_sales_rollups(self):
+        """
+        This test case checks if the refresh command only adds the items created
+        since its last run, and if a rebuild gives the same rollups
+        """
+        product = Product.objects.create(**self.product_data)
+        self._sell(product, quantity=2)
+        self._sell(product, days_ago=40)
+        out = io.StringIO()
+        call_command("refresh_sales_rollups", chunk_size=1, stdout=out)
+        self.assertIn("Added 2 invoice's items", out.getvalue())
+        item = self._sell(product, quantity=3)
+        call_command("refresh_sales_rollups", stdout=out)
+        self.assertEqual(item.id, RollupState.objects.get(name="sales").high_water_mark)
+        today = ProductDailySales.objects.get(product=product, day=timezone.now().date())
+        self.assertEqual((5, 50.0, 2.0), (today.quantity, today.gross_value, today.discount))
+        self.assertEqual(2, ProductDailySales.objects.count())
+        self.assertEqual(3, CustomerMonthlySales.objects.count())
+        self.assertEqual(3, CustomerMonthlySales.objects.filter(month__day=1).count())
+        expected = list(ProductDailySales.objects.order_by("day").values("day", *SALES))
+        ProductDailySales.objects.update(quantity=0)
+        call_command("refresh_sales_rollups", rebuild=True, stdout=out)
+        self.assertEqual(expected, list(ProductDailySales.objects.order_by("day").values("day", *SALES)))
+
+
+    def test_product_sales_range(self):
+        """
+        This test case checks if product sales are listed and summed over a
+        day range from the rollup, without touching the invoice's items
+        """
+        product = Product.objects.create(**self.product_data)
+        other = Product.objects.create(**self.product_data)
+        self._sell(product, quantity=2)
+        self._sell(product, days_ago=10)
+        self._sell(other)
+        call_command("refresh_sales_rollups", stdout=io.StringIO())
+        start = (timezone.now() - datetime.timedelta(days=1)).date().isoformat()
+        self.url = reverse("product-sales-list") + "?start={}&product={}".format(start, product.id)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, **self.auth_headers)
+        self.assertEqual(200, response.status_code)
+        self.assertFalse([q for q in queries if "api_invoiceitem" in q["sql"]])
+        results = response.json()["results"]
+        self.assertEqual(1, len(results))
+        self.assertEqual(2, results[0]["quantity"])
+        self.url = reverse("product-sales-totals") + "?product={}".format(product.id)
+        response = self.client.get(self.url, **self.auth_headers)
+        self.assertEqual({"quantity": 3, "gross_value": 30.0, "discount": 2.0, "net_value": 28.0}, response.json())
+        response = self.client.get(reverse("customer-sales-totals") + "?end=yesterday", **self.auth_headers)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual({"message": "Error! end must be a YYYY-MM-DD date!"}, response.json())
+        response = self.client.get(reverse("product-sales-list") + "?product=abc", **self.auth_headers)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual({"message": "Error! product must be an id!"}, response.json())
+    # END Testing sales rollups
+
+
+    # Testing product search
+    def test_product_search(self):
+        """
+        This test case checks if products are found by their words, the last
+        one as a prefix, best match first and paginated
+        """
+        names = ["Running shoes", "Trail running shoes", "Rain jacket", "Café table"]
+        ids = [Product.objects.create(**{**self.product_data, "name": name}).id for name in names]
+        Product.objects.filter(id=ids[0]).update(name="Running sneakers")
+        Product.objects.filter(id=ids[2]).delete()
+        self.url = reverse("product-search")
+        response = self.client.get(self.url + "?q=run", **self.auth_headers)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([ids[0], ids[1]], sorted(r["id"] for r in response.json()["results"]))
+        response = self.client.get(self.url + "?q=RUNNING+sho&limit=1", **self.auth_headers)
+        results = response.json()["results"]
+        self.assertEqual([ids[1]], [r["id"] for r in results])
+        self.assertIsNone(response.json()["next"])
+        response = self.client.get(self.url + "?q=cafe", **self.auth_headers)
+        self.assertEqual([ids[3]], [r["id"] for r in response.json()["results"]])
+        response = self.client.get(self.url + "?q=rain", **self.auth_headers)
+        self.assertEqual([], response.json()["results"])
+        response = self.client.get(self.url + "?q=run&limit=x", **self.auth_headers)
+        self.assertEqual(400, response.status_code)
+
+
+    def test_product_search_ranks_name_first(self):
+        """
+        This test case checks if a word in the name ranks above the same word
+        in the description, and the next link pages through the results
+        """
+        in_description = Product.objects.create(**{**self.product_data, "description": "A lamp for the desk"})
+        in_name = Product.objects.create(**{**self.product_data, "name": "Desk"})
+        response = self.client.get(reverse("product-search") + "?q=desk&limit=1", **self.auth_headers)
+        self.assertEqual([in_name.id], [r["id"] for r in response.json()["results"]])
+        response = self.client.get(response.json()["next"], **self.auth_headers)
+        self.assertEqual([in_description.id], [r["id"] for r in response.json()["results"]])
+        self.assertIsNone(response.json()["next"])
+
+
+    def test_product_search_flags_truncated_results(self):
+        """
+        This test case checks if every match is ranked up to SEARCH_MAX_RANKED,
+        and if results are flagged as truncated beyond it
+        """
+        ids = [Product.objects.create(**{**self.product_data, "name": "Desk lamp"}).id for i in range(3)]
+        in_name = Product.objects.create(**{**self.product_data, "name": "Desk"}).id
+        Product.objects.filter(id=ids[0]).update(description="Desk")
+        self.url = reverse("product-search") + "?q=desk"
+        with override_settings(SEARCH_MAX_RANKED=4):
+            response = self.client.get(self.url, **self.auth_headers)
+        self.assertFalse(response.json()["truncated"])
+        # the oldest match, ranked first for its name and description hits
+        self.assertEqual([ids[0], in_name], [r["id"] for r in response.json()["results"]][:2])
+        catalog_cache.bump()
+        with override_settings(SEARCH_MAX_RANKED=3):
+            response = self.client.get(self.url, **self.auth_headers)
+        self.assertTrue(response.json()["truncated"])
+        self.assertEqual([in_name, ids[2], ids[1]], [r["id"] for r in response.json()["results"]])
+
+
+    def test_product_search_without_fts(self):
+        """
+        This test case checks if the in-memory index answers the search on
+        backends without FTS5 and follows product changes
+        """
+        product_index.reset()
+        product = Product.objects.create(**{**self.product_data, "name": "Running shoes"})
+        with mock.patch("api.search.has_fts", return_value=False):
+            response = self.client.get(reverse("product-search") + "?q=runn", **self.auth_headers)
+            self.assertEqual([product.id], [r["id"] for r in response.json()["results"]])
+            Product.objects.filter(id=product.id).update(name="Rain jacket", updated_at=timezone.now())
+            catalog_cache.bump()
+            response = self.client.get(reverse("product-search") + "?q=rain", **self.auth_headers)
+            self.assertEqual([product.id], [r["id"] for r in response.json()["results"]])
+            product.delete()
+            response = self.client.get(reverse("product-search") + "?q=rain", **self.auth_headers)
+            self.assertEqual([], response.json()["results"])
+
+
+    @unittest.skipUnless(connection.vendor == "sqlite", "FTS5 index")
+    def test_product_search_triggers_are_repaired(self):
+        """
+        This test case checks if missing search triggers, dropped when SQLite
+        remakes the product table, are put back and the index rebuilt
+        """
+        product = Product.objects.create(**self.product_data)
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER api_product_fts_update")
+        Product.objects.filter(id=product.id).update(name="Espresso machine")
+        self.assertEqual([], search_products("espresso", 10))
+        install_product_fts(connection)
+        self.assertEqual([product.id], search_products("espresso", 10))
+    # END Testing product search
+
+
+    # Testing filters
+    def _list_ids(self, model, query, expected_status=200):
+        response = self.client.get(reverse("{}-list".format(model)) + query, **self.auth_headers)
+        self.assertEqual(expected_status, response.status_code)
+        return [r["id"] for r in response.json()["results"]] if expected_status == 200 else response.json()
+
+
+    def test_invoices_of_customer_between_dates(self):
+        """
+        This test case checks if invoices are filtered by customer and an
+        inclusive purchase date range, and ordered on request
+        """
+        self._seed_rows(3)
+        customer = Customer.objects.create(**self.customer_data)
+        invoices = [Invoice.objects.create(customer=customer) for _ in range(3)]
+        for days, invoice in zip((10, 5, 0), invoices):
+            Invoice.objects.filter(id=invoice.id).update(purchase_date=timezone.now() - datetime.timedelta(days=days))
+        start = (timezone.now() - datetime.timedelta(days=5)).date().isoformat()
+        end = timezone.now().date().isoformat()
+        query = "?customer={}&start={}&end={}&ordering=purchase_date".format(customer.id, start, end)
+        self.assertEqual([invoices[1].id, invoices[2].id], self._list_ids("invoice", query))
+        query = "?customer={}&ordering=-purchase_date".format(customer.id)
+        self.assertEqual(invoices[2].id, self._list_ids("invoice", query)[0])
+        self.assertIn("message", self._list_ids("invoice", "?customer=abc", 400))
+        self.assertIn("message", self._list_ids("invoice", "?start=2026-02-30", 400))
+
+
+    def test_open_carts_and_customer_by_email(self):
+        """
+        This test case checks if carts are filtered by is_closed and customers
+        by email
+        """
+        self._seed_rows(3)
+        closed = ShoppingCart.objects.first()
+        ShoppingCart.objects.filter(id=closed.id).update(is_closed=True)
+        self.assertEqual([closed.id], self._list_ids("shoppingcart", "?is_closed=true"))
+        self.assertNotIn(closed.id, self._list_ids("shoppingcart", "?is_closed=false"))
+        self.assertIn("message", self._list_ids("shoppingcart", "?is_closed=maybe", 400))
+        customer = Customer.objects.create(**{**self.customer_data, "email": "someone@test.case"})
+        self.assertEqual([customer.id], self._list_ids("customer", "?email=someone@test.case"))
+
+
+    def test_unindexed_ordering_is_rejected(self):
+        """
+        This test case checks if ordering on a field missing from the whitelist
+        is rejected, and if the check flags declarations no index backs
+        """
+        self.assertIn("message", self._list_ids("customer", "?ordering=name", 400))
+        self.assertEqual([], check_indexed_filters(None))
+        with mock.patch.object(CustomerViewSet, "indexed_filters", {"phone": "phone"}):
+            self.assertEqual(["api.E001"], [error.id for error in check_indexed_filters(None)])
+    # END Testing filters
+
+
+    # Testing sparse fieldsets
+    def test_sparse_fields_and_expand(self):
+        """
+        This test case checks if ?fields= trims the payload, nested fields
+        included, and if relations left out of ?expand= render as ids
+        """
+        self._seed_rows(2)
+        item = InvoiceItem.objects.first()
+        self.url = reverse("invoiceitem-detail", kwargs={"pk": item.id})
+        response = self.client.get(self.url + "?fields=id,quantity,product.name&expand=product", **self.auth_headers)
+        self.assertEqual({"id": item.id, "quantity": 1, "product": {"name": self.product_data["name"]}}, response.json())
+        response = self.client.get(self.url + "?expand=", **self.auth_headers)
+        self.assertEqual((item.invoice_id, item.product_id), (response.json()["invoice"], response.json()["product"]))
+        response = self.client.get(self.url + "?expand=invoice", **self.auth_headers)
+        self.assertEqual(item.invoice.customer_id, response.json()["invoice"]["customer"])
+        self.assertEqual(item.product_id, response.json()["product"])
+        response = self.client.get(self.url, **self.auth_headers)
+        self.assertEqual(self.customer_data["name"], response.json()["invoice"]["customer"]["name"])
+
+
+    def test_sparse_fields_select_less(self):
+        """
+        This test case checks if the list query only joins the expanded
+        relations and only selects the rendered columns
+        """
+        self._seed_rows(3)
+        self.url = reverse("invoiceitem-list") + "?fields=id,quantity,product&expand="
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, **self.auth_headers)
+        self.assertEqual({"id", "quantity", "product"}, set(response.json()["results"][0]))
+        [query] = [q["sql"] for q in queries if 'FROM "api_invoiceitem"' in q["sql"]]
+        self.assertNotIn("JOIN", query)
+        self.assertNotIn("discount_value", query)
+        self.url = reverse("invoiceitem-list") + "?fields=id,product.name"
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.url, **self.auth_headers)
+        [query] = [q["sql"] for q in queries if 'FROM "api_invoiceitem"' in q["sql"]]
+        self.assertNotIn('"api_product"."description"', query)
+        self.assertNotIn('"api_invoice"', query)
+        # the embedded products are read on their own, as fragments
+        [query] = [q["sql"] for q in queries if 'FROM "api_product"' in q["sql"]]
+        self.assertIn('"api_product"."name"', query)
+        self.assertNotIn('"api_product"."description"', query)
+    # END Testing sparse fieldsets
+
+
+    # Testing fast read path
+    def test_fast_list_matches_serializer(self):
+        """
+        This test case checks if list pages rendered from values() rows are
+        byte for byte the serializer's output, nulls and sparse fieldsets included
+        """
+        self._seed_rows(3)
+        InvoiceItem.objects.filter(id=InvoiceItem.objects.first().id).update(quote_price=None)
+        queries = ["", "?expand=", "?expand=invoice&fields=id,invoice.customer,invoice.total_value,quote_price"]
+        for model in ["customer", "product", "invoice", "invoiceitem", "shoppingcart"]:
+            for query in queries:
+                self.url = reverse("{}-list".format(model)) + query
+                fast = self.client.get(self.url, **self.auth_headers)
+                with mock.patch.object(FastReadMixin, "get_read_plan", return_value=None):
+                    catalog_cache.bump()
+                    slow = self.client.get(self.url, **self.auth_headers)
+                self.assertEqual(200, fast.status_code)
+                self.assertEqual(slow.content, fast.content, self.url)
+        # every list above went through a compiled plan
+        self.assertNotIn(None, FastReadMixin._read_plans.values())
+    # END Testing fast read path
+
+
+    # Testing fragment cache
+    def test_fragments_are_cached_and_invalidated(self):
+        """
+        This test case checks if embedded objects are served from the fragment
+        cache, and rendered again once their product, customer or invoice changes
+        """
+        self._seed_rows(2)
+        item = InvoiceItem.objects.first()
+        self.url = reverse("invoiceitem-list")
+        cold = self.client.get(self.url, **self.auth_headers)
+        with CaptureQueriesContext(connection) as queries:
+            warm = self.client.get(self.url, **self.auth_headers)
+        self.assertEqual(cold.content, warm.content)
+        self.assertEqual(1, len([q for q in queries if "api_" in q["sql"]]))
+        self.assertEqual(self.product_data["name"], warm.data["results"][0]["product"]["name"])
+        url = reverse("product-detail", kwargs={"pk": item.product_id})
+        self.client.patch(url, {"name": "Renamed"}, content_type="application/json", **self.auth_headers)
+        url = reverse("customer-detail", kwargs={"pk": item.invoice.customer_id})
+        self.client.patch(url, {"name": "Renamed too"}, content_type="application/json", **self.auth_headers)
+        url = reverse("invoiceitem-list")
+        data = {"invoice_id": item.invoice_id, "product_id": item.product_id, "quantity": 2, "quote_price": 1.5, "discount_value": 0.0}
+        self.client.post(url, data, content_type="application/json", **self.auth_headers)
+        results = {r["id"]: r for r in self.client.get(self.url, **self.auth_headers).json()["results"]}
+        self.assertEqual("Renamed", results[item.id]["product"]["name"])
+        self.assertEqual("Renamed too", results[item.id]["invoice"]["customer"]["name"])
+        self.assertEqual(Invoice.objects.get(id=item.invoice_id).total_value, results[item.id]["invoice"]["total_value"])
+
+
+    @override_settings(FRAGMENT_CACHE_MAX_BYTES=700)
+    def test_fragment_cache_evicts_least_recently_used(self):
+        """
+        This test case checks if the fragment cache stays under its size cap
+        by evicting the least recently used fragments
+        """
+        cache = FragmentCache()
+        cache.set_many({"a": b"a" * 100, "b": b"b" * 100})
+        self.assertEqual({"a": b"a" * 100}, cache.get_many(["a"]))
+        cache.set_many({"c": b"c" * 100})
+        self.assertEqual({"a", "c"}, set(cache.get_many(["a", "b", "c"])))
+        self.assertLessEqual(cache.size, 700)
+    # END Testing fragment cache
+
+
+    # Testing docs and compression
+    def test_docs_are_precompressed_and_cacheable(self):
+        """
+        This test case checks if the OpenAPI schema is served with a gzip
+        variant, a strong ETag per variant, a long Cache-Control and 304 on
+        a matching If-None-Match
+        """
+        plain = self.client.get(reverse("openapi-schema"))
+        self.assertEqual(200, plain.status_code)
+        self.assertTrue(plain.content.startswith(b"openapi:"))
+        self.assertIn("max-age=", plain["Cache-Control"])
+        self.assertIn("Accept-Encoding", plain["Vary"])
+        zipped = self.client.get(reverse("openapi-schema"), HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual("gzip", zipped["Content-Encoding"])
+        self.assertEqual(plain.content, gzip.decompress(zipped.content))
+        self.assertNotEqual(plain["ETag"], zipped["ETag"])
+        self.assertFalse(zipped["ETag"].startswith("W/"))
+        again = self.client.get(reverse("openapi-schema"), HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=zipped["ETag"])
+        self.assertEqual(304, again.status_code)
+        refused = self.client.get(reverse("openapi-schema"), HTTP_ACCEPT_ENCODING="gzip;q=0, identity")
+        self.assertFalse(refused.has_header("Content-Encoding"))
+        page = self.client.get(reverse("swagger-ui"))
+        self.assertIn(reverse("openapi-schema"), page.content.decode())
+
+
+    def test_docs_warmed_at_startup(self):
+        """
+        This test case checks if the precompiled pages of the URLconf are
+        rendered by warm_precompiled_templates, before any request
+        """
+        with mock.patch.object(PrecompiledTemplateView, "_variants", {}):
+            warm_precompiled_templates()
+            self.assertEqual({"swagger-ui.html", "docs.yml"}, {key[0] for key in PrecompiledTemplateView._variants})
+            with mock.patch("api.views.render_to_string") as render:
+                self.assertEqual(200, self.client.get(reverse("openapi-schema")).status_code)
+            self.assertFalse(render.called)
+
+
+    @override_settings(COMPRESSION_MIN_BYTES=2048)
+    def test_api_responses_are_compressed(self):
+        """
+        This test case checks if JSON responses over the size threshold and
+        streaming exports are compressed, and smaller ones are not
+        """
+        self._seed_rows(10)
+        response = self.client.get(reverse("invoiceitem-list"), HTTP_ACCEPT_ENCODING="gzip", **self.auth_headers)
+        self.assertEqual("gzip", response["Content-Encoding"])
+        self.assertEqual(10, len(json.loads(gzip.decompress(response.content))["results"]))
+        response = self.client.get(reverse("health-check"), HTTP_ACCEPT_ENCODING="gzip", **self.auth_headers)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        response = self.client.get(reverse("export-invoiceitems"), HTTP_ACCEPT_ENCODING="gzip", **self.auth_headers)
+        self.assertEqual("gzip", response["Content-Encoding"])
+        rows = list(csv.DictReader(io.StringIO(gzip.decompress(b"".join(response.streaming_content)).decode())))
+        self.assertEqual(10, len(rows))
+
+
+    @override_settings(COMPRESSION_MIN_BYTES=0)
+    def test_compressed_etags_stay_strong(self):
+        """
+        This test case checks if a compressed response has a strong ETag
+        naming its encoding, which If-None-Match and If-Match accept back
+        """
+        id = self._create_model("product", self.product_data, ["name"])
+        self.url = reverse("product-detail", kwargs={"pk": id})
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip", **self.auth_headers)
+        self.assertEqual("gzip", response["Content-Encoding"])
+        etag = response["ETag"]
+        self.assertRegex(etag, r'^"[0-9a-f]+-gzip"$')
+        response = self.client.get(self.url, HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_304_NOT_MODIFIED, response.status_code)
+        self.assertEqual(etag, response["ETag"])
+        data = {**self.product_data, "name": "Changed the name"}
+        response = self.client.put(self.url, data, content_type="application/json", HTTP_ACCEPT_ENCODING="gzip",
+                                   HTTP_IF_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_200_OK, response.status_code)
+        response = self.client.put(self.url, data, content_type="application/json", HTTP_ACCEPT_ENCODING="gzip",
+                                   HTTP_IF_MATCH=etag, **self.auth_headers)
+        self.assertEqual(status.HTTP_412_PRECONDITION_FAILED, response.status_code)
+    # END Testing docs and compression
+
+
+    # Testing traffic capture
+    def test_traffic_capture_and_replay(self):
+        """
+        This test case checks if sampled requests are written as JSON lines,
+        with their body redacted, and replayed with per route statistics
+        """
+        self._seed_rows(2)
+        path = os.path.join(tempfile.mkdtemp(), "traffic.jsonl")
+        with override_settings(TRAFFIC_CAPTURE_RATE=1.0, TRAFFIC_CAPTURE_PATH=path):
+            self.client.get(reverse("invoiceitem-list") + "?page_size=1", **self.auth_headers)
+            self.client.post(reverse("customer-list"), dict(self.customer_data, token="secret"),
+                             content_type="application/json", **self.auth_headers)
+            self.client.get(reverse("swagger-ui"))
+            get_writer(path).flush()
+        with open(path) as file:
+            records = [json.loads(line) for line in file]
+        self.assertEqual(["GET", "POST"], [r["method"] for r in records])
+        self.assertEqual(("invoiceitem-list", "page_size=1", 200), (records[0]["route"], records[0]["query"], records[0]["status"]))
+        self.assertEqual(User.objects.get(username=self.auth_user["username"]).id, records[0]["user"])
+        self.assertEqual("***", json.loads(records[1]["body"])["token"])
+        out = io.StringIO()
+        call_command("replay_traffic", path, "--writes", "--concurrency", "1",
+                     "--token", self.auth_headers["HTTP_AUTHORIZATION"], stdout=out)
+        report = {line.split()[0]: line.split() for line in out.getvalue().splitlines()[1:]}
+        self.assertEqual({"invoiceitem-list", "customer-list", "all"}, set(report))
+        self.assertEqual(("2", "0.0%"), (report["all"][1], report["all"][-1]))
+    # END Testing traffic capture
+
+
+    # Testing query timing
+    def test_server_timing_counts_queries(self):
+        """
+        This test case checks if responses carry the query count and time of
+        the request in a Server-Timing header
+        """
+        self._seed_rows(3)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("invoice-list"), **self.auth_headers)
+        timing = dict(re.findall(r'(\w[\w-]*);dur=[\d.]+;desc="(\d+) queries"', response["Server-Timing"]))
+        self.assertEqual({"db": str(len(queries))}, timing)
+        self.assertIn("app;dur=", response["Server-Timing"])
+        self.assertNotIn("n-plus-1", response["Server-Timing"])
+
+
+    def test_repeated_queries_are_flagged(self):
+        """
+        This test case checks if a query shape run once per row (N+1) is
+        reported in the Server-Timing header and logged as a warning
+        """
+        self._seed_rows(5)
+        items = [
+            {"invoice_id": invoice_id, "product_id": Product.objects.first().id, "quantity": 1, "discount_value": 0.0}
+            for invoice_id in Invoice.objects.values_list("id", flat=True)
+        ]
+        with self.assertLogs("api.queries", "WARNING") as logs:
+            response = self.client.post(reverse("invoiceitem-list"), items, content_type="application/json", **self.auth_headers)
+        self.assertEqual(201, response.status_code)
+        self.assertIn('n-plus-1;desc="1 shapes, up to 5x"', response["Server-Timing"])
+        [record] = logs.records
+        self.assertEqual("invoiceitem-list", record.route)
+        self.assertIn('UPDATE "api_invoice"', record.repeated_queries[0]["sql"])
+    # END Testing query timing
+
+
+    # Testing metrics
+    def _scrape(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return dict(line.rsplit(" ", 1) for line in response.content.decode().splitlines() if not line.startswith("#"))
+
+
+    def test_metrics_endpoint(self):
+        """
+        This test case checks if /metrics exposes request counts and latency
+        histograms by route name and status, query counts, cache hit ratios
+        and in-flight requests in the Prometheus text format
+        """
+        with override_settings(METRICS_DIR=tempfile.mkdtemp()):
+            before = self._scrape()
+            for _ in range(2):
+                self.client.get(reverse("customer-list"), **self.auth_headers)
+                self.client.get(reverse("product-list"), **self.auth_headers)
+            after = self._scrape()
+        requests = 'http_requests_total{route="customer-list",method="GET",status="200"}'
+        self.assertEqual(2, float(after[requests]) - float(before.get(requests, 0)))
+        labels = '{route="customer-list",status="200",le="+Inf"}'
+        self.assertEqual(after['http_request_duration_seconds_count{route="customer-list",status="200"}'],
+                         after["http_request_duration_seconds_bucket" + labels])
+        self.assertGreater(float(after['db_queries_total{route="customer-list"}']), 0)
+        self.assertIn('cache_hit_ratio{cache="catalog"}', after)
+        # the scrape itself
+        self.assertEqual("1", after["http_requests_in_flight"])
+
+
+    def test_metrics_method_label(self):
+        """
+        This test case checks if non-standard request methods are counted
+        under a single "other" method label
+        """
+        with override_settings(METRICS_DIR=tempfile.mkdtemp()):
+            before = self._scrape()
+            for method in ("FOO", "BAR"):
+                self.client.generic(method, reverse("customer-list"), **self.auth_headers)
+            after = self._scrape()
+        requests = 'http_requests_total{route="customer-list",method="other",status="405"}'
+        self.assertEqual(2, float(after[requests]) - float(before.get(requests, 0)))
+        self.assertFalse([name for name in after if 'method="FOO"' in name or 'method="BAR"' in name])
+
+
+    def test_metrics_merge_workers(self):
+        """
+        This test case checks if the scrape adds up the metrics stored by the
+        other workers, folding the exited ones into the archive without their gauges
+        """
+        directory = tempfile.mkdtemp()
+        exited = subprocess.Popen(["true"])
+        exited.wait()
+        requests = ("http_requests_total", (("route", "customer-list"), ("method", "GET"), ("status", "200")))
+        in_flight = ("http_requests_in_flight", ())
+        with override_settings(METRICS_DIR=directory):
+            local = metrics.collect()
+            metrics.write_series(os.path.join(directory, "{}.json".format(os.getppid())), {requests: 5, in_flight: 2})
+            metrics.write_series(os.path.join(directory, "{}.json".format(exited.pid)), {requests: 7, in_flight: 3})
+            merged = metrics.collect()
+            self.assertEqual(local[requests] + 12, merged[requests])
+            self.assertEqual(local[in_flight] + 2, merged[in_flight])
+            self.assertFalse(os.path.exists(os.path.join(directory, "{}.json".format(exited.pid))))
+            self.assertEqual(merged, metrics.collect())
+
+
+    def test_metrics_for_internal_callers_only(self):
+        """
+        This test case checks if /metrics is off by default and only answers
+        internal callers reaching the server directly, with the token when set
+        """
+        url = reverse("metrics")
+        self.assertEqual(404, self.client.get(url).status_code)
+        with override_settings(METRICS_DIR=tempfile.mkdtemp()):
+            self.assertEqual(200, self.client.get(url, REMOTE_ADDR="10.1.2.3").status_code)
+            self.assertEqual(403, self.client.get(url, REMOTE_ADDR="203.0.113.7").status_code)
+            self.assertEqual(403, self.client.get(url, HTTP_X_FORWARDED_FOR="203.0.113.7").status_code)
+            with override_settings(METRICS_TOKEN="scrape"):
+                self.assertEqual(403, self.client.get(url).status_code)
+                self.assertEqual(403, self.client.get(url, HTTP_AUTHORIZATION="Bearer other").status_code)
+                self.assertEqual(200, self.client.get(url, HTTP_AUTHORIZATION="Bearer scrape").status_code)
+    # END Testing metrics
+
+
+    # Testing profiling
+    def test_profiling_with_signed_header(self):
+        """
+        This test case checks if a request with a valid signed X-Profile header
+        is profiled, to collapsed stacks and a summary, and others are not
+        """
+        directory = tempfile.mkdtemp()
+        self._seed_rows(3)
+        with override_settings(PROFILING_DIR=directory):
+            response = self.client.get(reverse("invoiceitem-list"), **self.auth_headers)
+            self.assertNotIn("X-Profile-Id", response)
+            response = self.client.get(reverse("invoiceitem-list"), HTTP_X_PROFILE="profile:forged", **self.auth_headers)
+            self.assertNotIn("X-Profile-Id", response)
+            output = io.StringIO()
+            call_command("profiling_token", stdout=output, stderr=io.StringIO())
+            response = self.client.get(reverse("invoiceitem-list"), HTTP_X_PROFILE=output.getvalue().strip(), **self.auth_headers)
+        self.assertEqual(200, response.status_code)
+        name = response["X-Profile-Id"]
+        self.assertEqual({name + ".folded", name + ".txt"}, set(os.listdir(directory)))
+        with open(os.path.join(directory, name + ".txt")) as file:
+            summary = file.read()
+        self.assertTrue(summary.startswith("GET /api/invoiceitems/ -> 200 (invoiceitem-list)\n"))
+        with open(os.path.join(directory, name + ".folded")) as file:
+            stacks = file.read().splitlines()
+        for line in stacks:
+            self.assertRegex(line, r"^[^;]+ \(.+:\d+\)(;[^;]+ \(.+:\d+\))* \d+$")
+        samples = int(re.search(r"(\d+) samples", summary).group(1))
+        self.assertEqual(samples, sum(int(line.rsplit(" ", 1)[1]) for line in stacks))
+
+
+    def test_profiling_by_staff_keeps_last_profiles(self):
+        """
+        This test case checks if staff users can ask for a profile with
+        ?profile=1, other users can't, and only the last
+        PROFILING_MAX_PROFILES profiles are kept
+        """
+        directory = tempfile.mkdtemp()
+        with override_settings(PROFILING_DIR=directory, PROFILING_MAX_PROFILES=2):
+            response = self.client.get(reverse("customer-list"), {"profile": "1"}, **self.auth_headers)
+            self.assertNotIn("X-Profile-Id", response)
+            User.objects.filter(username=self.auth_user["username"]).update(is_staff=True)
+            names = []
+            for _ in range(3):
+                response = self.client.get(reverse("customer-list"), {"profile": "1"}, **self.auth_headers)
+                self.assertEqual(200, response.status_code)
+                names.append(response["X-Profile-Id"])
+        self.assertEqual(sorted(names), names)
+        self.assertEqual({name + suffix for name in names[1:] for suffix in (".folded", ".txt")}, set(os.listdir(directory)))
+    # END Testing profiling
+
+
+
+class TestProductSearchIndex(SimpleTestCase):
+    """
+    This class contains tests for the in-memory search index used without FTS5
+    """
+
+    def setUp(self):
+        self.index = ProductSearchIndex()
+        self.index.add(1, "Running shoes", "Light shoes for road running")
+        self.index.add(2, "Trail running shoes", "Shoes with grip")
+        self.index.add(3, "Desk lamp", "A lamp for the desk, runs on batteries")
+
+
+    def test_prefix_and_ranking(self):
+        """
+        This test case checks if every word must match, the last one as a
+        prefix, and if name hits rank first
+        """
+        self.assertEqual([1, 2, 3], sorted(self.index.search(["run"], 10, 0)))
+        self.assertEqual([2], self.index.search(["shoes", "tr"], 10, 0))
+        self.assertEqual([3], self.index.search(["desk"], 1, 0))
+        self.assertEqual([2], self.index.search(["grip"], 10, 0))
+        self.assertEqual([], self.index.search(["grip", "x"], 10, 0))
+        self.assertFalse(self.index.search(["run"], 10, 0).truncated)
+        with override_settings(SEARCH_MAX_RANKED=2):
+            results = self.index.search(["run"], 10, 0)
+        self.assertTrue(results.truncated)
+        self.assertEqual([2, 3], sorted(results))
+
+
+    def test_update_and_remove(self):
+        """
+        This test case checks if reindexed and removed products leave no stale terms
+        """
+        self.index.add(2, "Trail boots", "")
+        self.index.remove(1)
+        self.assertEqual([], self.index.search(["shoes"], 10, 0))
+        self.assertEqual([2], self.index.search(["boo"], 10, 0))
+        self.assertNotIn("grip", self.index.terms)
+        self.assertEqual(["batteries", "boots"], self.index.expand("b"))
+
+@unittest.skipUnless(connection.vendor == "sqlite", "query plans are checked on SQLite")
+class TestQueryPlans(TestCase):
+    """
+    This class checks if the hot queries are answered by an index instead of
+    a full table scan
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        products = [Product.objects.create(name="P{}".format(i), description="", image_link="", price=1.0) for i in range(5)]
+        for i in range(20):
+            customer = Customer.objects.create(name="C{}".format(i), email="c{}@test.case".format(i), phone="")
+            invoice = Invoice.objects.create(customer=customer)
+            for product in products:
+                InvoiceItem.objects.create(invoice=invoice, product=product, quantity=1, discount_value=0.0)
+                ShoppingCart.objects.create(customer=customer, product=product, quantity=1, discount_value=0.0, is_closed=i % 2 == 0)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+
+    def _assert_indexed(self, queryset):
+        plan = queryset.explain()
+        full_scans = [line for line in plan.splitlines() if re.search(r"\bSCAN\b", line) and "USING" not in line]
+        sorts = [line for line in plan.splitlines() if "TEMP B-TREE" in line]
+        self.assertFalse(full_scans + sorts, "{}\n{}".format(queryset.query, plan))
+
+
+    def test_open_carts_of_customer(self):
+        self._assert_indexed(ShoppingCart.objects.filter(customer_id=1, is_closed=False))
+
+
+    def test_invoices_of_customer_by_date(self):
+        self._assert_indexed(Invoice.objects.filter(customer_id=1).order_by("-purchase_date"))
+
+
+    def test_items_of_invoice(self):
+        self._assert_indexed(InvoiceItem.objects.filter(invoice_id=1))
+
+
+    def test_filtered_listings(self):
+        self._assert_indexed(Customer.objects.filter(email="c1@test.case"))
+        self._assert_indexed(ShoppingCart.objects.filter(is_closed=True).order_by("-creation_date", "-id")[:50])
+
+
+    def test_recent_first_listings(self):
+        for model in (Customer, Product, InvoiceItem, ShoppingCart):
+            self._assert_indexed(model.objects.order_by("-creation_date", "-id")[:50])
+        self._assert_indexed(Invoice.objects.order_by("-purchase_date", "-id")[:50])
+
+
+@unittest.skipUnless(connection.vendor == "sqlite", "SQLite backend settings")
+class TestSqliteBackend(TestCase):
+    """
+    This class checks the concurrency settings of the SQLite backend
+    """
+
+    def _file_connection(self, path, **pragmas):
+        wrapper = connections["default"].__class__({**connection.settings_dict, "NAME": path, "PRAGMAS": pragmas}, alias="file")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+
+    def test_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA synchronous")
+            self.assertEqual(1, cursor.fetchone()[0])  # NORMAL
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(5000, cursor.fetchone()[0])
+
+
+    def test_file_database_uses_wal(self):
+        path = os.path.join(tempfile.mkdtemp(), "wal.sqlite3")
+        with self._file_connection(path).cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode")
+            self.assertEqual("wal", cursor.fetchone()[0])
+
+
+    def test_transactions_take_the_write_lock(self):
+        """
+        This test case checks if a transaction holds the write lock from BEGIN,
+        and if a second one gives up after its retries
+        """
+        path = os.path.join(tempfile.mkdtemp(), "lock.sqlite3")
+        first, second = self._file_connection(path), self._file_connection(path, busy_timeout=10)
+        second.begin_backoff = 0.001
+        first.ensure_connection()
+        first._start_transaction_under_autocommit()
+        second.ensure_connection()
+        with self.assertRaises(OperationalError):
+            second._start_transaction_under_autocommit()
+        first.connection.rollback()
+        second._start_transaction_under_autocommit()
+        second.connection.rollback()
+
+
+@override_settings(DATABASE_REPLICAS=["replica_a", "replica_b"], REPLICA_CHECK_SECONDS=60, REPLICA_EJECT_SECONDS=60)
+class TestReplicaRouter(SimpleTestCase):
+    """
+    This class checks how the replica router picks a database
+    """
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.token = allow_replica_reads(True)
+
+    def tearDown(self):
+        reset_replica_reads(self.token)
+
+
+    def test_round_robin(self):
+        with mock.patch.object(ReplicaRouter, "is_healthy", return_value=True):
+            picked = [self.router.db_for_read(Customer) for i in range(4)]
+        self.assertEqual(["replica_a", "replica_b", "replica_a", "replica_b"], picked)
+        self.assertEqual("default", self.router.db_for_write(Customer))
+
+
+    def test_primary_when_not_allowed(self):
+        reset_replica_reads(self.token)
+        self.token = allow_replica_reads(False)
+        self.assertIsNone(self.router.db_for_read(Customer))
+
+
+    def test_failing_replica_is_ejected(self):
+        broken = mock.MagicMock()
+        broken.cursor.side_effect = OperationalError("unable to open database file")
+        working = mock.MagicMock()
+        with mock.patch("api.replicas.connections", {"replica_a": broken, "replica_b": working}):
+            picked = {self.router.db_for_read(Customer) for i in range(4)}
+            self.assertEqual({"replica_b"}, picked)
+            self.assertEqual(1, broken.cursor.call_count)
+
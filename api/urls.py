@@ -2,18 +2,23 @@
 from api.views import UpdateShoppingCart
 from django.urls import path, include
 from rest_framework.generics import UpdateAPIView
-from rest_framework.routers import DefaultRouter
 from . import views
+from .routers import BulkRouter
 
-router = DefaultRouter()
+router = BulkRouter()
 router.register(r'customers', views.CustomerViewSet, basename='customer')
 router.register(r'products', views.ProductViewSet, basename='product')
 router.register(r'invoices', views.InvoiceViewSet, basename='invoice')
 router.register(r'invoiceitems', views.InvoiceItemViewSet, basename='invoiceitem')
 router.register(r'shoppingcarts', views.ShoppingCartViewSet, basename='shoppingcart')
+router.register(r'analytics/product-sales', views.ProductSalesViewSet, basename='product-sales')
+router.register(r'analytics/customer-sales', views.CustomerSalesViewSet, basename='customer-sales')
 
 urlpatterns = [
     path('health-check', views.health_check.as_view(), name="health-check"),
     path('update-shoppingcart', views.UpdateShoppingCart.as_view(), name="update-shoppingcart"),
+    path('checkout', views.Checkout.as_view(), name="checkout"),
+    path('export/invoices', views.InvoiceExport.as_view(), name="export-invoices"),
+    path('export/invoiceitems', views.InvoiceItemExport.as_view(), name="export-invoiceitems"),
     path('', include(router.urls)),
 ]
\ No newline at end of file
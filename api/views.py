@@ -1,12 +1,42 @@
+import copy
+import csv
+import datetime
+import hashlib
+import threading
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import FieldDoesNotExist, ValidationError as DjangoValidationError
+from django.db import connection, models, transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.dateparse import parse_date
+from django.urls import URLResolver, get_resolver
+from django.utils.http import http_date
+from django.views import View
+from rest_framework import serializers, status
+from rest_framework.utils.urls import replace_query_param
+from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 from api.serializers import CustomerSerializer, InvoiceSerializer, ProductSerializer, InvoiceItemSerializer, ShoppingCartSerializer
-from api.models import Customer, Invoice, Product, InvoiceItem, ShoppingCart
+from api.serializers import CustomerMonthlySalesSerializer, ProductDailySalesSerializer, compile_read_plan
+from api.models import Customer, CustomerMonthlySales, Invoice, Product, ProductDailySales, InvoiceItem, ShoppingCart
 from rest_framework.authtoken.models import Token
-from rest_framework.permissions import IsAuthenticated
+from api.authentication import issue_token, revoke_token
+from api.cache import catalog_cache
+from api.compression import available_encodings, choose_encoding, compress, encoded_etag
+from api.fragments import PageFragments
+from api import metrics
+from api.pagination import DayCursorPagination, MonthCursorPagination, PurchaseDateCursorPagination
+from api.search import product_index, search_products
+from api.replicas import allow_replica_reads, is_pinned_to_primary, pin_to_primary, reset_replica_reads
+from rest_framework.permissions import SAFE_METHODS, IsAuthenticated
 
 
 class health_check(APIView):
@@ -21,49 +51,666 @@ class health_check(APIView):
         return Response({"message": "OK"}, status=200)
 
 
-class CustomerViewSet(ModelViewSet):
+class MetricsView(View):
     """
-    CRUD endpoint for Customer management
+    Prometheus scrape endpoint: the metrics of every worker, merged (see
+    api.metrics), for internal callers only (see api.metrics.is_scraper)
+    """
+
+    def get(self, request):
+        if not settings.METRICS_DIR:
+            raise Http404("Metrics are off")
+        if not metrics.is_scraper(request):
+            return HttpResponse("Forbidden", status=403, content_type="text/plain")
+        return HttpResponse(metrics.render(metrics.collect()), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+class PrecompiledTemplateView(View):
+    """
+    Serves a template rendered once per process (at startup, see
+    warm_precompiled_templates(), or on its first request), as immutable bytes
+    compressed beforehand with each encoding we support, picked by
+    Accept-Encoding, with a strong ETag and a long Cache-Control
+    """
+    template_name = None
+    content_type = "text/html; charset=utf-8"
+    extra_context = None
+    _variants = {}
+    _lock = threading.Lock()
+
+    def get_variants(self):
+        """
+        Returns {encoding (None for the identity): (etag, content)}
+        """
+        key = (self.template_name, tuple(sorted((self.extra_context or {}).items())))
+        variants = self._variants.get(key)
+        if variants is None:
+            with self._lock:
+                variants = self._variants.get(key)
+                if variants is None:
+                    content = render_to_string(self.template_name, self.extra_context).encode()
+                    digest = hashlib.sha256(content).hexdigest()[:32]
+                    etag = '"{}"'.format(digest)
+                    variants = {None: (etag, content)}
+                    for encoding in available_encodings():
+                        variants[encoding] = (encoded_etag(etag, encoding), compress(content, encoding, smallest=True))
+                    self._variants[key] = variants
+        return variants
+
+    def get(self, request, *args, **kwargs):
+        variants = self.get_variants()
+        encoding = choose_encoding(request, [encoding for encoding in variants if encoding])
+        etag, content = variants[encoding]
+        response = HttpResponse(content, content_type=self.content_type)
+        if encoding:
+            response["Content-Encoding"] = encoding
+        patch_vary_headers(response, ("Accept-Encoding",))
+        response["ETag"] = etag
+        response["Cache-Control"] = "public, max-age={}".format(settings.DOCS_CACHE_SECONDS)
+        # CompressionMiddleware strips the encoding of the ETags sent back
+        return get_conditional_response(request, etag=variants[None][0], response=response)
+
+
+def warm_precompiled_templates(patterns=None):
+    """
+    Renders and compresses the PrecompiledTemplateView pages of the URLconf:
+    called in the gunicorn master (see gunicorn.conf.py), the workers fork with
+    them built
+    """
+    for pattern in get_resolver().url_patterns if patterns is None else patterns:
+        if isinstance(pattern, URLResolver):
+            warm_precompiled_templates(pattern.url_patterns)
+            continue
+        view_class = getattr(pattern.callback, "view_class", None)
+        if view_class is not None and issubclass(view_class, PrecompiledTemplateView):
+            view_class(**pattern.callback.view_initkwargs).get_variants()
+
+
+def plan_related(serializer, model, prefix="", many=False):
+    """
+    Walks the nested serializers of a serializer and returns the lists of
+    select_related and prefetch_related lookups needed to render it
+    """
+    select_related, prefetch_related = [], []
+    for field in serializer.fields.values():
+        if field.write_only or field.source == "*":
+            continue
+        try:
+            model_field = model._meta.get_field(field.source.split(".")[0])
+        except FieldDoesNotExist:
+            continue
+        if not model_field.is_relation:
+            continue
+        if isinstance(field, serializers.ListSerializer):
+            child = field.child
+        elif isinstance(field, serializers.BaseSerializer):
+            child = field
+        elif isinstance(field, serializers.PrimaryKeyRelatedField):
+            # pk only fields read the local "<name>_id" column, no join needed
+            continue
+        elif isinstance(field, (serializers.RelatedField, serializers.ManyRelatedField)):
+            child = None
+        else:
+            continue
+        lookup = prefix + model_field.name
+        to_many = many or model_field.many_to_many or model_field.one_to_many
+        if to_many:
+            prefetch_related.append(lookup)
+        else:
+            select_related.append(lookup)
+        if child is not None:
+            nested_select, nested_prefetch = plan_related(child, model_field.related_model, lookup + "__", to_many)
+            select_related += nested_select
+            prefetch_related += nested_prefetch
+    # a nested lookup already covers its parents
+    select_related = [l for l in select_related if not any(o.startswith(l + "__") for o in select_related)]
+    prefetch_related = [l for l in prefetch_related if not any(o.startswith(l + "__") for o in prefetch_related)]
+    return select_related, prefetch_related
+
+
+def plan_columns(serializer, model, prefix=""):
+    """
+    Returns the only() lookups of the columns read to render a serializer,
+    following its nested serializers, or None when a field doesn't map to a
+    column of model
+    """
+    columns = [prefix + model._meta.pk.name]
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        if field.source == "*" or "." in field.source:
+            return None
+        try:
+            model_field = model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            return None
+        if model_field.many_to_many or model_field.one_to_many:
+            # prefetched with their own query
+            continue
+        if isinstance(field, serializers.BaseSerializer):
+            nested = plan_columns(field, model_field.related_model, prefix + model_field.name + "__")
+            if nested is None:
+                return None
+            columns += nested
+        columns.append(prefix + model_field.name)
+    return columns
+
+
+class RelatedQueryMixin:
+    """
+    Viewset mixin that joins/prefetches every relation rendered by the
+    serializer, so list and detail endpoints run a constant number of queries.
+    Reads only select the columns rendered (see ?fields= and ?expand= in
+    api.serializers.SparseFieldsMixin)
+    """
+    _related_plans = {}
+    max_related_plans = 256
+
+    def get_related_plan(self):
+        """
+        Returns the (select_related, prefetch_related, only) lookups of the request
+        """
+        params = self.request.query_params if self.request.method in SAFE_METHODS else {}
+        key = (type(self), self.request.method in SAFE_METHODS, params.get("fields"), params.get("expand"))
+        plan = self._related_plans.get(key)
+        if plan is None:
+            serializer = self.get_serializer()
+            model = self.queryset.model
+            columns = plan_columns(serializer, model) if self.request.method in SAFE_METHODS else None
+            if columns is not None:
+                # the cursor pagination reads the ordering fields
+                ordering = getattr(self.paginator, "ordering", None) or ()
+                columns += [name.lstrip("-") for name in ordering] + list(getattr(self, "ordering_fields", ()))
+                columns += list(getattr(self, "validator_fields", ()))
+            plan = (*plan_related(serializer, model), columns)
+            if len(self._related_plans) >= self.max_related_plans:
+                self._related_plans.clear()
+            self._related_plans[key] = plan
+        return plan
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        select_related, prefetch_related, columns = self.get_related_plan()
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        if columns:
+            queryset = queryset.only(*columns)
+        return queryset
+
+
+class FastReadMixin:
+    """
+    Viewset mixin rendering list pages straight from values_list() rows with
+    a function compiled from the serializer (see
+    api.serializers.compile_read_plan), skipping model instances and DRF's
+    field by field to_representation. The output is the serializer's; lists
+    whose serializer renders fields not backed by a column use the serializer.
+    Embedded objects with an "updated_at" stamp are spliced in as cached JSON
+    fragments (see api.fragments), the page query only reading their pk and stamps
+    """
+    _read_plans = {}
+    max_read_plans = 256
+
+    def get_read_plan(self):
+        params = self.request.query_params
+        key = (type(self), params.get("fields"), params.get("expand"))
+        if key not in self._read_plans:
+            plan = compile_read_plan(self.get_serializer(), self.queryset.model, fragments=True)
+            if plan is not None:
+                lookups, render = plan
+                # the cursor pagination reads the ordering fields off the rows
+                ordering = getattr(self.paginator, "ordering", None) or ()
+                extra = [name.lstrip("-") for name in ordering] + list(getattr(self, "ordering_fields", ()))
+                extra += list(getattr(self, "validator_fields", ()))
+                plan = (lookups + [name for name in dict.fromkeys(extra) if name not in lookups], render)
+            if len(self._read_plans) >= self.max_read_plans:
+                self._read_plans.clear()
+            self._read_plans[key] = plan
+        return self._read_plans[key]
+
+    def list(self, request, *args, **kwargs):
+        plan = self.get_read_plan() if request.method in SAFE_METHODS else None
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+        lookups, render = plan
+        rows = self.filter_queryset(self.get_queryset()).values_list(*lookups, named=True)
+        page = self.paginate_queryset(rows)
+        fragments = PageFragments()
+        data = render(rows if page is None else page, fragments)
+        fragments.fill()
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
+
+
+def bulk_create(model, objs):
+    """
+    bulk_create that always sets the primary keys of the created objects
+    """
+    if connection.features.can_return_rows_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    if connection.vendor != "sqlite":
+        for obj in objs:
+            obj.save(force_insert=True)
+        return objs
+    with transaction.atomic():
+        objs = model.objects.bulk_create(objs)
+        # SQLite holds the write lock until commit, so the newest rows are ours
+        pks = model.objects.order_by("-pk").values_list("pk", flat=True)[:len(objs)]
+        for obj, pk in zip(objs, reversed(list(pks))):
+            obj.pk = pk
+    return objs
+
+
+class BulkWriteMixin:
+    """
+    Viewset mixin that accepts a list payload on create (POST) and partial
+    update (PATCH on the list url). Valid rows are written with one
+    bulk_create/bulk_update in a single transaction, invalid rows are reported
+    by index and skipped
+    """
+
+    def create(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return super().create(request, *args, **kwargs)
+        model = self.queryset.model
+        rows, errors = self.validate_bulk(request.data)
+        with transaction.atomic():
+            objs = bulk_create(model, [model(**data) for data in rows.values()])
+            self.perform_bulk_create(objs)
+        return self.bulk_response(objs, errors, status.HTTP_201_CREATED)
+
+    def bulk_partial_update(self, request, *args, **kwargs):
+        if not isinstance(request.data, list):
+            return Response({"message": "Error! Expected a list of items."}, status=400)
+        model = self.queryset.model
+        ids = [row.get("id") for row in request.data if isinstance(row, dict)]
+        instances = model.objects.in_bulk([pk for pk in ids if isinstance(pk, int)])
+        errors, seen = {}, set()
+        for index, row in enumerate(request.data):
+            instance = instances.get(row.get("id")) if isinstance(row, dict) else None
+            if instance is not None and instance.pk in seen:
+                # bulk_update takes each object once; the first row wins
+                error = {"id": ["duplicate"]}
+            else:
+                error = self.bulk_row_error(instance) if instance else {"id": ["Not found."]}
+            if instance is not None:
+                seen.add(instance.pk)
+            if error:
+                errors[index] = error
+        rows, errors = self.validate_bulk(request.data, errors, partial=True)
+        objs, fields = [], {field.attname for field in model._meta.concrete_fields if getattr(field, "auto_now", False)}
+        now = timezone.now()
+        previous = []
+        for index, data in rows.items():
+            instance = instances[request.data[index]["id"]]
+            previous.append(copy.copy(instance))
+            for attr, value in data.items():
+                setattr(instance, attr, value)
+            for attr in fields:
+                setattr(instance, attr, now)
+            fields.update(data)
+            objs.append(instance)
+        with transaction.atomic():
+            if objs and fields:
+                model.objects.bulk_update(objs, fields)
+            self.perform_bulk_update(objs, previous)
+        return self.bulk_response(objs, errors, status.HTTP_200_OK)
+
+    def bulk_row_error(self, instance):
+        """
+        Returns the errors that forbid updating instance, if any
+        """
+        return None
+
+    def perform_bulk_create(self, objs):
+        pass
+
+    def perform_bulk_update(self, objs, previous):
+        pass
+
+    def validate_bulk(self, data, errors=None, partial=False):
+        """
+        Validates the rows with a many=True serializer and checks their foreign
+        keys with one query per relation. Returns the validated data and the
+        errors, both keyed by row index
+        """
+        errors = dict(errors or {})
+        serializer = self.get_serializer(data=data, many=True, partial=partial)
+        if not serializer.is_valid():
+            if not isinstance(serializer.errors, list):
+                errors.update({index: serializer.errors for index in range(len(data))})
+            else:
+                errors.update({index: error for index, error in enumerate(serializer.errors) if error})
+            valid = [index for index in range(len(data)) if index not in errors]
+            serializer = self.get_serializer(data=[data[index] for index in valid], many=True, partial=partial)
+            serializer.is_valid(raise_exception=True)
+        else:
+            valid = list(range(len(data)))
+        rows = dict(zip(valid, serializer.validated_data))
+        for field in self.queryset.model._meta.concrete_fields:
+            if not isinstance(field, models.ForeignKey):
+                continue
+            pks = {row[field.attname] for row in rows.values() if row.get(field.attname) is not None}
+            found = set(field.related_model.objects.filter(pk__in=pks).values_list("pk", flat=True))
+            for index, row in list(rows.items()):
+                pk = row.get(field.attname)
+                if pk is not None and pk not in found:
+                    message = 'Invalid pk "{}" - object does not exist.'.format(pk)
+                    errors.setdefault(index, {})[field.attname] = [message]
+                    del rows[index]
+        for index in [index for index in rows if index in errors]:
+            del rows[index]
+        return rows, errors
+
+    def bulk_response(self, objs, errors, success_status):
+        """
+        Renders the written rows together with the per row errors
+        """
+        written = self.get_queryset().in_bulk([obj.pk for obj in objs])
+        serializer = self.get_serializer([written[obj.pk] for obj in objs], many=True)
+        if not objs:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif errors:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = success_status
+        return Response({
+            "results": serializer.data,
+            "errors": [{"index": index, "errors": errors[index]} for index in sorted(errors)],
+        }, status=response_status)
+
+
+class CatalogCacheMixin:
+    """
+    Viewset mixin that serves list and detail payloads from the catalog cache.
+    List pages are cached with their validators (see ConditionalGetMixin)
+    """
+
+    def list(self, request, *args, **kwargs):
+        fill = super().list
+        key = "{}:page:{}".format(self.basename, request.build_absolute_uri())
+        def fill_page():
+            data = fill(request, *args, **kwargs).data
+            return data, getattr(self, "page_validators", None)
+        data, self.page_validators = catalog_cache.get_or_fill(key, fill_page)
+        return Response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        fill = super().retrieve
+        # ?fields= and ?expand= variants are cached apart
+        key = "{}:detail:{}".format(self.basename, request.build_absolute_uri())
+        return Response(catalog_cache.get_or_fill(key, lambda: fill(request, *args, **kwargs).data))
+
+
+class NotModified(Exception):
+    """
+    Raised with the 304 response of a list page found not modified before
+    rendering it
+    """
+
+    def __init__(self, response):
+        super().__init__()
+        self.response = response
+
+
+class ConditionalGetMixin:
+    """
+    Viewset mixin that answers conditional requests. Objects get the ETag and
+    Last-Modified validators computed from the "updated_at" column, without
+    serializing the payload: If-None-Match/If-Modified-Since on GET return 304
+    and If-Match on PUT/PATCH returns 412 when the object changed. List pages
+    get validators computed from the pk and "updated_at" of their rows, read
+    with the page, and answer 304 before rendering it
+    """
+    validator_fields = ("updated_at",)
+
+    def get_validators(self, pk):
+        """
+        Returns the (etag, last_modified timestamp) of an object, none for a
+        malformed pk: the view answers 404
+        """
+        try:
+            pk = self.queryset.model._meta.pk.to_python(pk)
+        except (TypeError, ValueError, DjangoValidationError):
+            return None, None
+        queryset = self.filter_queryset(self.queryset.all()).order_by()
+        updated_at = queryset.filter(pk=pk).values_list("updated_at", flat=True).first()
+        if updated_at is None:
+            return None, None
+        key = "{}:{}:{}:{}".format(
+            self.queryset.model._meta.label, pk, updated_at.isoformat(), getattr(self.request, "accepted_media_type", ""),
+        )
+        return '"{}"'.format(hashlib.sha1(key.encode()).hexdigest()), int(updated_at.timestamp())
+
+    def get_page_validators(self, page):
+        """
+        Returns the (etag, last_modified timestamp) of a list page, from its rows
+        and links: a row added, removed or changed changes the ETag
+        """
+        attname = self.queryset.model._meta.pk.attname
+        stamps = [(getattr(row, attname), row.updated_at) for row in page]
+        key = "{}:{}:{}:{}:{}:{}".format(
+            self.queryset.model._meta.label, self.request.get_full_path(), getattr(self.request, "accepted_media_type", ""),
+            self.paginator.get_next_link(), self.paginator.get_previous_link(),
+            ",".join("{}@{}".format(pk, updated_at.isoformat()) for pk, updated_at in stamps),
+        )
+        last_modified = int(max(updated_at for pk, updated_at in stamps).timestamp()) if stamps else None
+        return '"{}"'.format(hashlib.sha1(key.encode()).hexdigest()), last_modified
+
+    def not_modified(self, request, etag, last_modified):
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            self.set_validators(response, etag, last_modified)
+        return response
+
+    def set_validators(self, response, etag, last_modified):
+        response["ETag"] = etag
+        if last_modified is not None:
+            response["Last-Modified"] = http_date(last_modified)
+
+    def conditional(self, request, handler, pk):
+        etag, last_modified = self.get_validators(pk)
+        if etag:
+            response = self.not_modified(request, etag, last_modified)
+            if response is not None:
+                return response
+        response = handler()
+        if request.method not in ("GET", "HEAD"):
+            etag, last_modified = self.get_validators(pk)
+        if etag and response.status_code == 200:
+            self.set_validators(response, etag, last_modified)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        handler = super().retrieve
+        return self.conditional(request, lambda: handler(request, *args, **kwargs), kwargs[self.lookup_field])
+
+    def update(self, request, *args, **kwargs):
+        handler = super().update
+        return self.conditional(request, lambda: handler(request, *args, **kwargs), kwargs[self.lookup_field])
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None and self.request.method in ("GET", "HEAD"):
+            self.page_validators = self.get_page_validators(page)
+            response = self.not_modified(self.request, *self.page_validators)
+            if response is not None:
+                raise NotModified(response)
+        return page
+
+    def list(self, request, *args, **kwargs):
+        self.page_validators = None
+        try:
+            response = super().list(request, *args, **kwargs)
+        except NotModified as exc:
+            return exc.response
+        if self.page_validators is None or response.status_code != 200:
+            return response
+        # a page served from the cache was not checked yet
+        not_modified = self.not_modified(request, *self.page_validators)
+        if not_modified is not None:
+            return not_modified
+        self.set_validators(response, *self.page_validators)
+        return response
+
+
+class ReplicaReadMixin:
+    """
+    Viewset mixin that lets safe requests read from the replicas (see
+    api.replicas.ReplicaRouter), except for a client that just wrote, which
+    stays on the primary for a while to read its own writes
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        allowed = request.method in SAFE_METHODS and not is_pinned_to_primary(request)
+        self._replica_token = allow_replica_reads(allowed)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_to_primary(request)
+        if getattr(self, "_replica_token", None) is not None:
+            reset_replica_reads(self._replica_token)
+            self._replica_token = None
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class CustomerViewSet(ReplicaReadMixin, ConditionalGetMixin, FastReadMixin, RelatedQueryMixin, ModelViewSet):
+    """
+    CRUD endpoint for Customer management.
+    Supports conditional requests (ETag / Last-Modified)
     """
     permission_classes = (IsAuthenticated,)
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
+    max_page_size = 100
+    indexed_filters = {"email": "email", "start": "creation_date__gte", "end": "creation_date__lte"}
+    ordering_fields = ("creation_date", "updated_at", "id")
 
 
-class ProductViewSet(ModelViewSet):
+class ProductViewSet(ReplicaReadMixin, ConditionalGetMixin, CatalogCacheMixin, FastReadMixin, RelatedQueryMixin, ModelViewSet):
     """
-    CRUD endpoint for Product management
+    CRUD endpoint for Product management.
+    Reads are served from the catalog cache and support conditional requests
+    (ETag / Last-Modified)
     """
     permission_classes = (IsAuthenticated,)
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    max_page_size = 200
+    search_page_size = 20
 
+    @action(detail=False)
+    def search(self, request):
+        """
+        Full-text search on name and description, best match first.
+        GET method accepts the query parameters:
+            q: words to look for, the last one also matches as a prefix
+            limit: page size (default 20, up to max_page_size)
+            offset: results to skip
+        "truncated" is true when the query matched more than SEARCH_MAX_RANKED
+        products: only the newest were ranked, narrow the query to see the others
+        """
+        query = request.query_params.get("q", "")
+        try:
+            limit = int(request.query_params.get("limit", self.search_page_size))
+            offset = int(request.query_params.get("offset", 0))
+        except ValueError:
+            return Response({"message": "Error! limit and offset must be integers!"}, status=400)
+        if limit < 1 or offset < 0:
+            return Response({"message": "Error! limit must be positive and offset not negative!"}, status=400)
+        limit = min(limit, self.max_page_size)
+        url = request.build_absolute_uri()
 
-class InvoiceViewSet(ModelViewSet):
+        def fill():
+            ids = search_products(query, limit + 1, offset)
+            products = Product.objects.in_bulk(ids[:limit])
+            with product_index.lock:
+                for id in set(ids[:limit]) - set(products):
+                    product_index.remove(id)
+            previous = None
+            if offset:
+                previous = replace_query_param(url, "offset", max(offset - limit, 0))
+            return {
+                "next": replace_query_param(url, "offset", offset + limit) if len(ids) > limit else None,
+                "previous": previous,
+                "results": list(ProductSerializer([products[id] for id in ids[:limit] if id in products], many=True).data),
+                "truncated": ids.truncated,
+            }
+        return Response(catalog_cache.get_or_fill("{}:search:{}".format(self.basename, url), fill))
+
+
+class InvoiceViewSet(ReplicaReadMixin, FastReadMixin, RelatedQueryMixin, ModelViewSet):
     """
     CRUD endpoint for Invoice management
     """
     permission_classes = (IsAuthenticated,)
     queryset = Invoice.objects.all()
     serializer_class = InvoiceSerializer
+    pagination_class = PurchaseDateCursorPagination
+    max_page_size = 100
+    indexed_filters = {"customer": "customer", "start": "purchase_date__gte", "end": "purchase_date__lte"}
+    ordering_fields = ("purchase_date", "id")
 
 
-class InvoiceItemViewSet(ModelViewSet):
+class InvoiceItemViewSet(ReplicaReadMixin, BulkWriteMixin, FastReadMixin, RelatedQueryMixin, ModelViewSet):
     """
-    CRUD endpoint for Invoice's Item management
+    CRUD endpoint for Invoice's Item management.
+    POST and PATCH on the list url also accept a list of items
     """
     permission_classes = (IsAuthenticated,)
     queryset = InvoiceItem.objects.all()
     serializer_class = InvoiceItemSerializer
+    max_page_size = 500
+    indexed_filters = {"invoice": "invoice", "product": "product"}
+    ordering_fields = ("creation_date", "id")
+
+    # every write keeps the invoice totals in sync with F() deltas
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            item = serializer.save()
+            Invoice.objects.add_item_totals(added=[item])
 
+    def perform_update(self, serializer):
+        with transaction.atomic():
+            previous = copy.copy(serializer.instance)
+            item = serializer.save()
+            Invoice.objects.add_item_totals(added=[item], removed=[previous])
 
-class ShoppingCartViewSet(ModelViewSet):
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            Invoice.objects.add_item_totals(removed=[instance])
+            instance.delete()
+
+    def perform_bulk_create(self, objs):
+        Invoice.objects.add_item_totals(added=objs)
+
+    def perform_bulk_update(self, objs, previous):
+        Invoice.objects.add_item_totals(added=objs, removed=previous)
+
+
+class ShoppingCartViewSet(ReplicaReadMixin, BulkWriteMixin, FastReadMixin, RelatedQueryMixin, ModelViewSet):
     """
-    CRUD endpoint for shopping cart management
+    CRUD endpoint for shopping cart management.
+    POST and PATCH on the list url also accept a list of carts
     """
     permission_classes = (IsAuthenticated,)
     queryset = ShoppingCart.objects.all()
     serializer_class = ShoppingCartSerializer
+    max_page_size = 100
+    indexed_filters = {
+        "customer": "customer", "product": "product", "is_closed": "is_closed",
+        "start": "creation_date__gte", "end": "creation_date__lte",
+    }
+    ordering_fields = ("creation_date", "id")
+
+    def bulk_row_error(self, instance):
+        if instance.is_closed:
+            return {"is_closed": ["Error! Cart already closed!"]}
+        return None
 
 
 class AuthToken(APIView):
@@ -77,6 +724,8 @@ class AuthToken(APIView):
             "username": "your_username",
             "password": "your password"
         }
+        Add "token_type": "signed" to get a stateless, expiring token to be
+        sent as "Bearer <token>" instead of "Token <token>"
         Note: Use Django's administration console to create a user for you
         http://localhost:8000/admin
         """
@@ -86,6 +735,9 @@ class AuthToken(APIView):
             password = payload["password"] if "password" in payload else ""
             user = User.objects.get(username=username)
             if user.check_password(password):
+                if payload.get("token_type") == "signed":
+                    token, expires = issue_token(user)
+                    return Response({"message": "OK", "token": token, "expires": expires}, status=200)
                 token = Token.objects.filter(user=user).first()
                 if not token:
                     token = Token.objects.create(user=user)
@@ -96,6 +748,15 @@ class AuthToken(APIView):
             print(str(e))
         return Response({"message": "Auth Invalid", "token": ""}, status=404)
 
+    def delete(self, request):
+        """
+        DELETE method revokes the signed token used to call it
+        """
+        if not isinstance(request.auth, dict):
+            return Response({"message": "Error! Only signed tokens can be revoked!"}, status=400)
+        revoke_token(request.auth)
+        return Response({"message": "OK"}, status=200)
+
 
 class UpdateShoppingCart(APIView):
     """
@@ -114,3 +775,241 @@ class UpdateShoppingCart(APIView):
             serializer.save()
         return Response({"message": "OK", "cart": serializer.data}, status=200)
 
+
+class CheckoutConflict(Exception):
+    pass
+
+
+class Checkout(APIView):
+    """
+    Endpoint that turns the customer's open shopping carts into an invoice
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request):
+        """
+        POST method requires a payload with the customer, like this:
+        {
+            "customer_id": 1
+        }
+        Runs a fixed number of queries whatever the number of carts
+        """
+        data = request.data if isinstance(request.data, dict) else {}
+        try:
+            customer_id = serializers.IntegerField(min_value=1).run_validation(data.get("customer_id", serializers.empty))
+        except ValidationError:
+            return Response({"message": "Error! customer_id must be a positive integer!", "invoice": {}}, status=400)
+        try:
+            with transaction.atomic():
+                carts = list(
+                    ShoppingCart.objects.select_for_update()
+                    .filter(customer_id=customer_id, is_closed=False)
+                    .values_list("id", "product_id", "quantity", "discount_value", "product__price")
+                )
+                if not carts:
+                    if not Customer.objects.filter(id=customer_id).exists():
+                        return Response({"message": "Error! Customer not found!", "invoice": {}}, status=404)
+                    return Response({"message": "Error! No open carts to checkout!", "invoice": {}}, status=400)
+                invoice = Invoice.objects.create(customer_id=customer_id)
+                InvoiceItem.objects.bulk_create([
+                    InvoiceItem(invoice=invoice, product_id=product_id, quantity=quantity,
+                                discount_value=discount_value, quote_price=price)
+                    for _, product_id, quantity, discount_value, price in carts
+                ])
+                totals = InvoiceItem.objects.filter(invoice=invoice).totals()
+                Invoice.objects.filter(id=invoice.id).update(updated_at=timezone.now(), **totals)
+                closed = ShoppingCart.objects.filter(id__in=[cart[0] for cart in carts], is_closed=False).update(
+                    is_closed=True, closed_date=timezone.now()
+                )
+                if closed != len(carts):
+                    raise CheckoutConflict()
+        except CheckoutConflict:
+            return Response({"message": "Error! Carts changed during checkout!", "invoice": {}}, status=409)
+        invoice = Invoice.objects.select_related("customer").get(id=invoice.id)
+        return Response({"message": "OK", "invoice": InvoiceSerializer(invoice).data}, status=201)
+
+
+class _Echo:
+    """
+    File-like object handing back what csv.writer writes
+    """
+    def write(self, value):
+        return value
+
+
+class ExportView(APIView):
+    """
+    Base of the streaming exports, not routed itself: subclasses set the
+    ordered queryset, the columns and the date lookup. Rows are read in chunks
+    with values_list().iterator() and sent as CSV or NDJSON while the query is
+    still running, so memory stays flat whatever the export size
+    """
+    permission_classes = (IsAuthenticated,)
+    chunk_size = 2000
+    queryset = None
+    # (column name, lookup) pairs
+    columns = ()
+    date_lookup = None
+    filename = "export"
+
+    def get(self, request):
+        """
+        GET method accepts the query parameters:
+            output: "csv" (default) or "ndjson"
+            start, end: purchase date range (YYYY-MM-DD), inclusive
+        """
+        output = request.query_params.get("output", "csv")
+        if output not in ("csv", "ndjson"):
+            return Response({"message": "Error! output must be csv or ndjson!"}, status=400)
+        queryset = self.queryset.all()
+        for param, lookup, days in (("start", "gte", 0), ("end", "lt", 1)):
+            if param not in request.query_params:
+                continue
+            try:
+                day = parse_date(request.query_params[param])
+            except ValueError:
+                day = None
+            if day is None:
+                return Response({"message": "Error! {} must be a YYYY-MM-DD date!".format(param)}, status=400)
+            bound = timezone.make_aware(datetime.datetime.combine(day + datetime.timedelta(days=days), datetime.time.min))
+            queryset = queryset.filter(**{"{}__{}".format(self.date_lookup, lookup): bound})
+        rows = queryset.values_list(*[lookup for _, lookup in self.columns]).iterator(chunk_size=self.chunk_size)
+        if output == "csv":
+            response = StreamingHttpResponse(self.stream_csv(rows), content_type="text/csv")
+        else:
+            response = StreamingHttpResponse(self.stream_ndjson(rows), content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="{}.{}"'.format(self.filename, output)
+        return response
+
+    def _chunks(self, lines):
+        buffer = []
+        for line in lines:
+            buffer.append(line)
+            if len(buffer) == self.chunk_size:
+                yield "".join(buffer)
+                buffer = []
+        if buffer:
+            yield "".join(buffer)
+
+    def stream_csv(self, rows):
+        writer = csv.writer(_Echo())
+        # the header goes out before the query runs
+        yield writer.writerow([name for name, _ in self.columns])
+        yield from self._chunks(
+            writer.writerow([value.isoformat() if isinstance(value, datetime.datetime) else value for value in row])
+            for row in rows
+        )
+
+    def stream_ndjson(self, rows):
+        names = [name for name, _ in self.columns]
+        encoder = DjangoJSONEncoder()
+        yield from self._chunks(encoder.encode(dict(zip(names, row))) + "\n" for row in rows)
+
+
+class InvoiceExport(ExportView):
+    """
+    Streaming export of the invoices with their customer
+    """
+    columns = (
+        ("id", "id"), ("purchase_date", "purchase_date"), ("customer_id", "customer_id"),
+        ("customer_name", "customer__name"), ("customer_email", "customer__email"),
+        ("total_value", "total_value"), ("total_quantity", "total_quantity"), ("total_discount", "total_discount"),
+    )
+    queryset = Invoice.objects.order_by("purchase_date", "id")
+    date_lookup = "purchase_date"
+    filename = "invoices"
+
+
+class InvoiceItemExport(ExportView):
+    """
+    Streaming export of the invoice's items with their invoice, customer and product
+    """
+    columns = (
+        ("id", "id"), ("invoice_id", "invoice_id"), ("purchase_date", "invoice__purchase_date"),
+        ("customer_id", "invoice__customer_id"), ("customer_name", "invoice__customer__name"),
+        ("product_id", "product_id"), ("product_name", "product__name"), ("quantity", "quantity"),
+        ("quote_price", "quote_price"), ("discount_value", "discount_value"), ("creation_date", "creation_date"),
+    )
+    queryset = InvoiceItem.objects.order_by("id")
+    date_lookup = "invoice__purchase_date"
+    filename = "invoiceitems"
+
+
+class SalesRollupViewSet(ReplicaReadMixin, ReadOnlyModelViewSet):
+    """
+    Read only range queries on a sales rollup, kept up to date by the
+    refresh_sales_rollups command. Query parameters:
+        start, end: period range (YYYY-MM-DD), inclusive
+        <key_param>: id of a single product or customer
+    """
+    permission_classes = (IsAuthenticated,)
+    max_page_size = 500
+    key_param = None
+
+    def get_filters(self):
+        """
+        Returns the (filters, error message) of the query parameters, the
+        message set when one is invalid
+        """
+        params = self.request.query_params
+        model = self.queryset.model
+        filters = {}
+        for param, lookup in (("start", "gte"), ("end", "lte")):
+            if param not in params:
+                continue
+            try:
+                day = parse_date(params[param])
+            except ValueError:
+                day = None
+            if day is None:
+                return None, "Error! {} must be a YYYY-MM-DD date!".format(param)
+            if model.period == "month":
+                day = day.replace(day=1)
+            filters["{}__{}".format(model.period, lookup)] = day
+        if self.key_param in params:
+            if not params[self.key_param].isdigit():
+                return None, "Error! {} must be an id!".format(self.key_param)
+            filters[model.key] = int(params[self.key_param])
+        return filters, None
+
+    def filter_queryset(self, queryset):
+        return super().filter_queryset(queryset).filter(**self.filters)
+
+    def filtered(self, handler, request, *args, **kwargs):
+        self.filters, error = self.get_filters()
+        if error is not None:
+            return Response({"message": error}, status=400)
+        return handler(request, *args, **kwargs)
+
+    def list(self, request, *args, **kwargs):
+        return self.filtered(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.filtered(super().retrieve, request, *args, **kwargs)
+
+    @action(detail=False)
+    def totals(self, request):
+        """
+        Sums of the rows in the range: quantity, gross_value, discount and net_value
+        """
+        return self.filtered(lambda request: Response(self.filter_queryset(self.get_queryset()).totals()), request)
+
+
+class ProductSalesViewSet(SalesRollupViewSet):
+    """
+    Sales per product and day
+    """
+    queryset = ProductDailySales.objects.all()
+    serializer_class = ProductDailySalesSerializer
+    pagination_class = DayCursorPagination
+    key_param = "product"
+
+
+class CustomerSalesViewSet(SalesRollupViewSet):
+    """
+    Sales per customer and month
+    """
+    queryset = CustomerMonthlySales.objects.all()
+    serializer_class = CustomerMonthlySalesSerializer
+    pagination_class = MonthCursorPagination
+    key_param = "customer"
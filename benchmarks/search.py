@@ -0,0 +1,105 @@
+"""
+Latency of the product search on a generated catalog, with the SQLite FTS5
+index and with the in-memory fallback index. Product names and descriptions
+draw their words from a Zipf-like vocabulary, queries are one or two words,
+the last one as a 2 to 4 letters prefix half of the time
+
+Usage:
+    python benchmarks/search.py --products 1000000 --queries 500
+"""
+import argparse
+import itertools
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--products", type=int, default=1000000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--skip-fallback", action="store_true", help="Only measure the FTS5 index")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BASE_DIR)
+    os.environ["DJANGO_SETTINGS_MODULE"] = "ecommerce.settings"
+    from django.conf import settings
+    settings.DATABASES["default"]["NAME"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    import django
+    django.setup()
+    from unittest import mock
+    from django.core.management import call_command
+    from django.db import connection, transaction
+    from api.models import Product
+    from api import search
+
+    random.seed(1)
+    vocabulary = ["".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(3, 10)))
+                  for _ in range(args.vocabulary)]
+    weights = list(itertools.accumulate(1.0 / rank for rank in range(1, len(vocabulary) + 1)))
+
+    def words(count):
+        return " ".join(random.choices(vocabulary, cum_weights=weights, k=count))
+
+    call_command("migrate", verbosity=0)
+    started = time.time()
+    for start in range(0, args.products, 10000):
+        with transaction.atomic():
+            Product.objects.bulk_create([
+                Product(name=words(3), description=words(20), image_link="", price=1.0)
+                for _ in range(min(10000, args.products - start))
+            ])
+    print("Loaded {} products in {:.1f}s".format(args.products, time.time() - started))
+
+    queries = []
+    for _ in range(args.queries):
+        terms = random.choices(vocabulary, cum_weights=weights, k=random.randint(1, 2))
+        if random.random() < 0.5:
+            terms[-1] = terms[-1][:random.randint(2, 4)]
+        queries.append(" ".join(terms))
+
+    def measure(label):
+        latencies, truncated = [], 0
+        for query in queries:
+            started = time.perf_counter()
+            truncated += search.search_products(query, 21, 0).truncated
+            latencies.append((time.perf_counter() - started) * 1000)
+        print("{}: p50 {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms, {:.0f}% truncated".format(
+            label, percentile(latencies, 0.5), percentile(latencies, 0.95), max(latencies),
+            truncated * 100 / len(queries)
+        ))
+
+    measure("fts5")
+    # the same capped matches without bm25(): the rest is its IDF scans
+    latencies = []
+    with connection.cursor() as cursor:
+        for query in queries:
+            started = time.perf_counter()
+            cursor.execute("SELECT rowid FROM {0} WHERE {0} MATCH %s ORDER BY rowid DESC LIMIT %s".format(search.FTS_TABLE),
+                           [search.fts_query(search.tokenize(query)), settings.SEARCH_MAX_RANKED + 1])
+            cursor.fetchall()
+            latencies.append((time.perf_counter() - started) * 1000)
+    print("fts5 matches without bm25(): p50 {:.1f} ms, p95 {:.1f} ms".format(
+        percentile(latencies, 0.5), percentile(latencies, 0.95)
+    ))
+    if not args.skip_fallback:
+        with mock.patch.object(search, "has_fts", return_value=False):
+            started = time.time()
+            search.search_products("warm up", 1)
+            print("Built the in-memory index in {:.1f}s".format(time.time() - started))
+            measure("in-memory")
+
+
+if __name__ == "__main__":
+    main()
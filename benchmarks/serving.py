@@ -0,0 +1,107 @@
+"""
+Load benchmark of the production server (gunicorn, see gunicorn.conf.py)
+against the development server (manage.py runserver)
+
+Usage:
+    python benchmarks/serving.py --concurrency 16 --duration 10
+"""
+import argparse
+import http.client
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    "runserver": [sys.executable, "manage.py", "runserver", "--noreload", "127.0.0.1:{port}"],
+    "gunicorn": [os.path.join(os.path.dirname(sys.executable), "gunicorn"), "ecommerce.wsgi", "--bind", "127.0.0.1:{port}"],
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("server on port {} did not start".format(port))
+
+
+def load(port, paths, concurrency, duration):
+    """
+    Runs concurrency clients with keep-alive connections for duration seconds,
+    returns the latencies (ms) and the error count
+    """
+    latencies, errors = [], [0]
+    deadline = time.time() + duration
+
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        i = 0
+        while time.time() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            started = time.perf_counter()
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                response.read()
+                if response.status >= 400:
+                    errors[0] += 1
+                if response.getheader("Connection", "").lower() == "close":
+                    connection.close()
+            except (OSError, http.client.HTTPException):
+                errors[0] += 1
+                connection.close()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--path", action="append", help="Path to request (default: health check and docs)")
+    parser.add_argument("--server", action="append", choices=SERVERS, help="Server to benchmark (default: all)")
+    args = parser.parse_args()
+    paths = args.path or ["/api/health-check", "/openapi-schema"]
+
+    print("{:<10} {:>9} {:>9} {:>9} {:>9} {:>7}".format("server", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors"))
+    for name in args.server or list(SERVERS):
+        port = free_port()
+        command = [part.format(port=port) for part in SERVERS[name]]
+        server = subprocess.Popen(command, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(port)
+            load(port, paths, 2, 1)  # warm up
+            latencies, errors = load(port, paths, args.concurrency, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        quantiles = statistics.quantiles(latencies, n=100)
+        print("{:<10} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} {:>7}".format(
+            name, len(latencies) / args.duration, quantiles[49], quantiles[94], quantiles[98], errors
+        ))
+
+
+if __name__ == "__main__":
+    main()
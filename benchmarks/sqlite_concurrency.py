@@ -0,0 +1,103 @@
+"""
+Mixed read/write throughput on ShoppingCart with many threads, on the stock
+SQLite backend (django.db.backends.sqlite3) and on the tuned one
+(ecommerce.sqlite3: WAL, pragmas, BEGIN IMMEDIATE with retry)
+
+Usage:
+    python benchmarks/sqlite_concurrency.py --threads 16 --duration 10 --writes 0.2
+"""
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENGINES = ["django.db.backends.sqlite3", "ecommerce.sqlite3"]
+
+
+def run(engine, threads, duration, writes):
+    """
+    Runs the workload on a fresh database file, returns (reads, writes, errors)
+    """
+    sys.path.insert(0, BASE_DIR)
+    os.environ["DJANGO_SETTINGS_MODULE"] = "ecommerce.settings"
+    from django.conf import settings
+    settings.DATABASES["default"].update(ENGINE=engine, NAME=os.path.join(tempfile.mkdtemp(), "bench.sqlite3"))
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.db import connection, transaction
+    from api.models import Customer, Product, ShoppingCart
+
+    call_command("migrate", verbosity=0)
+    product = Product.objects.create(name="P", description="", image_link="", price=1.0)
+    customers = [Customer.objects.create(name="C", email="c@test.case", phone="") for _ in range(50)]
+    for customer in customers:
+        ShoppingCart.objects.bulk_create([
+            ShoppingCart(customer=customer, product=product, quantity=1, discount_value=0.0, is_closed=False)
+            for _ in range(10)
+        ])
+    connection.close()
+
+    counts = {"reads": 0, "writes": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def worker():
+        done = {"reads": 0, "writes": 0, "errors": 0}
+        while time.time() < deadline:
+            customer = random.choice(customers)
+            try:
+                if random.random() < writes:
+                    # read-then-write transaction, the shape of a cart update
+                    with transaction.atomic():
+                        cart = ShoppingCart.objects.filter(customer=customer, is_closed=False).first()
+                        cart.quantity += 1
+                        cart.save(update_fields=["quantity", "closed_date"])
+                    done["writes"] += 1
+                else:
+                    list(ShoppingCart.objects.filter(customer=customer, is_closed=False))
+                    done["reads"] += 1
+            except Exception:
+                done["errors"] += 1
+        connection.close()
+        with lock:
+            for key, value in done.items():
+                counts[key] += value
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return counts["reads"], counts["writes"], counts["errors"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--writes", type=float, default=0.2, help="Share of write transactions")
+    parser.add_argument("--engine", choices=ENGINES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.engine:
+        print(*run(args.engine, args.threads, args.duration, args.writes))
+        return
+    print("{:<30} {:>9} {:>9} {:>9}".format("engine", "reads/s", "writes/s", "errors"))
+    for engine in ENGINES:
+        # one process per engine, Django can only be set up once
+        output = subprocess.check_output([
+            sys.executable, __file__, "--engine", engine, "--threads", str(args.threads),
+            "--duration", str(args.duration), "--writes", str(args.writes),
+        ], cwd=BASE_DIR, universal_newlines=True)
+        reads, writes, errors = map(int, output.split()[-3:])
+        print("{:<30} {:>9.1f} {:>9.1f} {:>9}".format(engine, reads / args.duration, writes / args.duration, errors))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import sys
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -25,6 +27,9 @@ SECRET_KEY = 'b49yz!xnpg3ux3@0+1&_dnp&0y22ymyk25rv&p#yh8ss8#870p'
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
+# running "manage.py test"
+TESTING = sys.argv[1:2] == ['test']
+
 ALLOWED_HOSTS = ['*']
 
 CORS_ORIGIN_ALLOW_ALL = True
@@ -48,12 +53,24 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
+        'api.authentication.SignedTokenAuthentication',
         'rest_framework.authentication.TokenAuthentication', 
     ],
+    'DEFAULT_FILTER_BACKENDS': ['api.filters.IndexedFilterBackend'],
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.FragmentJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.CreationDateCursorPagination',
+    'PAGE_SIZE': 50,
 }
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
+    'api.capture.TrafficCaptureMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'api.compression.CompressionMiddleware',
+    'api.instrumentation.QueryTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -61,6 +78,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'ecommerce.urls'
@@ -87,13 +105,161 @@ WSGI_APPLICATION = 'ecommerce.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
+# ecommerce.sqlite3 is django.db.backends.sqlite3 tuned for concurrency (WAL,
+# pragmas, BEGIN IMMEDIATE with retry), see ecommerce/sqlite3/base.py
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
+        'ENGINE': 'ecommerce.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
     }
 }
 
+# Read replicas: safe requests on the api viewsets read from these aliases,
+# see api/replicas.py. Locally, SQLITE_REPLICA=1 adds a copy of db.sqlite3
+# kept in sync by "python manage.py sync_replica --interval 5"
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+DATABASE_REPLICAS = []
+
+if os.environ.get('SQLITE_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'ecommerce.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.replica.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append('replica')
+
+# health check interval and ejection time of a failing replica
+REPLICA_CHECK_SECONDS = 10
+REPLICA_EJECT_SECONDS = 30
+# a client reads from the primary for this long after writing (read your
+# writes), pinned in the shared cache
+REPLICA_PIN_SECONDS = 5
+REPLICA_PIN_CACHE_ALIAS = 'state'
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+# The catalog generation, revoked tokens and replica pins must be seen by every
+# gunicorn worker: the caches are shared through files in CACHE_DIR, by the
+# workers of a container. With several containers, set MEMCACHED_LOCATION
+# (host:port, needs python-memcached) to share them between those. The revoked
+# tokens and replica pins are kept apart from the catalog payloads, in the
+# 'state' cache, so catalog traffic never evicts them: its files are only
+# removed once expired, and with memcached MEMCACHED_STATE_LOCATION must be an
+# instance of its own. The tests use fresh in-memory caches
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(BASE_DIR, '.cache'))
+if TESTING:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'ecommerce',
+        },
+        'state': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'ecommerce-state',
+        },
+    }
+elif os.environ.get('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHED_LOCATION'],
+        },
+        'state': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHED_STATE_LOCATION'],
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(CACHE_DIR, 'default'),
+            'OPTIONS': {'MAX_ENTRIES': 5000},
+        },
+        'state': {
+            'BACKEND': 'api.cache.ExpiringFileBasedCache',
+            'LOCATION': os.path.join(CACHE_DIR, 'state'),
+            'OPTIONS': {'MAX_ENTRIES': 5000},
+        },
+    }
+
+# Serialized product payloads (api.cache.CatalogCache)
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = 300
+
+# Response compression (api.compression.CompressionMiddleware): brotli when
+# the Brotli package is installed, else gzip. Streaming responses are always
+# compressed
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_CONTENT_TYPES = ('application/json', 'application/x-ndjson', 'text/csv')
+
+# Sampled requests written as JSON lines by api.capture.TrafficCaptureMiddleware,
+# to replay with "python manage.py replay_traffic". Off with a rate of 0
+TRAFFIC_CAPTURE_RATE = float(os.environ.get('TRAFFIC_CAPTURE_RATE', 0))
+TRAFFIC_CAPTURE_PATH = os.environ.get('TRAFFIC_CAPTURE_PATH', os.path.join(BASE_DIR, 'traffic.jsonl'))
+TRAFFIC_CAPTURE_PREFIXES = ('/api/',)
+TRAFFIC_CAPTURE_MAX_BODY = 64 * 1024
+# keys of the JSON bodies whose values are never written
+TRAFFIC_CAPTURE_REDACT = ('password', 'token')
+
+# SQL queries counted and timed by api.instrumentation.QueryTimingMiddleware
+# on this fraction of the requests (always in the tests), reported in a
+# Server-Timing header and the "api.queries" log. A query shape repeated this
+# many times in a request is reported as N+1
+QUERY_TIMING_RATE = 1.0 if TESTING else float(os.environ.get('QUERY_TIMING_RATE', 0))
+QUERY_TIMING_REPEATS = 5
+
+# Prometheus metrics served on /metrics (api.metrics): each worker writes its
+# counters to METRICS_DIR every METRICS_FLUSH_SECONDS, the worker answering a
+# scrape merges them. Off unless set: use a directory on tmpfs of this
+# deployment only (the Docker image sets one), other processes' files are merged
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_SECONDS = 5
+# /metrics answers the callers from these networks, reaching the server
+# directly (no X-Forwarded-For: not through the load balancer), and with
+# METRICS_TOKEN set, sending it as "Authorization: Bearer <token>"
+METRICS_ALLOWED_NETWORKS = ('127.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', '::1/128')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# On-demand profiling (api.profiling.ProfilingMiddleware) of the requests with a
+# signed X-Profile header (manage.py profiling_token), valid PROFILING_TOKEN_MAX_AGE
+# seconds, or from staff users with ?profile=1: the stack is sampled every
+# PROFILING_INTERVAL seconds, and the last PROFILING_MAX_PROFILES profiles, up to
+# PROFILING_MAX_BYTES, are kept in PROFILING_DIR. Empty turns the profiling off
+PROFILING_DIR = os.environ.get('PROFILING_DIR', os.path.join(tempfile.gettempdir(), 'ecommerce-profiles'))
+PROFILING_INTERVAL = 0.001
+PROFILING_TOP = 30
+PROFILING_MAX_PROFILES = 50
+PROFILING_MAX_BYTES = 20 * 1024 * 1024
+PROFILING_TOKEN_MAX_AGE = 3600
+
+# Product search (api.search) ranks at most this many of the matches, the
+# newest, and flags the results as truncated when a query matches more: BM25
+# reads every match, ranking all of a common word's takes seconds. Lowering it
+# doesn't lower the latency much: bm25() also counts every match of each word
+# for its IDF (see benchmarks/search.py)
+SEARCH_MAX_RANKED = 2000
+
+# Client cache lifetime of the precompiled OpenAPI schema and Swagger page
+DOCS_CACHE_SECONDS = 24 * 60 * 60
+
+# Encoded JSON of the objects embedded in list pages (api.fragments.FragmentCache),
+# kept in each worker's memory up to this size
+FRAGMENT_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Signed API tokens (api.authentication.SignedTokenAuthentication)
+# Keys by version: add a new version and switch SIGNED_TOKEN_VERSION to rotate
+SIGNED_TOKEN_KEYS = {
+    '1': SECRET_KEY,
+}
+SIGNED_TOKEN_VERSION = '1'
+SIGNED_TOKEN_TTL = 3600
+# Revoked tokens are kept in this cache, shared by the workers
+SIGNED_TOKEN_REVOCATION = True
+SIGNED_TOKEN_CACHE_ALIAS = 'state'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
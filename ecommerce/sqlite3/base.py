@@ -0,0 +1,45 @@
+"""
+SQLite backend tuned for concurrent access
+
+Every connection runs in WAL mode (readers don't block the writer), with
+relaxed fsync, memory mapped reads, a bigger page cache and a busy timeout.
+Transactions start with BEGIN IMMEDIATE, so the write lock is taken up front
+instead of failing on upgrade halfway through, and BEGIN is retried with
+backoff while the database is locked. Pragmas can be overridden with a
+"PRAGMAS" dict in the DATABASES entry
+"""
+import random
+import time
+from django.db.backends.sqlite3 import base
+from django.db.utils import OperationalError
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    pragmas = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 128 * 1024 * 1024,
+        "cache_size": -16000,  # KiB
+        "busy_timeout": 5000,  # ms
+    }
+    begin_attempts = 5
+    begin_backoff = 0.05  # seconds, doubled on each attempt
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        pragmas = {**self.pragmas, **self.settings_dict.get("PRAGMAS", {})}
+        if self.is_in_memory_db():
+            pragmas.pop("journal_mode", None)
+        for name, value in pragmas.items():
+            conn.execute("PRAGMA {} = {}".format(name, value))
+        return conn
+
+    def _start_transaction_under_autocommit(self):
+        for attempt in range(self.begin_attempts):
+            try:
+                self.cursor().execute("BEGIN IMMEDIATE")
+                return
+            except OperationalError as e:
+                if "locked" not in str(e) or attempt == self.begin_attempts - 1:
+                    raise
+            time.sleep(self.begin_backoff * 2 ** attempt * random.uniform(0.5, 1.5))
@@ -15,15 +15,15 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
-from django.views.generic import TemplateView
 from api import views
 
 urlpatterns = [
     # docs
-    path('', TemplateView.as_view(template_name='swagger-ui.html', extra_context={'schema_url':'openapi-schema'}), name='swagger-ui'),
-    path('openapi-schema', TemplateView.as_view(template_name='docs.yml'), name='openapi-schema'),
+    path('', views.PrecompiledTemplateView.as_view(template_name='swagger-ui.html', extra_context={'schema_url':'openapi-schema'}), name='swagger-ui'),
+    path('openapi-schema', views.PrecompiledTemplateView.as_view(template_name='docs.yml', content_type='application/yaml; charset=utf-8'), name='openapi-schema'),
     # END docs
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
     path('auth', views.AuthToken.as_view()),
+    path('metrics', views.MetricsView.as_view(), name='metrics'),
 ]
@@ -0,0 +1,71 @@
+"""
+Gunicorn settings for the production container (see Dockerfile)
+
+Workers and threads are sized from the task's "cpu" and "memory" in
+config.json, and can be overridden with the WEB_CONCURRENCY and WEB_THREADS
+environment variables. To serve ecommerce.asgi instead, run:
+    WEB_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn ecommerce.asgi:application
+"""
+import json
+import os
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def task_size():
+    """
+    Returns the (cpu units, memory MB) of the ECS task, 1024 cpu units being 1 vCPU
+    """
+    try:
+        with open(os.path.join(BASE_DIR, "config.json")) as config_file:
+            config = json.load(config_file)
+    except (OSError, ValueError):
+        config = {}
+    return int(config.get("cpu", 1024)), int(config.get("memory", 2048))
+
+
+cpu_units, memory_mb = task_size()
+
+# (2 x vCPUs) + 1 workers, at least 2 so one can be recycled while the other
+# serves, and no more than the memory can hold (about 128 MB per worker)
+workers = int(os.environ.get("WEB_CONCURRENCY", max(2, min(2 * cpu_units // 1024 + 1, memory_mb // 128))))
+# threads cover the time spent waiting on the database
+threads = int(os.environ.get("WEB_THREADS", 4))
+worker_class = os.environ.get("WEB_WORKER_CLASS", "gthread")
+bind = "0.0.0.0:{}".format(os.environ.get("PORT", "80"))
+
+# load the app once in the master, workers share its memory
+preload_app = True
+# longer than the load balancer idle timeout (60s), so it closes connections first
+keepalive = 75
+# recycle workers to bound memory growth, jittered so they don't restart together
+max_requests = 1000
+max_requests_jitter = 100
+timeout = 30
+# SIGTERM drains in flight requests, within the ECS stop timeout (30s)
+graceful_timeout = 25
+# heartbeat files on tmpfs, the container's disk may block
+worker_tmp_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+accesslog = "-"
+errorlog = "-"
+
+
+def on_starting(server):
+    # metrics of the workers, merged by the one answering /metrics (see api.metrics)
+    from api import metrics
+    metrics.reset()
+    # the app is preloaded: the workers fork with the docs already rendered
+    from api.views import warm_precompiled_templates
+    warm_precompiled_templates()
+
+
+def worker_exit(server, worker):
+    # the counts since the last flush of a recycled worker
+    from api import metrics
+    metrics.registry.flush()
+
+
+def child_exit(server, worker):
+    from api import metrics
+    metrics.retire(worker.pid)